@@ -1,80 +1,116 @@
 """
 Servicio de Evaluaciones Dinámicas (Assessment Service)
 Genera tests desde el contenido vectorizado (RAG) y corrige respuestas abiertas (LLM-as-a-Judge).
+
+Las preguntas generadas se guardan una a una en banco_preguntas (con sus bloques fuente,
+dificultad y embedding). Una evaluación nueva se monta al instante desde el banco del
+temario eligiendo preguntas variadas (MMR sobre los embeddings); el LLM solo se llama
+en segundo plano para reponer el banco cuando se queda corto.
+
+Los veredictos del juez se guardan en cache_correcciones: una respuesta igual (normalizada)
+o casi igual (embedding) a otra ya calificada para la misma pregunta reutiliza su nota.
+Antes del juez, una pre-corrección local (embeddings + reglas léxicas) califica sin LLM
+los casos evidentes: respuesta vacía, idéntica a la esperada o fuera de tema.
 """
+import re
 import json
 import os
+import hashlib
+import threading
+import unicodedata
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import List, Dict, Any, Optional
+
+import numpy as np
 from sqlalchemy.orm import Session
-from sqlalchemy import select
+from sqlalchemy import select, text, func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 
 from mistralai import Mistral
-from app.models.modelos import BaseConocimiento, Temario, Assessment, TestScore
-from app.crud.embedding_service import generar_embedding
+from app.db.database import SessionLocal
+from app.models.modelos import BaseConocimiento, Temario, Assessment, TestScore, PreguntaBanco, CacheCorreccion
+from app.crud.embedding_service import generar_embedding, generar_embeddings_batch, EMBEDDING_DIM
+from app.crud.rate_limit_service import esperar, estimar_tokens_mensajes, retry_with_backoff, PROVEEDOR_MISTRAL
 
 # Cliente Mistral (para generación de tests y corrección)
 api_key = os.getenv("MISTRAL_API_KEY")
 client = Mistral(api_key=api_key) if api_key else None
+MODELO_EVALUACION = "mistral-large-latest"
+
+# Banco de preguntas
+BANCO_MIN_PREGUNTAS = int(os.getenv("BANCO_MIN_PREGUNTAS", "15"))    # Stock (poco usadas) antes de reponer
+BANCO_MAX_PREGUNTAS = int(os.getenv("BANCO_MAX_PREGUNTAS", "60"))    # Tope por temario (no se repone más)
+BANCO_LOTE_GENERACION = int(os.getenv("BANCO_LOTE_GENERACION", "10"))  # Preguntas por llamada de reposición
+BANCO_MAX_USOS = int(os.getenv("BANCO_MAX_USOS", "5"))                # A partir de aquí no cuenta como stock
+BANCO_MMR_LAMBDA = float(os.getenv("BANCO_MMR_LAMBDA", "0.6"))        # 1 = solo poco usadas, 0 = solo variedad
+BANCO_SIMILITUD_DUPLICADO = float(os.getenv("BANCO_SIMILITUD_DUPLICADO", "0.92"))  # Coseno: se descarta
+BANCO_BLOQUEO = 47_000  # Clave de pg_try_advisory_xact_lock (con el temario_id): una reposición a la vez
+CONTEXTO_MAX_CARACTERES = 8000
+
+TIPOS_MINIMOS = {"opcion_multiple": 2, "verdadero_falso": 1, "abierta": 1}
+
+
+@retry_with_backoff(PROVEEDOR_MISTRAL, MODELO_EVALUACION)
+def _completar_json(messages: List[Dict[str, str]], temperatura: float) -> Dict[str, Any]:
+    """Llamada JSON a Mistral respetando los límites compartidos del modelo."""
+    esperar(PROVEEDOR_MISTRAL, MODELO_EVALUACION, estimar_tokens_mensajes(messages))
+    response = client.chat.complete(
+        model=MODELO_EVALUACION,
+        messages=messages,
+        response_format={"type": "json_object"},
+        temperature=temperatura
+    )
+    return json.loads(response.choices[0].message.content)
 
 
 # ============================================================================
-# 1. GENERACIÓN DINÁMICA DE EVALUACIONES
+# 1. GENERACIÓN DINÁMICA DE EVALUACIONES (LLM → banco de preguntas)
 # ============================================================================
 
-def generar_evaluacion(
-    db: Session, 
-    temario_id: int, 
-    num_preguntas: int = 5,
-    temperatura: float = 0.7
-) -> Dict[str, Any]:
+def _seleccionar_contexto(bloques: List[BaseConocimiento], cobertura: Dict[int, int]) -> List[BaseConocimiento]:
     """
-    Genera una evaluación dinámica basada en el contenido del temario indexado.
-    
-    Pipeline:
-    1. Recupera fragmentos del temario desde la base vectorial
-    2. Construye meta-prompt para generar preguntas diversificadas
-    3. Fuerza salida JSON estructurada
-    4. Persiste en tabla Assessment
-    
-    Args:
-        db: Sesión de base de datos
-        temario_id: ID del temario sobre el que generar la evaluación
-        num_preguntas: Número de preguntas a generar
-        temperatura: Controla variabilidad (0.0=determinista, 1.0=creativo)
-    
-    Returns:
-        Diccionario con la evaluación generada y su ID en la DB
+    Bloques que caben en el contexto, empezando por los que menos preguntas tienen ya en
+    el banco (sin banco = los primeros del tema, como siempre). Se devuelven en orden de lectura.
     """
-    # 1. Obtener info del tema
-    tema = db.query(Temario).filter(Temario.id == temario_id).first()
-    if not tema:
-        return {"error": f"Temario con id={temario_id} no encontrado"}
-    
-    # 2. Recuperar fragmentos del tema (contenido del libro)
-    bloques = db.query(BaseConocimiento).filter(
-        BaseConocimiento.temario_id == temario_id
-    ).order_by(BaseConocimiento.orden_aparicion.asc()).all()
-    
-    if not bloques:
-        return {"error": f"No hay contenido indexado para el temario '{tema.nombre}'"}
-    
-    # Concatenar contenido para contexto
+    elegidos, total = [], 0
+    for b in sorted(bloques, key=lambda b: (cobertura.get(b.id, 0), b.orden_aparicion)):
+        if total + len(b.contenido) > CONTEXTO_MAX_CARACTERES and elegidos:
+            continue
+        elegidos.append(b)
+        total += len(b.contenido)
+    return sorted(elegidos, key=lambda b: b.orden_aparicion)
+
+
+def _generar_preguntas_llm(
+    tema: Temario,
+    bloques: List[BaseConocimiento],
+    num_preguntas: int,
+    temperatura: float,
+    evitar: List[str] = (),
+) -> Dict[str, Any]:
+    """Pide al LLM `num_preguntas` preguntas sobre los bloques dados (formato JSON estricto)."""
     contenido_completo = "\n\n".join([
-        f"[Bloque {b.orden_aparicion} - Tipo: {b.tipo_contenido}]\n{b.contenido}" 
+        f"[Bloque {b.orden_aparicion} - Tipo: {b.tipo_contenido}]\n{b.contenido}"
         for b in bloques
     ])
-    
-    # 3. Meta-prompt para generación de evaluaciones
+    lista_evitar = "\n".join(f"    - {e}" for e in evitar)
+    seccion_evitar = f"""
+    PREGUNTAS QUE YA EXISTEN (no las repitas ni las parafrasees):
+{lista_evitar}
+    """ if evitar else ""
+
+    # Meta-prompt para generación de evaluaciones
     prompt_generacion = f"""
     ERES UN GENERADOR DE EVALUACIONES ACADÉMICAS EXPERTO.
     
     CONTEXTO DEL LIBRO (usa EXCLUSIVAMENTE este contenido para formular preguntas):
     ---
-    {contenido_completo[:8000]}
+    {contenido_completo[:CONTEXTO_MAX_CARACTERES]}
     ---
     
     TEMA: {tema.nombre}
-    
+    {seccion_evitar}
     INSTRUCCIONES:
     1. Genera exactamente {num_preguntas} preguntas sobre el contenido anterior.
     2. Tipos de preguntas a incluir:
@@ -88,6 +124,7 @@ def generar_evaluacion(
        - respuesta_correcta: Índice (0-based) para opción múltiple/V/F, o texto para abierta
        - justificacion: Explicación de por qué es correcta (cita del libro)
        - dificultad: 1 (fácil), 2 (media), 3 (difícil)
+       - bloques: Números de los [Bloque N] en los que se basa la pregunta
     
     FORMATO JSON ESTRICTO:
     {{
@@ -99,7 +136,8 @@ def generar_evaluacion(
                 "opciones": ["A) ...", "B) ...", "C) ...", "D) ..."],
                 "respuesta_correcta": 0,
                 "justificacion": "...",
-                "dificultad": 1
+                "dificultad": 1,
+                "bloques": [3]
             }},
             {{
                 "enunciado": "...",
@@ -107,7 +145,8 @@ def generar_evaluacion(
                 "opciones": ["Verdadero", "Falso"],
                 "respuesta_correcta": 0,
                 "justificacion": "...",
-                "dificultad": 1
+                "dificultad": 1,
+                "bloques": [5]
             }},
             {{
                 "enunciado": "...",
@@ -115,52 +154,347 @@ def generar_evaluacion(
                 "opciones": [],
                 "respuesta_correcta": "La respuesta esperada...",
                 "justificacion": "...",
-                "dificultad": 2
+                "dificultad": 2,
+                "bloques": [4, 5]
             }}
         ]
     }}
     """
-    
+    return _completar_json(
+        [
+            {"role": "system", "content": prompt_generacion},
+            {"role": "user", "content": f"Genera {num_preguntas} preguntas sobre: {tema.nombre}"}
+        ],
+        temperatura
+    )
+
+
+def _texto_pregunta(pregunta: Dict[str, Any]) -> str:
+    """Enunciado + respuesta correcta: lo que se compara para medir si dos preguntas se parecen."""
+    respuesta = pregunta.get("respuesta_correcta", "")
+    opciones = pregunta.get("opciones") or []
+    if isinstance(respuesta, int) and 0 <= respuesta < len(opciones):
+        respuesta = opciones[respuesta]
+    return f"{pregunta.get('enunciado', '')}\n{respuesta}"
+
+
+def _matriz_normalizada(vectores: List[Optional[list]]) -> np.ndarray:
+    """Vectores L2-normalizados en filas (fila de ceros si la pregunta no tiene embedding)."""
+    matriz = np.zeros((len(vectores), EMBEDDING_DIM), dtype=np.float32)
+    for i, v in enumerate(vectores):
+        if v is not None:
+            matriz[i] = np.asarray(v, dtype=np.float32)
+    normas = np.linalg.norm(matriz, axis=1, keepdims=True)
+    return matriz / np.where(normas == 0, 1, normas)
+
+
+def guardar_en_banco(
+    db: Session,
+    temario_id: int,
+    preguntas: List[Dict[str, Any]],
+    bloques: List[BaseConocimiento],
+) -> List[PreguntaBanco]:
+    """
+    Guarda las preguntas generadas en el banco (sin commit). Calcula sus embeddings en un
+    lote, traduce los números de bloque a IDs de base_conocimiento y descarta las casi
+    idénticas a otra del banco o del mismo lote (coseno >= BANCO_SIMILITUD_DUPLICADO).
+    """
+    validas = [p for p in preguntas if p.get("enunciado") and p.get("tipo") in TIPOS_MINIMOS]
+    if not validas:
+        return []
+
+    try:
+        vectores = generar_embeddings_batch(db, [_texto_pregunta(p) for p in validas])
+    except Exception as e:
+        print(f"⚠️ Banco: sin embeddings para las preguntas nuevas ({e}); se guardan sin deduplicar")
+        vectores = [None] * len(validas)
+
+    existentes = db.execute(
+        select(PreguntaBanco.embedding).where(
+            PreguntaBanco.temario_id == temario_id,
+            PreguntaBanco.activa.is_(True),
+            PreguntaBanco.embedding.is_not(None),
+        )
+    ).scalars().all()
+    vistos = _matriz_normalizada(list(existentes))
+    nuevos = _matriz_normalizada(vectores)
+
+    id_por_orden = {b.orden_aparicion: b.id for b in bloques}
+    guardadas = []
+    for i, pregunta in enumerate(validas):
+        if vectores[i] is not None and len(vistos) and float((vistos @ nuevos[i]).max()) >= BANCO_SIMILITUD_DUPLICADO:
+            continue
+        bloques_fuente = [id_por_orden[n] for n in pregunta.pop("bloques", None) or [] if n in id_por_orden]
+        fila = PreguntaBanco(
+            temario_id=temario_id,
+            tipo=pregunta["tipo"],
+            enunciado=pregunta["enunciado"],
+            contenido=pregunta,
+            dificultad=int(pregunta.get("dificultad") or 2),
+            bloques_fuente=bloques_fuente or None,
+            embedding=vectores[i],
+        )
+        db.add(fila)
+        guardadas.append(fila)
+        if vectores[i] is not None:
+            vistos = np.vstack([vistos, nuevos[i:i + 1]])
+
+    descartadas = len(validas) - len(guardadas)
+    print(f"🏦 Banco temario {temario_id}: {len(guardadas)} preguntas nuevas"
+          + (f" ({descartadas} duplicadas descartadas)" if descartadas else ""))
+    return guardadas
+
+
+def _seleccionar_mmr(candidatas: List[PreguntaBanco], num_preguntas: int) -> List[PreguntaBanco]:
+    """
+    Maximal Marginal Relevance: en cada paso elige la pregunta con mejor
+    λ·relevancia − (1−λ)·similitud máxima con las ya elegidas. La relevancia premia las
+    menos usadas (evaluaciones frescas). Cuando los huecos que quedan son justo los tipos
+    mínimos que faltan (TIPOS_MINIMOS), solo se consideran preguntas de esos tipos.
+    """
+    if len(candidatas) <= num_preguntas:
+        return list(candidatas)
+
+    matriz = _matriz_normalizada([c.embedding for c in candidatas])
+    relevancia = np.array([1.0 / (1 + (c.veces_usada or 0)) for c in candidatas])
+    similitud_max = np.zeros(len(candidatas))
+    libres = np.ones(len(candidatas), dtype=bool)
+    faltan = {t: n for t, n in TIPOS_MINIMOS.items() if any(c.tipo == t for c in candidatas)}
+    elegidas = []
+
+    while len(elegidas) < num_preguntas and libres.any():
+        permitidas = libres.copy()
+        if sum(faltan.values()) >= num_preguntas - len(elegidas):
+            de_tipo = np.array([faltan.get(c.tipo, 0) > 0 for c in candidatas])
+            if (permitidas & de_tipo).any():
+                permitidas &= de_tipo
+        puntuacion = BANCO_MMR_LAMBDA * relevancia - (1 - BANCO_MMR_LAMBDA) * similitud_max
+        i = int(np.argmax(np.where(permitidas, puntuacion, -np.inf)))
+
+        elegidas.append(candidatas[i])
+        libres[i] = False
+        if faltan.get(candidatas[i].tipo, 0) > 0:
+            faltan[candidatas[i].tipo] -= 1
+        similitud_max = np.maximum(similitud_max, matriz @ matriz[i])
+
+    # Mismo orden que las generadas por el LLM: primero opción múltiple, V/F y abiertas al final
+    orden_tipos = list(TIPOS_MINIMOS)
+    return sorted(elegidas, key=lambda c: orden_tipos.index(c.tipo))
+
+
+def _contar_stock(db: Session, temario_id: int) -> Dict[str, int]:
+    total, stock = db.execute(
+        select(
+            func.count(PreguntaBanco.id),
+            func.count(PreguntaBanco.id).filter(PreguntaBanco.veces_usada < BANCO_MAX_USOS),
+        ).where(PreguntaBanco.temario_id == temario_id, PreguntaBanco.activa.is_(True))
+    ).one()
+    return {"total": total, "stock": stock}
+
+
+def _necesita_reposicion(conteo: Dict[str, int]) -> bool:
+    return conteo["stock"] < BANCO_MIN_PREGUNTAS and conteo["total"] < BANCO_MAX_PREGUNTAS
+
+
+def reponer_banco(db: Session, temario_id: int, cantidad: int = BANCO_LOTE_GENERACION) -> Dict[str, Any]:
+    """
+    Genera `cantidad` preguntas nuevas con el LLM y las guarda en el banco. El contexto
+    prioriza los bloques con menos preguntas y el prompt lista las existentes para no
+    repetirlas. Un advisory lock por temario evita reposiciones simultáneas (varios
+    workers de la API).
+    """
     if not client:
         return {"error": "No hay cliente Mistral configurado"}
+    tema = db.get(Temario, temario_id)
+    if not tema:
+        return {"error": f"Temario con id={temario_id} no encontrado"}
+    if not db.execute(text("SELECT pg_try_advisory_xact_lock(:clave, :t)"), {"clave": BANCO_BLOQUEO, "t": temario_id}).scalar():
+        return {"temario_id": temario_id, "nuevas": 0, "omitido": "reposición en curso"}
+
+    bloques = db.query(BaseConocimiento).filter(
+        BaseConocimiento.temario_id == temario_id
+    ).order_by(BaseConocimiento.orden_aparicion.asc()).all()
+    if not bloques:
+        db.rollback()
+        return {"error": f"No hay contenido indexado para el temario '{tema.nombre}'"}
+
+    existentes = db.execute(
+        select(PreguntaBanco.enunciado, PreguntaBanco.bloques_fuente).where(
+            PreguntaBanco.temario_id == temario_id, PreguntaBanco.activa.is_(True)
+        )
+    ).all()
+    cobertura: Dict[int, int] = {}
+    for _, fuentes in existentes:
+        for bloque_id in fuentes or []:
+            cobertura[bloque_id] = cobertura.get(bloque_id, 0) + 1
+
+    contexto = _seleccionar_contexto(bloques, cobertura)
+    generado = _generar_preguntas_llm(tema, contexto, cantidad, 0.9, evitar=[e for e, _ in existentes][-40:])
+    guardadas = guardar_en_banco(db, temario_id, generado.get("preguntas", []), contexto)
+    db.commit()  # Libera también el advisory lock
+    return {"temario_id": temario_id, "nuevas": len(guardadas), **_contar_stock(db, temario_id)}
+
+
+_reposiciones_en_curso: set = set()
+_lock_reposiciones = threading.Lock()
+
+
+def _reponer_en_hilo(temario_id: int):
+    db = SessionLocal()
+    try:
+        resultado = reponer_banco(db, temario_id)
+        if "error" in resultado:
+            print(f"⚠️ Banco temario {temario_id}: {resultado['error']}")
+    except Exception as e:
+        db.rollback()
+        print(f"❌ Error reponiendo el banco del temario {temario_id}: {e}")
+    finally:
+        db.close()
+        with _lock_reposiciones:
+            _reposiciones_en_curso.discard(temario_id)
+
+
+def reponer_banco_async(temario_id: int) -> bool:
+    """Lanza la reposición en un hilo de fondo (como mucho una por temario en este proceso)."""
+    if not client:
+        return False
+    with _lock_reposiciones:
+        if temario_id in _reposiciones_en_curso:
+            return False
+        _reposiciones_en_curso.add(temario_id)
+    threading.Thread(target=_reponer_en_hilo, args=(temario_id,), name=f"banco-{temario_id}", daemon=True).start()
+    return True
+
+
+def estado_banco(db: Session, temario_id: int) -> Dict[str, Any]:
+    """Tamaño del banco de un temario por tipo y dificultad, y si toca reponerlo."""
+    conteo = _contar_stock(db, temario_id)
+    filas = db.execute(
+        select(PreguntaBanco.tipo, PreguntaBanco.dificultad, func.count(PreguntaBanco.id), func.sum(PreguntaBanco.veces_usada))
+        .where(PreguntaBanco.temario_id == temario_id, PreguntaBanco.activa.is_(True))
+        .group_by(PreguntaBanco.tipo, PreguntaBanco.dificultad)
+    ).all()
+    por_tipo: Dict[str, int] = {}
+    por_dificultad: Dict[int, int] = {}
+    usos = 0
+    for tipo, dificultad, n, veces in filas:
+        por_tipo[tipo] = por_tipo.get(tipo, 0) + n
+        por_dificultad[dificultad] = por_dificultad.get(dificultad, 0) + n
+        usos += veces or 0
+    return {
+        "temario_id": temario_id,
+        **conteo,
+        "por_tipo": por_tipo,
+        "por_dificultad": por_dificultad,
+        "usos_totales": usos,
+        "necesita_reposicion": _necesita_reposicion(conteo),
+        "reponiendo": temario_id in _reposiciones_en_curso,
+    }
+
+
+def _montar_desde_banco(db: Session, tema: Temario, num_preguntas: int) -> Optional[List[PreguntaBanco]]:
+    """Preguntas del banco para una evaluación, o None si no hay suficientes."""
+    candidatas = db.query(PreguntaBanco).filter(
+        PreguntaBanco.temario_id == tema.id, PreguntaBanco.activa.is_(True)
+    ).all()
+    if len(candidatas) < num_preguntas:
+        return None
+    return _seleccionar_mmr(candidatas, num_preguntas)
+
+
+def generar_evaluacion(
+    db: Session, 
+    temario_id: int, 
+    num_preguntas: int = 5,
+    temperatura: float = 0.7,
+    usar_banco: bool = True,
+) -> Dict[str, Any]:
+    """
+    Genera una evaluación dinámica basada en el contenido del temario indexado.
+    
+    Pipeline:
+    1. Si el banco del temario tiene preguntas suficientes, las elige con MMR (sin LLM)
+    2. Si no, recupera fragmentos del temario y genera las preguntas con el LLM
+       (JSON estructurado) y las guarda en el banco
+    3. Persiste en tabla Assessment
+    4. Si el banco se queda corto, lo repone en segundo plano
+    
+    Args:
+        db: Sesión de base de datos
+        temario_id: ID del temario sobre el que generar la evaluación
+        num_preguntas: Número de preguntas a generar
+        temperatura: Controla variabilidad (0.0=determinista, 1.0=creativo)
+        usar_banco: False fuerza una generación nueva con el LLM
+    
+    Returns:
+        Diccionario con la evaluación generada y su ID en la DB
+    """
+    # 1. Obtener info del tema
+    tema = db.query(Temario).filter(Temario.id == temario_id).first()
+    if not tema:
+        return {"error": f"Temario con id={temario_id} no encontrado"}
     
     try:
-        response = client.chat.complete(
-            model="mistral-large-latest",
-            messages=[
-                {"role": "system", "content": prompt_generacion},
-                {"role": "user", "content": f"Genera {num_preguntas} preguntas sobre: {tema.nombre}"}
-            ],
-            response_format={"type": "json_object"},
-            temperature=temperatura
-        )
-        
-        evaluacion_json = json.loads(response.choices[0].message.content)
+        elegidas = _montar_desde_banco(db, tema, num_preguntas) if usar_banco else None
         
-        # 4. Persistir en tabla Assessment
-        preguntas = evaluacion_json.get("preguntas", [])
-        titulo = evaluacion_json.get("titulo", f"Evaluación: {tema.nombre}")
+        if elegidas is not None:
+            origen = "banco"
+            titulo = f"Evaluación: {tema.nombre}"
+            preguntas = [dict(p.contenido) for p in elegidas]
+            for p in elegidas:
+                p.veces_usada = (p.veces_usada or 0) + 1
+            banco_ids = [p.id for p in elegidas]
+        else:
+            # 2. Recuperar fragmentos del tema (contenido del libro)
+            bloques = db.query(BaseConocimiento).filter(
+                BaseConocimiento.temario_id == temario_id
+            ).order_by(BaseConocimiento.orden_aparicion.asc()).all()
+            
+            if not bloques:
+                return {"error": f"No hay contenido indexado para el temario '{tema.nombre}'"}
+            if not client:
+                return {"error": "No hay cliente Mistral configurado"}
+            
+            origen = "llm"
+            contexto = _seleccionar_contexto(bloques, {})
+            evaluacion_json = _generar_preguntas_llm(tema, contexto, num_preguntas, temperatura)
+            preguntas = evaluacion_json.get("preguntas", [])
+            titulo = evaluacion_json.get("titulo", f"Evaluación: {tema.nombre}")
+            guardadas = guardar_en_banco(db, temario_id, [dict(p) for p in preguntas], contexto)
+            for p in guardadas:
+                p.veces_usada = 1
+            db.flush()
+            banco_ids = [p.id for p in guardadas]
+            for p in preguntas:
+                p.pop("bloques", None)
         
+        # 3. Persistir en tabla Assessment
         nueva_evaluacion = Assessment(
             temario_id=temario_id,
             titulo=titulo,
             topic_metadata=tema.nombre,
             total_preguntas=len(preguntas),
-            generated_json_payload=evaluacion_json,
+            generated_json_payload={"titulo": titulo, "preguntas": preguntas, "origen": origen, "banco_ids": banco_ids},
             temperatura=temperatura,
         )
         db.add(nueva_evaluacion)
         db.commit()
         db.refresh(nueva_evaluacion)
         
+        # 4. Reponer el banco en segundo plano si se está agotando
+        if _necesita_reposicion(_contar_stock(db, temario_id)):
+            reponer_banco_async(temario_id)
+        
         return {
             "assessment_id": nueva_evaluacion.id,
             "titulo": titulo,
             "total_preguntas": len(preguntas),
             "preguntas": preguntas,
+            "origen": origen,
         }
         
     except Exception as e:
+        db.rollback()
         print(f"Error generando evaluación: {e}")
         return {"error": str(e)}
 
@@ -169,6 +503,64 @@ def generar_evaluacion(
 # 2. CORRECCIÓN SEMÁNTICA (LLM-as-a-Judge)
 # ============================================================================
 
+CRITERIOS_CORRECCION = """
+    INSTRUCCIONES DE CALIFICACIÓN:
+    1. Evalúa si la respuesta del alumno aborda los conceptos clave requeridos.
+    2. Acepta parafraseo, sinónimos y diferentes formas de expresar la misma idea.
+    3. NO penalices por diferencias puramente sintácticas o de vocabulario.
+    4. SÍ penaliza errores conceptuales o información incorrecta.
+"""
+
+
+def _pregunta_abierta(assessment: Optional[Assessment], pregunta_idx: int) -> Dict[str, Any]:
+    """Pregunta `pregunta_idx` del assessment, o {"error": ...} si no existe."""
+    if not assessment:
+        return {"error": "Evaluación no encontrada"}
+    preguntas = assessment.generated_json_payload.get("preguntas", [])
+    if pregunta_idx >= len(preguntas):
+        return {"error": f"Pregunta {pregunta_idx} no existe en la evaluación"}
+    return preguntas[pregunta_idx]
+
+
+def _score_abierta(assessment_id: int, usuario_id: int, pregunta_idx: int,
+                   respuesta_alumno: str, resultado: Dict[str, Any], cache: Optional[Dict] = None,
+                   precorreccion: Optional[Dict] = None) -> TestScore:
+    respuestas = {
+        "pregunta_idx": pregunta_idx,
+        "respuesta": respuesta_alumno
+    }
+    log = dict(resultado)
+    if precorreccion:
+        respuestas["precorreccion"] = precorreccion["motivo"]
+        log["precorreccion"] = precorreccion
+    if cache:
+        respuestas["cache"] = cache["nivel"]
+        entrada = cache.get("entrada")  # None = repetida dentro del mismo lote
+        log["cache"] = {"nivel": cache["nivel"], "similitud": cache["similitud"], "entrada_id": entrada.id if entrada else None}
+    return TestScore(
+        assessment_id=assessment_id,
+        usuario_id=usuario_id,
+        score=resultado.get("score", 0),
+        respuestas_alumno=respuestas,
+        ai_feedback_log=json.dumps(log, ensure_ascii=False),
+    )
+
+
+def _respuesta_corregida(score: TestScore, resultado: Dict[str, Any], cache: Optional[Dict] = None,
+                         precorreccion: Optional[Dict] = None) -> Dict[str, Any]:
+    return {
+        "score_id": score.id,
+        "score": score.score,
+        "nivel": resultado.get("nivel", ""),
+        "feedback": resultado.get("feedback", ""),
+        "conceptos_correctos": resultado.get("conceptos_correctos", []),
+        "conceptos_faltantes": resultado.get("conceptos_faltantes", []),
+        "desde_cache": cache is not None,
+        "cache": {"nivel": cache["nivel"], "similitud": cache["similitud"]} if cache else None,
+        "precorreccion": precorreccion["motivo"] if precorreccion else None,
+    }
+
+
 def corregir_respuesta_abierta(
     db: Session,
     assessment_id: int,
@@ -194,14 +586,23 @@ def corregir_respuesta_abierta(
     """
     # Obtener la evaluación
     assessment = db.query(Assessment).filter(Assessment.id == assessment_id).first()
-    if not assessment:
-        return {"error": "Evaluación no encontrada"}
+    pregunta = _pregunta_abierta(assessment, pregunta_idx)
+    if "error" in pregunta:
+        return pregunta
     
-    preguntas = assessment.generated_json_payload.get("preguntas", [])
-    if pregunta_idx >= len(preguntas):
-        return {"error": f"Pregunta {pregunta_idx} no existe en la evaluación"}
+    # Caché de correcciones (misma respuesta o casi ya calificada) y pre-corrección local
+    item = {"assessment_id": assessment_id, "pregunta_idx": pregunta_idx,
+            "respuesta_alumno": respuesta_alumno, "pregunta": pregunta}
+    _contar_correccion("respuestas")
+    if _buscar_en_cache(db, [item]) or _precorregir(db, [item]):
+        resultado = item["cache"]["entrada"].resultado if "cache" in item else item["resultado"]
+        nuevo_score = _score_abierta(assessment_id, usuario_id, pregunta_idx, respuesta_alumno,
+                                     resultado, item.get("cache"), item.get("precorreccion"))
+        db.add(nuevo_score)
+        db.commit()
+        db.refresh(nuevo_score)
+        return _respuesta_corregida(nuevo_score, resultado, item.get("cache"), item.get("precorreccion"))
     
-    pregunta = preguntas[pregunta_idx]
     enunciado = pregunta["enunciado"]
     respuesta_correcta = pregunta["respuesta_correcta"]
     justificacion = pregunta.get("justificacion", "")
@@ -216,13 +617,7 @@ def corregir_respuesta_abierta(
     JUSTIFICACIÓN BIBLIOGRÁFICA: {justificacion}
     
     RESPUESTA DEL ALUMNO: {respuesta_alumno}
-    
-    INSTRUCCIONES DE CALIFICACIÓN:
-    1. Evalúa si la respuesta del alumno aborda los conceptos clave requeridos.
-    2. Acepta parafraseo, sinónimos y diferentes formas de expresar la misma idea.
-    3. NO penalices por diferencias puramente sintácticas o de vocabulario.
-    4. SÍ penaliza errores conceptuales o información incorrecta.
-    
+    {CRITERIOS_CORRECCION}
     FORMATO JSON:
     {{
         "score": <número de 0 a 100>,
@@ -237,50 +632,560 @@ def corregir_respuesta_abierta(
         return {"error": "No hay cliente Mistral configurado"}
     
     try:
-        response = client.chat.complete(
-            model="mistral-large-latest",
-            messages=[
+        resultado = _completar_json(
+            [
                 {"role": "system", "content": prompt_juez},
                 {"role": "user", "content": "Califica la respuesta del alumno."}
             ],
-            response_format={"type": "json_object"},
-            temperature=0.1  # Baja temperatura para corrección determinista
+            0.1  # Baja temperatura para corrección determinista
         )
-        
-        resultado = json.loads(response.choices[0].message.content)
+        _contar_correccion("juez")
+        _contar_correccion("llamadas_juez")
         
         # Guardar calificación en TestScore
-        score_valor = resultado.get("score", 0)
-        feedback = resultado.get("feedback", "")
-        
-        nuevo_score = TestScore(
-            assessment_id=assessment_id,
-            usuario_id=usuario_id,
-            score=score_valor,
-            respuestas_alumno={
-                "pregunta_idx": pregunta_idx,
-                "respuesta": respuesta_alumno
-            },
-            ai_feedback_log=json.dumps(resultado, ensure_ascii=False),
-        )
+        nuevo_score = _score_abierta(assessment_id, usuario_id, pregunta_idx, respuesta_alumno, resultado)
         db.add(nuevo_score)
+        _guardar_en_cache(db, [{**item, "resultado": resultado}])
         db.commit()
         db.refresh(nuevo_score)
         
-        return {
-            "score_id": nuevo_score.id,
-            "score": score_valor,
-            "nivel": resultado.get("nivel", ""),
-            "feedback": feedback,
-            "conceptos_correctos": resultado.get("conceptos_correctos", []),
-            "conceptos_faltantes": resultado.get("conceptos_faltantes", []),
-        }
+        return _respuesta_corregida(nuevo_score, resultado)
         
     except Exception as e:
         print(f"Error en corrección semántica: {e}")
         return {"error": str(e)}
 
 
+# ============================================================================
+# 2b. CORRECCIÓN EN LOTE (varias respuestas por prompt, prompts concurrentes)
+# ============================================================================
+
+CORRECCION_RESPUESTAS_POR_PROMPT = int(os.getenv("CORRECCION_RESPUESTAS_POR_PROMPT", "6"))
+CORRECCION_MAX_CARACTERES_PROMPT = int(os.getenv("CORRECCION_MAX_CARACTERES_PROMPT", "12000"))
+CORRECCION_CONCURRENCIA = int(os.getenv("CORRECCION_CONCURRENCIA", "4"))  # Prompts en vuelo (el RPM manda)
+
+
+def _agrupar_para_juez(pendientes: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+    """
+    Reparte las respuestas en prompts de hasta CORRECCION_RESPUESTAS_POR_PROMPT respuestas
+    (y CORRECCION_MAX_CARACTERES_PROMPT caracteres). Van ordenadas por pregunta, así las
+    respuestas a la misma pregunta comparten prompt y su enunciado se escribe una vez.
+    """
+    grupos, actual, caracteres = [], [], 0
+    for item in sorted(pendientes, key=lambda i: (i["assessment_id"], i["pregunta_idx"])):
+        tamano = len(item["respuesta_alumno"]) + len(str(item["pregunta"].get("respuesta_correcta", ""))) + 300
+        if actual and (len(actual) >= CORRECCION_RESPUESTAS_POR_PROMPT or caracteres + tamano > CORRECCION_MAX_CARACTERES_PROMPT):
+            grupos.append(actual)
+            actual, caracteres = [], 0
+        actual.append(item)
+        caracteres += tamano
+    if actual:
+        grupos.append(actual)
+    return grupos
+
+
+def _juzgar_grupo(grupo: List[Dict[str, Any]]) -> Dict[int, Dict[str, Any]]:
+    """
+    Una llamada al juez para todas las respuestas del grupo. Devuelve {posición: calificación}
+    solo con las que el modelo calificó (las que falten se reintentan aparte).
+    """
+    preguntas: Dict[tuple, str] = {}
+    bloques_preguntas, bloques_respuestas = [], []
+    for item in grupo:
+        clave = (item["assessment_id"], item["pregunta_idx"])
+        if clave not in preguntas:
+            preguntas[clave] = f"P{len(preguntas) + 1}"
+            p = item["pregunta"]
+            bloques_preguntas.append(
+                f"    [{preguntas[clave]}] PREGUNTA: {p['enunciado']}\n"
+                f"    RESPUESTA CORRECTA (Golden Answer): {p['respuesta_correcta']}\n"
+                f"    JUSTIFICACIÓN BIBLIOGRÁFICA: {p.get('justificacion', '')}"
+            )
+        bloques_respuestas.append(
+            f"    [R{item['posicion']}] (pregunta {preguntas[clave]}) RESPUESTA DEL ALUMNO: {item['respuesta_alumno']}"
+        )
+
+    prompt_juez = f"""
+    ERES UN EVALUADOR ACADÉMICO EXPERTO. Tu tarea es calificar las respuestas de varios alumnos.
+    Califica CADA respuesta por separado, solo contra su pregunta: las respuestas no se influyen entre sí.
+    
+    PREGUNTAS:
+{chr(10).join(bloques_preguntas)}
+    
+    RESPUESTAS A CALIFICAR:
+{chr(10).join(bloques_respuestas)}
+    {CRITERIOS_CORRECCION}
+    FORMATO JSON (una entrada por respuesta, con su id "R<n>"):
+    {{
+        "calificaciones": [
+            {{
+                "id": "R<n>",
+                "score": <número de 0 a 100>,
+                "nivel": "<insuficiente|basico|competente|excelente>",
+                "feedback": "<retroalimentación constructiva para el alumno>",
+                "conceptos_correctos": ["<lista de conceptos bien abordados>"],
+                "conceptos_faltantes": ["<lista de conceptos que debió mencionar>"]
+            }}
+        ]
+    }}
+    """
+    resultado = _completar_json(
+        [
+            {"role": "system", "content": prompt_juez},
+            {"role": "user", "content": f"Califica las {len(grupo)} respuestas."}
+        ],
+        0.1
+    )
+    if len(grupo) == 1 and "calificaciones" not in resultado and isinstance(resultado.get("score"), (int, float)):
+        return {grupo[0]["posicion"]: resultado}  # Con una sola respuesta el modelo a veces responde sin lista
+    esperadas = {item["posicion"] for item in grupo}
+    calificaciones = {}
+    for c in resultado.get("calificaciones", []):
+        try:
+            posicion = int(str(c.pop("id", "")).lstrip("Rr"))
+        except ValueError:
+            continue
+        if posicion in esperadas and isinstance(c.get("score"), (int, float)):
+            calificaciones[posicion] = c
+    return calificaciones
+
+
+def _juzgar_concurrente(grupos: List[List[Dict[str, Any]]]) -> Dict[int, Any]:
+    """Lanza los grupos a la vez (rate_limit_service reparte el presupuesto). {posición: calificación o Exception}."""
+    resultados: Dict[int, Any] = {}
+    if not grupos:
+        return resultados
+    with ThreadPoolExecutor(max_workers=max(1, min(CORRECCION_CONCURRENCIA, len(grupos)))) as pool:
+        futuros = {pool.submit(_juzgar_grupo, grupo): grupo for grupo in grupos}
+        for futuro in as_completed(futuros):
+            try:
+                resultados.update(futuro.result())
+            except Exception as e:
+                print(f"⚠️ Corrección en lote: fallo en un prompt de {len(futuros[futuro])} respuestas ({e})")
+                for item in futuros[futuro]:
+                    resultados[item["posicion"]] = e
+    return resultados
+
+
+def corregir_respuestas_abiertas_lote(db: Session, respuestas: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Corrige de una vez todas las respuestas abiertas de una entrega (o de una clase).
+    
+    Pipeline:
+    1. Carga los assessments implicados en una consulta y valida cada respuesta
+    2. Empaqueta varias respuestas por prompt del juez (salida JSON con un id por respuesta)
+    3. Lanza los prompts en paralelo dentro del límite de Mistral (rate_limit_service)
+    4. Las respuestas que el juez omitió o cuyo prompt falló se reintentan una a una
+    5. Guarda todos los TestScore en una única transacción
+    (antes del paso 2, la caché y la pre-corrección local resuelven las que no necesitan juez)
+    
+    Args:
+        db: Sesión de base de datos
+        respuestas: [{assessment_id, pregunta_idx, respuesta_alumno, usuario_id}, ...]
+    
+    Returns:
+        {"resultados": [...] en el orden de entrada, "corregidas", "errores", "llamadas_llm"}
+    """
+    ids = {r["assessment_id"] for r in respuestas}
+    assessments = {a.id: a for a in db.query(Assessment).filter(Assessment.id.in_(ids)).all()} if ids else {}
+
+    resultados: List[Dict[str, Any]] = [None] * len(respuestas)
+    pendientes = []
+    for posicion, r in enumerate(respuestas):
+        pregunta = _pregunta_abierta(assessments.get(r["assessment_id"]), r["pregunta_idx"])
+        if "error" in pregunta:
+            resultados[posicion] = {"error": pregunta["error"]}
+        else:
+            pendientes.append({**r, "posicion": posicion, "pregunta": pregunta})
+
+    # Caché y pre-corrección: esas no van al juez; las repetidas dentro del lote, una sola vez
+    _contar_correccion("respuestas", len(pendientes))
+    _buscar_en_cache(db, pendientes)
+    _precorregir(db, [item for item in pendientes if "cache" not in item])
+    representantes: Dict[tuple, Dict[str, Any]] = {}
+    copias = []
+    for item in pendientes:
+        if "cache" in item or "precorreccion" in item:
+            continue
+        # Sin hash (caché desactivada) no hay con qué agrupar: cada respuesta es su propio representante
+        clave = (item["assessment_id"], item["pregunta_idx"], item["hash"]) if item.get("hash") else ("posicion", item["posicion"])
+        if clave in representantes:
+            copias.append((item, representantes[clave]))
+        else:
+            representantes[clave] = item
+    al_juez = list(representantes.values())
+
+    if client:
+        grupos = _agrupar_para_juez(al_juez)
+        calificaciones = _juzgar_concurrente(grupos)
+    else:
+        grupos = []
+        calificaciones = {item["posicion"]: "No hay cliente Mistral configurado" for item in al_juez}
+    llamadas = len(grupos)
+
+    # Reintento individual de lo que el juez no devolvió (o cuyo prompt falló)
+    sueltas = [item for item in al_juez if not isinstance(calificaciones.get(item["posicion"]), dict)]
+    if sueltas and client:
+        print(f"   [Corrección] Reintentando {len(sueltas)} respuestas una a una")
+        calificaciones.update(_juzgar_concurrente([[item] for item in sueltas]))
+        llamadas += len(sueltas)
+
+    for item in al_juez:
+        if isinstance(calificaciones.get(item["posicion"]), dict):
+            item["resultado"] = calificaciones[item["posicion"]]
+    _contar_correccion("juez", sum(1 for item in al_juez if "resultado" in item))
+    _contar_correccion("llamadas_juez", llamadas)
+    for item, original in copias:
+        if "resultado" in original:
+            item["resultado"] = original["resultado"]
+            item["cache"] = {"nivel": "exacta", "similitud": 1.0, "entrada": None}
+        else:
+            calificaciones[item["posicion"]] = calificaciones.get(original["posicion"])
+    _contar_correccion("cache_exacta", sum(1 for item, _ in copias if "cache" in item))
+
+    scores = []
+    for item in pendientes:
+        cache = item.get("cache")
+        calificacion = cache["entrada"].resultado if cache and cache["entrada"] else item.get("resultado")
+        if calificacion is None:
+            error = calificaciones.get(item["posicion"])
+            resultados[item["posicion"]] = {"error": str(error or "Sin calificación del juez")}
+            continue
+        score = _score_abierta(item["assessment_id"], item["usuario_id"], item["pregunta_idx"],
+                               item["respuesta_alumno"], calificacion, cache, item.get("precorreccion"))
+        scores.append((item["posicion"], score, calificacion, cache, item.get("precorreccion")))
+
+    try:
+        db.add_all([score for _, score, _, _, _ in scores])
+        _guardar_en_cache(db, [item for item in al_juez if "resultado" in item])
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        print(f"Error guardando la corrección en lote: {e}")
+        return {"error": str(e)}
+
+    for posicion, score, calificacion, cache, precorreccion in scores:
+        resultados[posicion] = _respuesta_corregida(score, calificacion, cache, precorreccion)
+
+    errores = sum(1 for r in resultados if "error" in r)
+    desde_cache = sum(1 for _, _, _, cache, _ in scores if cache)
+    precorregidas = sum(1 for _, _, _, _, precorreccion in scores if precorreccion)
+    print(f"✅ Corrección en lote: {len(scores)} respuestas en {llamadas} llamadas al juez "
+          f"({desde_cache} desde caché, {precorregidas} pre-corregidas, {errores} errores)")
+    return {
+        "resultados": resultados,
+        "corregidas": len(scores),
+        "errores": errores,
+        "llamadas_llm": llamadas,
+        "desde_cache": desde_cache,
+        "precorregidas": precorregidas,
+    }
+
+
+# ============================================================================
+# 2c. CACHÉ DE CORRECCIONES (exacta + semántica)
+# ============================================================================
+
+CORRECCION_CACHE = os.getenv("CORRECCION_CACHE", "1") == "1"
+CORRECCION_CACHE_SIMILITUD = float(os.getenv("CORRECCION_CACHE_SIMILITUD", "0.97"))   # Coseno mínimo (estricto)
+CORRECCION_CACHE_MIN_CARACTERES = int(os.getenv("CORRECCION_CACHE_MIN_CARACTERES", "25"))  # Más cortas: solo exacta
+
+_RE_ESPACIOS = re.compile(r"\s+")
+
+
+def _normalizar_respuesta(texto: str) -> str:
+    """Minúsculas, sin tildes, espacios colapsados y sin puntuación en los extremos."""
+    texto = unicodedata.normalize("NFKD", (texto or "").lower())
+    texto = "".join(c for c in texto if not unicodedata.combining(c))
+    return _RE_ESPACIOS.sub(" ", texto).strip(" .,;:!¡?¿\"'")
+
+
+def _buscar_en_cache(db: Session, items: List[Dict[str, Any]]) -> int:
+    """
+    Busca un veredicto previo para cada respuesta (dicts con assessment_id, pregunta_idx,
+    respuesta_alumno). Nivel 1: misma respuesta normalizada (hash). Nivel 2: respuesta a la
+    misma pregunta con similitud coseno >= CORRECCION_CACHE_SIMILITUD (solo si la respuesta
+    tiene al menos CORRECCION_CACHE_MIN_CARACTERES: en las cortas una palabra cambia el sentido).
+    
+    Rellena en cada item "normalizada", "hash", "embedding" y, si acierta,
+    "cache" = {"nivel": "exacta"|"semantica", "similitud", "entrada"}. Devuelve los aciertos.
+    """
+    if not CORRECCION_CACHE or not items:
+        return 0
+    for item in items:
+        item["normalizada"] = _normalizar_respuesta(item["respuesta_alumno"])
+        item["hash"] = hashlib.sha256(item["normalizada"].encode("utf-8")).hexdigest()
+        item["embedding"] = None
+
+    filas = db.query(CacheCorreccion).filter(
+        CacheCorreccion.respuesta_hash.in_({item["hash"] for item in items})
+    ).all()
+    exactas = {(f.assessment_id, f.pregunta_idx, f.respuesta_hash): f for f in filas}
+    for item in items:
+        entrada = exactas.get((item["assessment_id"], item["pregunta_idx"], item["hash"]))
+        if entrada:
+            item["cache"] = {"nivel": "exacta", "similitud": 1.0, "entrada": entrada}
+
+    semanticas = [i for i in items if "cache" not in i and len(i["normalizada"]) >= CORRECCION_CACHE_MIN_CARACTERES]
+    if semanticas:
+        try:
+            vectores = generar_embeddings_batch(db, [i["normalizada"] for i in semanticas])
+        except Exception as e:
+            print(f"⚠️ Caché de correcciones: sin embeddings ({e}), solo coincidencia exacta")
+            vectores = [None] * len(semanticas)
+        for item, vector in zip(semanticas, vectores):
+            item["embedding"] = vector
+            if vector is None:
+                continue
+            distancia = CacheCorreccion.embedding.cosine_distance(vector)
+            fila = db.query(CacheCorreccion, distancia).filter(
+                CacheCorreccion.assessment_id == item["assessment_id"],
+                CacheCorreccion.pregunta_idx == item["pregunta_idx"],
+                CacheCorreccion.embedding.is_not(None),
+            ).order_by(distancia).first()
+            if fila and 1 - fila[1] >= CORRECCION_CACHE_SIMILITUD:
+                item["cache"] = {"nivel": "semantica", "similitud": round(1 - fila[1], 4), "entrada": fila[0]}
+
+    # Uso de cada entrada (UPDATE atómico: varias peticiones pueden acertar la misma a la vez)
+    for item in items:
+        if "cache" in item:
+            _contar_correccion(f"cache_{item['cache']['nivel']}")
+    usos = Counter(item["cache"]["entrada"].id for item in items if "cache" in item)
+    for veces in set(usos.values()):
+        db.query(CacheCorreccion).filter(
+            CacheCorreccion.id.in_([i for i, n in usos.items() if n == veces])
+        ).update({CacheCorreccion.hits: CacheCorreccion.hits + veces, CacheCorreccion.ultimo_uso: func.now()},
+                 synchronize_session=False)
+    return sum(usos.values())
+
+
+def _guardar_en_cache(db: Session, items: List[Dict[str, Any]]) -> None:
+    """Guarda los veredictos nuevos del juez (sin commit: van en la transacción de los TestScore)."""
+    filas = [
+        {
+            "assessment_id": item["assessment_id"],
+            "pregunta_idx": item["pregunta_idx"],
+            "respuesta_hash": item["hash"],
+            "respuesta_normalizada": item["normalizada"],
+            "embedding": item.get("embedding"),
+            "resultado": item["resultado"],
+        }
+        for item in items if CORRECCION_CACHE and item.get("hash")
+    ]
+    if filas:
+        db.execute(
+            pg_insert(CacheCorreccion).on_conflict_do_nothing(
+                index_elements=["assessment_id", "pregunta_idx", "respuesta_hash"]
+            ),
+            filas,
+        )
+
+
+def informe_cache_correcciones(db: Session, assessment_id: int) -> Dict[str, Any]:
+    """
+    Respuestas abiertas corregidas de un assessment, cuántas salieron de la caché y cuántas
+    de la pre-corrección local (por pregunta): todas ellas son llamadas al juez evitadas.
+    """
+    filas = db.execute(text("""
+        SELECT (respuestas_alumno->>'pregunta_idx')::int AS pregunta_idx,
+               respuestas_alumno->>'cache' AS nivel,
+               respuestas_alumno->>'precorreccion' AS motivo,
+               count(*) AS n
+        FROM test_scores
+        WHERE assessment_id = :a AND respuestas_alumno->>'pregunta_idx' IS NOT NULL
+        GROUP BY 1, 2, 3
+    """), {"a": assessment_id}).all()
+    entradas = db.execute(
+        select(CacheCorreccion.pregunta_idx, func.count(CacheCorreccion.id))
+        .where(CacheCorreccion.assessment_id == assessment_id)
+        .group_by(CacheCorreccion.pregunta_idx)
+    ).all()
+
+    vacio = lambda: {"corregidas": 0, "exacta": 0, "semantica": 0, "precorregidas": 0, "entradas": 0}
+    por_pregunta: Dict[int, Dict[str, int]] = {}
+    motivos: Dict[str, int] = {}
+    for idx, nivel, motivo, n in filas:
+        datos = por_pregunta.setdefault(idx, vacio())
+        datos["corregidas"] += n
+        if nivel in ("exacta", "semantica"):
+            datos[nivel] += n
+        if motivo:
+            datos["precorregidas"] += n
+            motivos[motivo] = motivos.get(motivo, 0) + n
+    for idx, n in entradas:
+        por_pregunta.setdefault(idx, vacio())["entradas"] = n
+
+    corregidas = sum(d["corregidas"] for d in por_pregunta.values())
+    exactas = sum(d["exacta"] for d in por_pregunta.values())
+    semanticas = sum(d["semantica"] for d in por_pregunta.values())
+    precorregidas = sum(motivos.values())
+    evitadas = exactas + semanticas + precorregidas
+    return {
+        "assessment_id": assessment_id,
+        "corregidas": corregidas,
+        "aciertos_exactos": exactas,
+        "aciertos_semanticos": semanticas,
+        "tasa_aciertos": round((exactas + semanticas) / corregidas, 3) if corregidas else 0.0,
+        "precorregidas": motivos,
+        "llamadas_llm_evitadas": evitadas,
+        "tasa_llm_evitadas": round(evitadas / corregidas, 3) if corregidas else 0.0,
+        "por_pregunta": dict(sorted(por_pregunta.items())),
+    }
+
+
+# ============================================================================
+# 2d. PRE-CORRECCIÓN LOCAL (embeddings + reglas léxicas, sin LLM)
+# ============================================================================
+
+PRECORRECCION = os.getenv("PRECORRECCION", "1") == "1"
+PRECORRECCION_SIMILITUD_ALTA = float(os.getenv("PRECORRECCION_SIMILITUD_ALTA", "0.95"))      # vs respuesta_correcta
+PRECORRECCION_COBERTURA_ALTA = float(os.getenv("PRECORRECCION_COBERTURA_ALTA", "0.8"))       # Términos de la esperada presentes
+PRECORRECCION_SIMILITUD_BAJA = float(os.getenv("PRECORRECCION_SIMILITUD_BAJA", "0.2"))       # vs esperada y justificación
+PRECORRECCION_SOLAPAMIENTO_BAJO = float(os.getenv("PRECORRECCION_SOLAPAMIENTO_BAJO", "0.05"))  # Términos del tema en la respuesta
+PRECORRECCION_MIN_TERMINOS = int(os.getenv("PRECORRECCION_MIN_TERMINOS", "3"))  # Menos: nunca "fuera de tema" (sí/no...)
+
+RESPUESTAS_EN_BLANCO = {"", "no se", "nose", "no lo se", "ni idea", "no tengo idea", "no me acuerdo", "no lo recuerdo", "paso"}
+_PALABRAS_VACIAS = {
+    "el", "la", "los", "las", "un", "una", "unos", "unas", "de", "del", "al", "en", "con", "por", "para",
+    "que", "como", "es", "son", "se", "su", "sus", "lo", "le", "les", "y", "o", "u", "a", "e",
+    "pero", "mas", "muy", "ya", "si", "cuando", "donde", "esta", "este", "esto", "estos", "estas",
+    "ese", "esa", "eso", "hay", "ser", "sea", "tiene", "puede", "entre", "sobre", "tambien",
+}
+# Cambian la polaridad: nunca son vacías y deben coincidir con las de la esperada para dar el 100
+_NEGACIONES = {"no", "ni", "sin", "nunca", "jamas", "tampoco", "nada", "nadie", "ningun", "ninguno", "ninguna"}
+_RE_TERMINOS = re.compile(r"\w+")
+
+_metricas_correccion = defaultdict(int)
+_metricas_lock = threading.Lock()
+
+
+def _contar_correccion(evento: str, n: int = 1) -> None:
+    if n:
+        with _metricas_lock:
+            _metricas_correccion[evento] += n
+
+
+def obtener_metricas_correccion() -> Dict[str, Any]:
+    """Respuestas abiertas de este proceso por origen del veredicto y tasa de llamadas al juez evitadas."""
+    with _metricas_lock:
+        m = dict(_metricas_correccion)
+    respuestas = m.get("respuestas", 0)
+    juez = m.get("juez", 0)
+    precorregidas = {k[len("precorreccion_"):]: v for k, v in m.items() if k.startswith("precorreccion_")}
+    evitadas = m.get("cache_exacta", 0) + m.get("cache_semantica", 0) + sum(precorregidas.values())
+    return {
+        "respuestas": respuestas,
+        "juez": {"respuestas": juez, "llamadas": m.get("llamadas_juez", 0)},
+        "cache": {"exacta": m.get("cache_exacta", 0), "semantica": m.get("cache_semantica", 0)},
+        "precorreccion": precorregidas,
+        "llamadas_llm_evitadas": evitadas,
+        "tasa_llm_evitadas": round(evitadas / respuestas, 4) if respuestas else 0.0,
+    }
+
+
+def _terminos(texto: str) -> set:
+    return {t for t in _RE_TERMINOS.findall(texto) if len(t) > 1 and t not in _PALABRAS_VACIAS}
+
+
+def _resultado_precorreccion(motivo: str, score: int, respuesta_correcta: str) -> Dict[str, Any]:
+    """Veredicto determinista con el mismo formato que el del juez."""
+    if motivo == "coincide_con_esperada":
+        return {"score": score, "nivel": "excelente", "feedback": "¡Correcto! Tu respuesta coincide con la esperada.",
+                "conceptos_correctos": [respuesta_correcta], "conceptos_faltantes": []}
+    feedback = {
+        "sin_respuesta": "No has respondido a la pregunta.",
+        "fuera_de_tema": "Tu respuesta no trata sobre lo que pide la pregunta.",
+    }[motivo]
+    return {"score": score, "nivel": "insuficiente", "feedback": f"{feedback} La respuesta esperada era: {respuesta_correcta}",
+            "conceptos_correctos": [], "conceptos_faltantes": [respuesta_correcta]}
+
+
+def _precorregir(db: Session, items: List[Dict[str, Any]]) -> int:
+    """
+    Califica sin LLM las respuestas evidentes (items con "pregunta" y "respuesta_alumno"):
+    
+    - sin_respuesta (0): vacía, solo signos o "no sé"
+    - coincide_con_esperada (100): igual a respuesta_correcta normalizada, o similitud coseno
+      >= PRECORRECCION_SIMILITUD_ALTA con ella cubriendo >= PRECORRECCION_COBERTURA_ALTA de
+      sus términos y con las mismas negaciones (_NEGACIONES) que ella: ni la similitud ni la
+      cobertura distinguen "es mutable" de "no es mutable"
+    - fuera_de_tema (0): similitud < PRECORRECCION_SIMILITUD_BAJA con la esperada y con la
+      justificación, y casi ningún término de ellas (<= PRECORRECCION_SOLAPAMIENTO_BAJO). Solo
+      con PRECORRECCION_MIN_TERMINOS términos o más: en respuestas de una palabra no es fiable
+    
+    El resto (lo ambiguo) queda para el juez. Rellena item["precorreccion"] e item["resultado"]
+    en las resueltas y devuelve cuántas son. Sin embeddings solo aplica las reglas léxicas.
+    """
+    if not PRECORRECCION or not items:
+        return 0
+
+    dudosas = []
+    for item in items:
+        pregunta = item["pregunta"]
+        esperada = pregunta.get("respuesta_correcta")
+        if not isinstance(esperada, str):
+            continue
+        item.setdefault("normalizada", _normalizar_respuesta(item["respuesta_alumno"]))
+        if item["normalizada"] in RESPUESTAS_EN_BLANCO or not _RE_TERMINOS.search(item["normalizada"]):
+            item["precorreccion"] = {"motivo": "sin_respuesta"}
+            item["resultado"] = _resultado_precorreccion("sin_respuesta", 0, esperada)
+        elif item["normalizada"] == _normalizar_respuesta(esperada):
+            item["precorreccion"] = {"motivo": "coincide_con_esperada", "similitud": 1.0, "cobertura": 1.0}
+            item["resultado"] = _resultado_precorreccion("coincide_con_esperada", 100, esperada)
+        else:
+            dudosas.append(item)
+
+    if dudosas:
+        # Un solo lote de embeddings: respuestas sin vector (la caché ya calculó algunos) + referencias
+        referencias = set()
+        for item in dudosas:
+            referencias.add(_normalizar_respuesta(item["pregunta"]["respuesta_correcta"]))
+            referencias.add(_normalizar_respuesta(item["pregunta"].get("justificacion") or ""))
+        referencias.discard("")
+        sin_vector = [item for item in dudosas if item.get("embedding") is None]
+        textos = list(referencias) + [item["normalizada"] for item in sin_vector]
+        try:
+            vectores = generar_embeddings_batch(db, textos)
+        except Exception as e:
+            print(f"⚠️ Pre-corrección: sin embeddings ({e}), solo reglas léxicas")
+            vectores = None
+
+        if vectores is not None:
+            por_texto = dict(zip(textos[:len(referencias)], _matriz_normalizada(vectores[:len(referencias)])))
+            for item, vector in zip(sin_vector, vectores[len(referencias):]):
+                item["embedding"] = vector
+            for item in dudosas:
+                esperada = _normalizar_respuesta(item["pregunta"]["respuesta_correcta"])
+                justificacion = _normalizar_respuesta(item["pregunta"].get("justificacion") or "")
+                respuesta = _matriz_normalizada([item["embedding"]])[0]
+                sim_esperada = float(por_texto[esperada] @ respuesta) if esperada in por_texto else 0.0
+                sim_justificacion = float(por_texto[justificacion] @ respuesta) if justificacion in por_texto else 0.0
+
+                terminos = _terminos(item["normalizada"])
+                terminos_esperada = _terminos(esperada)
+                cobertura = len(terminos & terminos_esperada) / len(terminos_esperada) if terminos_esperada else 0.0
+                solapamiento = len(terminos & (terminos_esperada | _terminos(justificacion))) / len(terminos) if terminos else 0.0
+                metricas = {"similitud": round(sim_esperada, 4), "similitud_justificacion": round(sim_justificacion, 4),
+                            "cobertura": round(cobertura, 3), "solapamiento": round(solapamiento, 3)}
+
+                misma_polaridad = (terminos & _NEGACIONES) == (terminos_esperada & _NEGACIONES)
+
+                if (sim_esperada >= PRECORRECCION_SIMILITUD_ALTA and cobertura >= PRECORRECCION_COBERTURA_ALTA
+                        and misma_polaridad):
+                    item["precorreccion"] = {"motivo": "coincide_con_esperada", **metricas}
+                    item["resultado"] = _resultado_precorreccion("coincide_con_esperada", 100, item["pregunta"]["respuesta_correcta"])
+                elif (max(sim_esperada, sim_justificacion) < PRECORRECCION_SIMILITUD_BAJA
+                      and solapamiento <= PRECORRECCION_SOLAPAMIENTO_BAJO
+                      and len(terminos) >= PRECORRECCION_MIN_TERMINOS):
+                    item["precorreccion"] = {"motivo": "fuera_de_tema", **metricas}
+                    item["resultado"] = _resultado_precorreccion("fuera_de_tema", 0, item["pregunta"]["respuesta_correcta"])
+
+    resueltas = [item for item in items if "precorreccion" in item]
+    for item in resueltas:
+        _contar_correccion(f"precorreccion_{item['precorreccion']['motivo']}")
+    return len(resueltas)
+
+
 # ============================================================================
 # 3. CORRECCIÓN DE OPCIÓN MÚLTIPLE (Determinista)
 # ============================================================================
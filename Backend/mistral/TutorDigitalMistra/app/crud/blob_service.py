@@ -0,0 +1,186 @@
+"""
+Almacén de PDFs direccionado por contenido (SHA-256).
+
+La subida se vuelca por bloques (UploadFile ya es un SpooledTemporaryFile: en memoria
+hasta 1 MB, luego en disco) a un temporal dentro del almacén mientras se calcula el
+hash, y se renombra de forma atómica a PDF_BLOB_DIR/ab/abcdef....pdf. El mismo PDF
+se guarda una sola vez aunque se suba muchas veces.
+
+Con el hash se evita re-ingestar un libro ya procesado:
+- Misma licencia: se enlaza el libro existente (no hay ingesta).
+- Otra licencia: se clona el libro (temario + chunks con sus embeddings) con SQL,
+  sin volver a extraer, trocear ni pedir embeddings.
+"""
+import os
+import hashlib
+import tempfile
+from datetime import datetime
+from typing import Optional, Tuple
+
+from fastapi import UploadFile
+from sqlalchemy import text, exists, func
+from sqlalchemy.orm import Session
+
+from app.models.modelos import Libro, Temario, BaseConocimiento
+
+# ============================================================================
+# Configuración
+# ============================================================================
+
+PDF_BLOB_DIR = os.getenv("PDF_BLOB_DIR", os.path.join("uploads", "blobs"))
+BLOB_BLOQUE = 1024 * 1024  # Bytes por lectura de la subida
+
+# ============================================================================
+# Almacén
+# ============================================================================
+
+def ruta_blob(sha256: str) -> str:
+    return os.path.join(PDF_BLOB_DIR, sha256[:2], f"{sha256}.pdf")
+
+
+async def guardar_upload(archivo: UploadFile) -> Tuple[str, str, int]:
+    """
+    Guarda la subida en el almacén calculando su SHA-256 al vuelo.
+    Devuelve (ruta, sha256, bytes). Si el contenido ya estaba, se descarta la copia nueva.
+    """
+    dir_tmp = os.path.join(PDF_BLOB_DIR, "tmp")
+    os.makedirs(dir_tmp, exist_ok=True)
+    h = hashlib.sha256()
+    total = 0
+    fd, ruta_tmp = tempfile.mkstemp(dir=dir_tmp, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as destino:
+            while bloque := await archivo.read(BLOB_BLOQUE):
+                h.update(bloque)
+                destino.write(bloque)
+                total += len(bloque)
+        sha256 = h.hexdigest()
+        ruta = ruta_blob(sha256)
+        if os.path.exists(ruta):
+            os.remove(ruta_tmp)
+            print(f"📦 PDF ya almacenado: {sha256[:12]}… ({total / 1e6:.1f} MB)")
+        else:
+            os.makedirs(os.path.dirname(ruta), exist_ok=True)
+            os.replace(ruta_tmp, ruta)  # Mismo sistema de ficheros: renombrado atómico
+            print(f"📦 PDF almacenado: {sha256[:12]}… ({total / 1e6:.1f} MB)")
+        return ruta, sha256, total
+    except BaseException:
+        if os.path.exists(ruta_tmp):
+            os.remove(ruta_tmp)
+        raise
+
+# ============================================================================
+# Deduplicación de libros
+# ============================================================================
+
+def _libros_completos(db: Session, sha256: str):
+    """Libros con ese PDF ya ingeridos por completo (el temario se activa al terminar la ingesta)."""
+    return db.query(Libro).filter(
+        Libro.pdf_sha256 == sha256,
+        exists().where(Temario.libro_id == Libro.id, Temario.activo == True),
+    )
+
+
+def buscar_libro(db: Session, sha256: str, licencia_id: Optional[int]) -> Optional[Libro]:
+    """Libro completo con ese PDF en la misma licencia (None = sin licencia)."""
+    consulta = _libros_completos(db, sha256)
+    if licencia_id is None:
+        consulta = consulta.filter(Libro.licencia_id.is_(None))
+    else:
+        consulta = consulta.filter(Libro.licencia_id == licencia_id)
+    return consulta.order_by(Libro.id).first()
+
+
+def buscar_libro_origen(db: Session, sha256: str) -> Optional[Libro]:
+    """Cualquier libro completo con ese PDF (de otra licencia): origen para clonar."""
+    return _libros_completos(db, sha256).order_by(Libro.id).first()
+
+
+def clonar_libro(db: Session, origen: Libro, licencia_id: Optional[int], titulo: Optional[str] = None) -> Tuple[Libro, int]:
+    """
+    Copia un libro ya ingerido a otra licencia: Libro, Temario activo (con su jerarquía) y su
+    base_conocimiento con embeddings y lista enlazada re-mapeados. Los chunks se copian
+    con un único INSERT ... SELECT (ids nuevos con nextval, enlaces con el mapa viejo → nuevo).
+    Devuelve (libro, chunks copiados). Hace commit.
+    """
+    nuevo = Libro(
+        titulo=titulo if titulo and titulo.strip() else origen.titulo,
+        autor=origen.autor,
+        descripcion=f"Copiado del libro {origen.id} el {datetime.now().strftime('%Y-%m-%d %H:%M')}",
+        pdf_path=origen.pdf_path,
+        pdf_sha256=origen.pdf_sha256,
+        activo=True,
+        licencia_id=licencia_id,
+    )
+    db.add(nuevo)
+    db.flush()
+
+    # Temario en dos pasadas: una nueva edición puede colgar temas viejos de un padre con id
+    # mayor, así que el orden por id no garantiza ver antes al padre. Solo los activos: los
+    # desactivados y el de contenido retirado de ediciones anteriores no se copian (ni sus chunks)
+    temas = (
+        db.query(Temario)
+        .filter(Temario.libro_id == origen.id, Temario.activo == True)
+        .order_by(Temario.id)
+        .all()
+    )
+    copias = [
+        Temario(
+            libro_id=nuevo.id,
+            nombre=tema.nombre,
+            descripcion=tema.descripcion,
+            nivel=tema.nivel,
+            orden=tema.orden,
+            pagina_inicio=tema.pagina_inicio,
+            activo=tema.activo,
+        )
+        for tema in temas
+    ]
+    db.add_all(copias)
+    db.flush()
+    mapa_temas = {tema.id: copia.id for tema, copia in zip(temas, copias)}
+    for tema, copia in zip(temas, copias):
+        if tema.parent_id is not None:
+            copia.parent_id = mapa_temas.get(tema.parent_id)
+    db.flush()
+
+    chunks = 0
+    if mapa_temas:
+        # busqueda_texto se copia tal cual: sin trigger en esta transacción (no se recalcula el tsvector)
+        db.execute(text("SELECT set_config('tutor.fts_diferido', 'on', true)"))
+        chunks = db.execute(
+            text("""
+                WITH mt AS (
+                    SELECT * FROM unnest(CAST(:viejos AS integer[]), CAST(:nuevos AS integer[])) AS t(viejo, nuevo)
+                ),
+                mc AS MATERIALIZED (
+                    SELECT bc.id AS viejo, nextval(pg_get_serial_sequence('base_conocimiento', 'id')) AS nuevo
+                    FROM base_conocimiento bc JOIN mt ON mt.viejo = bc.temario_id
+                )
+                INSERT INTO base_conocimiento (
+                    id, temario_id, contenido, tipo_contenido, ref_fuente, pagina, orden_aparicion,
+                    chunk_anterior_id, chunk_siguiente_id, embedding, metadatos, busqueda_texto
+                )
+                SELECT mc.nuevo, mt.nuevo, bc.contenido, bc.tipo_contenido, bc.ref_fuente, bc.pagina,
+                       bc.orden_aparicion, ant.nuevo, sig.nuevo, bc.embedding, bc.metadatos, bc.busqueda_texto
+                FROM base_conocimiento bc
+                JOIN mc ON mc.viejo = bc.id
+                JOIN mt ON mt.viejo = bc.temario_id
+                LEFT JOIN mc ant ON ant.viejo = bc.chunk_anterior_id
+                LEFT JOIN mc sig ON sig.viejo = bc.chunk_siguiente_id
+            """),
+            {"viejos": list(mapa_temas.keys()), "nuevos": list(mapa_temas.values())},
+        ).rowcount
+    db.commit()
+    db.refresh(nuevo)
+    print(f"📚 Libro {origen.id} copiado como {nuevo.id} (licencia {licencia_id}): {len(mapa_temas)} temas, {chunks} chunks")
+    return nuevo, chunks
+
+
+def contar_chunks_libro(db: Session, libro_id: int) -> int:
+    return (
+        db.query(func.count(BaseConocimiento.id))
+        .join(Temario, Temario.id == BaseConocimiento.temario_id)
+        .filter(Temario.libro_id == libro_id)
+        .scalar()
+    )
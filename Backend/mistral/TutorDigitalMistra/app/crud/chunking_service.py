@@ -3,8 +3,12 @@ Servicio de Fragmentación Token-Based (Chunking)
 Implementa fragmentación de tamaño fijo con overlap usando tiktoken.
 Parámetros óptimos: 450 tokens por chunk, 70 tokens de overlap (~15%).
 """
+import os
 import re
-from typing import List, Dict, Any, Optional
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Any, Optional, Tuple, Iterator, Iterable
 
 try:
     import tiktoken
@@ -13,6 +17,10 @@ try:
 except ImportError:
     TOKENIZER = None
     print("ADVERTENCIA: tiktoken no instalado. Usando estimación por caracteres.")
+except Exception as e:
+    # Sin red la primera vez tiktoken no puede descargar el vocabulario
+    TOKENIZER = None
+    print(f"ADVERTENCIA: no se pudo cargar cl100k_base ({e}). Usando estimación por caracteres.")
 
 # ============================================================================
 # Constantes de Configuración
@@ -20,6 +28,10 @@ except ImportError:
 
 CHUNK_SIZE = 450       # Tokens por fragmento (rango óptimo: 400-500)
 CHUNK_OVERLAP = 70     # Tokens de solapamiento (~15% del chunk)
+TOKENIZER_HILOS = int(os.getenv("TOKENIZER_HILOS", "4"))  # Hilos de encode_ordinary_batch
+INGEST_PROCESOS = int(os.getenv("INGEST_PROCESOS", str(min(4, os.cpu_count() or 1))))  # 1 = sin pool
+# Por debajo de este tamaño arrancar el pool cuesta más de lo que ahorra
+INGEST_MIN_CARACTERES_POOL = int(os.getenv("INGEST_MIN_CARACTERES_POOL", "1000000"))
 
 # ============================================================================
 # Funciones de Tokenización
@@ -33,6 +45,13 @@ def contar_tokens(texto: str) -> int:
     return len(texto) // 4
 
 
+def contar_tokens_lote(textos: List[str]) -> List[int]:
+    """Cuenta tokens de muchos textos en una sola llamada (encode_ordinary_batch reparte en hilos)."""
+    if TOKENIZER:
+        return [len(t) for t in TOKENIZER.encode_ordinary_batch(textos, num_threads=TOKENIZER_HILOS)]
+    return [len(t) // 4 for t in textos]
+
+
 def _dividir_en_sentencias(texto: str) -> List[str]:
     """Divide el texto en sentencias respetando puntuación."""
     # Patrón: divide en punto seguido de espacio/newline, ?, !, o doble newline
@@ -44,81 +63,84 @@ def _dividir_en_sentencias(texto: str) -> List[str]:
 # Fragmentación Token-Based con Overlap
 # ============================================================================
 
-def fragmentar_texto(
+def fragmentar_texto_con_tokens(
     texto: str, 
     chunk_size: int = CHUNK_SIZE, 
     overlap: int = CHUNK_OVERLAP
-) -> List[str]:
+) -> List[Tuple[str, int]]:
     """
     Fragmenta el texto en chunks de tamaño fijo (en tokens) con overlap.
     
     Algoritmo:
-    1. Divide el texto en sentencias
+    1. Divide el texto en sentencias y las tokeniza TODAS de una vez (cada una una sola vez)
     2. Agrupa sentencias hasta alcanzar chunk_size tokens
     3. Al cerrar un chunk, retrocede overlap tokens para el siguiente
     4. Nunca corta a mitad de sentencia
     
+    Los conteos se arrastran por todo el proceso: el tamaño de un chunk es la suma de sus
+    sentencias (puede diferir en algún token del texto unido, no afecta a los límites).
+    
     Args:
         texto: Texto a fragmentar
         chunk_size: Tamaño máximo por fragmento en tokens (default: 450)
         overlap: Solapamiento entre fragmentos en tokens (default: 70)
     
     Returns:
-        Lista de fragmentos de texto
+        Lista de tuplas (fragmento, tokens)
     """
     if not texto or not texto.strip():
         return []
     
     texto = texto.strip()
-    total_tokens = contar_tokens(texto)
-    
-    # Si el texto cabe en un solo chunk, devolverlo tal cual
-    if total_tokens <= chunk_size:
-        return [texto]
-    
     sentencias = _dividir_en_sentencias(texto)
     
     if not sentencias:
-        return [texto]
+        return [(texto, contar_tokens(texto))]
+    
+    tokens_sentencias = contar_tokens_lote(sentencias)
+    total_tokens = sum(tokens_sentencias)
+    
+    # Si el texto cabe en un solo chunk, devolverlo tal cual
+    if total_tokens <= chunk_size:
+        return [(texto, total_tokens)]
     
     fragmentos = []
-    chunk_actual = []
+    chunk_actual = []  # Índices de sentencias
     tokens_chunk_actual = 0
     idx_sentencia = 0
     
     while idx_sentencia < len(sentencias):
-        sentencia = sentencias[idx_sentencia]
-        tokens_sentencia = contar_tokens(sentencia)
+        tokens_sentencia = tokens_sentencias[idx_sentencia]
         
         # Si una sola sentencia supera el chunk_size, forzar su inclusión
         if tokens_sentencia > chunk_size and not chunk_actual:
-            fragmentos.append(sentencia)
+            fragmentos.append((sentencias[idx_sentencia], tokens_sentencia))
             idx_sentencia += 1
             continue
         
         # Si la sentencia cabe en el chunk actual
         if tokens_chunk_actual + tokens_sentencia <= chunk_size:
-            chunk_actual.append(sentencia)
+            chunk_actual.append(idx_sentencia)
             tokens_chunk_actual += tokens_sentencia
             idx_sentencia += 1
         else:
             # Cerrar chunk actual
             if chunk_actual:
-                fragmentos.append(" ".join(chunk_actual))
+                fragmentos.append((" ".join(sentencias[j] for j in chunk_actual), tokens_chunk_actual))
             
             # Calcular overlap: retroceder sentencias hasta cubrir ~overlap tokens
             tokens_overlap = 0
             inicio_overlap = len(chunk_actual)
             
-            for j in range(len(chunk_actual) - 1, -1, -1):
-                tokens_overlap += contar_tokens(chunk_actual[j])
+            for pos in range(len(chunk_actual) - 1, -1, -1):
+                tokens_overlap += tokens_sentencias[chunk_actual[pos]]
                 if tokens_overlap >= overlap:
-                    inicio_overlap = j
+                    inicio_overlap = pos
                     break
             
             # Iniciar nuevo chunk con las sentencias de overlap
             chunk_actual = chunk_actual[inicio_overlap:]
-            tokens_chunk_actual = sum(contar_tokens(s) for s in chunk_actual)
+            tokens_chunk_actual = sum(tokens_sentencias[j] for j in chunk_actual)
             
             # --- FIX: Evitar loop infinito si el overlap + sentencia actual sigue excediendo el tamaño ---
             if tokens_chunk_actual + tokens_sentencia > chunk_size:
@@ -129,47 +151,55 @@ def fragmentar_texto(
     
     # Agregar el último chunk si tiene contenido
     if chunk_actual:
-        ultimo = " ".join(chunk_actual)
+        ultimo = " ".join(sentencias[j] for j in chunk_actual)
         # Solo agregar si no es un duplicado del último fragmento
-        if not fragmentos or ultimo != fragmentos[-1]:
-            fragmentos.append(ultimo)
+        if not fragmentos or ultimo != fragmentos[-1][0]:
+            fragmentos.append((ultimo, tokens_chunk_actual))
     
     return fragmentos
 
 
+def fragmentar_texto(
+    texto: str, 
+    chunk_size: int = CHUNK_SIZE, 
+    overlap: int = CHUNK_OVERLAP
+) -> List[str]:
+    """Igual que fragmentar_texto_con_tokens pero devuelve solo los textos."""
+    return [frag for frag, _ in fragmentar_texto_con_tokens(texto, chunk_size, overlap)]
+
+
 # ============================================================================
 # Detección de Tipo de Contenido
 # ============================================================================
 
+# Patrones comunes de código Python, unidos en una sola regex precompilada
+_PATRONES_CODIGO = [
+    r'^\s*(def |class |import |from .+ import)',  # Declaraciones
+    r'^\s*(if |elif |else:|for |while |try:|except|finally:)',  # Control
+    r'^\s*(return |yield |raise |with )',  # Keywords
+    r'^\s*#\s',  # Comentarios Python
+    r'>>>\s',  # REPL Python
+    r'^\s*(print\(|input\(|len\(|range\()',  # Funciones comunes
+    r'[=!<>]=|[+\-*/]=',  # Operadores de asignación
+    r'^\s{4,}\S',  # Indentación de 4+ espacios
+    r'\[.*\]|\{.*\}',  # Listas/diccionarios literales
+]
+_RE_CODIGO = re.compile("|".join(f"(?:{p})" for p in _PATRONES_CODIGO))
+
+
 def detectar_tipo_contenido(texto: str) -> str:
     """
     Clasifica un fragmento como 'texto' (teoría) o 'codigo' (Python).
     Usa heurísticas basadas en patrones comunes de código Python.
     """
     lineas = texto.split('\n')
-    indicadores_codigo = 0
     total_lineas = len(lineas)
     
     if total_lineas == 0:
         return "texto"
     
-    patrones_codigo = [
-        r'^\s*(def |class |import |from .+ import)',  # Declaraciones
-        r'^\s*(if |elif |else:|for |while |try:|except|finally:)',  # Control
-        r'^\s*(return |yield |raise |with )',  # Keywords
-        r'^\s*#\s',  # Comentarios Python
-        r'>>>\s',  # REPL Python
-        r'^\s*(print\(|input\(|len\(|range\()',  # Funciones comunes
-        r'[=!<>]=|[+\-*/]=',  # Operadores de asignación
-        r'^\s{4,}\S',  # Indentación de 4+ espacios
-        r'\[.*\]|\{.*\}',  # Listas/diccionarios literales
-    ]
-    
-    for linea in lineas:
-        for patron in patrones_codigo:
-            if re.search(patron, linea):
-                indicadores_codigo += 1
-                break
+    buscar = _RE_CODIGO.search
+    indicadores_codigo = sum(1 for linea in lineas if buscar(linea))
     
     # Si más del 40% de las líneas tienen patrones de código
     ratio = indicadores_codigo / total_lineas if total_lineas > 0 else 0
@@ -182,7 +212,8 @@ def detectar_tipo_contenido(texto: str) -> str:
 
 def enriquecer_fragmentos(
     fragmentos: List[str],
-    metadata_base: Dict[str, Any]
+    metadata_base: Dict[str, Any],
+    tokens_fragmentos: Optional[List[int]] = None,
 ) -> List[Dict[str, Any]]:
     """
     Enriquece cada fragmento con metadatos descriptivos.
@@ -190,15 +221,18 @@ def enriquecer_fragmentos(
     Args:
         fragmentos: Lista de textos fragmentados
         metadata_base: Metadatos comunes (fuente, página, capítulo, etc.)
+        tokens_fragmentos: Conteos ya calculados en el chunking (evita re-tokenizar)
     
     Returns:
         Lista de diccionarios con 'contenido', 'tipo', 'tokens', 'metadata'
     """
     resultado = []
+    if tokens_fragmentos is None:
+        tokens_fragmentos = contar_tokens_lote(fragmentos)
     
     for idx, fragmento in enumerate(fragmentos):
         tipo = detectar_tipo_contenido(fragmento)
-        tokens = contar_tokens(fragmento)
+        tokens = tokens_fragmentos[idx]
         
         meta = {
             **metadata_base,
@@ -252,8 +286,9 @@ def procesar_texto_tema(
     if not texto or not texto.strip():
         return []
     
-    # 1. Fragmentar
-    fragmentos = fragmentar_texto(texto, chunk_size, overlap)
+    # 1. Fragmentar (cada sentencia se tokeniza una sola vez)
+    con_tokens = fragmentar_texto_con_tokens(texto, chunk_size, overlap)
+    fragmentos = [frag for frag, _ in con_tokens]
     
     # 2. Construir posición legible
     if parent_nombre:
@@ -272,6 +307,69 @@ def procesar_texto_tema(
         "origen": "chunking_token_based_v1",
     }
     
-    bloques = enriquecer_fragmentos(fragmentos, metadata_base)
+    bloques = enriquecer_fragmentos(fragmentos, metadata_base, [n for _, n in con_tokens])
     
     return bloques
+
+
+# ============================================================================
+# Procesamiento de Temas en Paralelo (Pool de Procesos)
+# ============================================================================
+
+def _procesar_tema_worker(args: Tuple) -> Tuple[List[Dict[str, Any]], float]:
+    """Worker del pool (función de módulo para que sea serializable). Devuelve (bloques, CPU en segundos)."""
+    cpu_inicio = time.process_time()
+    bloques = procesar_texto_tema(*args)
+    return bloques, time.process_time() - cpu_inicio
+
+
+def procesar_temas_paralelo(
+    tareas: List[Tuple],
+    procesos: int = INGEST_PROCESOS,
+) -> Iterator[Tuple[List[Dict[str, Any]], float]]:
+    """
+    Ejecuta procesar_texto_tema para cada tupla de argumentos en un pool de procesos.
+    Los resultados se devuelven EN EL MISMO ORDEN que `tareas` (orden determinista),
+    según van estando disponibles. Con pocos temas, libros pequeños o procesos <= 1 se hace en serie.
+    """
+    total_caracteres = sum(len(args[0]) for args in tareas)
+    if procesos <= 1 or len(tareas) < 2 or total_caracteres < INGEST_MIN_CARACTERES_POOL:
+        for args in tareas:
+            yield _procesar_tema_worker(args)
+        return
+    
+    with ProcessPoolExecutor(max_workers=min(procesos, len(tareas))) as pool:
+        # map() conserva el orden de entrada; chunksize reduce el ida y vuelta entre procesos
+        chunksize = max(1, len(tareas) // (procesos * 4))
+        yield from pool.map(_procesar_tema_worker, tareas, chunksize=chunksize)
+
+
+def procesar_temas_stream(
+    tareas: Iterable[Tuple],
+    procesos: int = INGEST_PROCESOS,
+) -> Iterator[Tuple[List[Dict[str, Any]], float]]:
+    """
+    Variante en streaming de procesar_temas_paralelo para la ingesta por etapas:
+    consume las tareas según llegan y devuelve los resultados en el mismo orden.
+    Empieza en serie y solo abre el pool cuando el texto recibido supera
+    INGEST_MIN_CARACTERES_POOL; nunca hay más de procesos*2 temas en vuelo.
+    """
+    pool = None
+    en_vuelo = deque()
+    caracteres = 0
+    try:
+        for args in tareas:
+            caracteres += len(args[0])
+            if pool is None and procesos > 1 and caracteres >= INGEST_MIN_CARACTERES_POOL:
+                pool = ProcessPoolExecutor(max_workers=procesos)
+            if pool is None:
+                yield _procesar_tema_worker(args)
+                continue
+            en_vuelo.append(pool.submit(_procesar_tema_worker, args))
+            if len(en_vuelo) >= procesos * 2:
+                yield en_vuelo.popleft().result()
+        while en_vuelo:
+            yield en_vuelo.popleft().result()
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
@@ -0,0 +1,137 @@
+"""
+Circuit Breaker para los proveedores de IA (embeddings Azure OpenAI y chat Mistral).
+
+Si un proveedor acumula fallos seguidos (errores o timeouts), el circuito se ABRE y
+las llamadas de consulta se rechazan al instante durante un tiempo, en lugar de
+esperar reintentos. Mientras tanto el RAG pasa a búsqueda léxica (full-text) y el
+chat a respuestas sin API. Pasado el tiempo de reposo, el circuito queda SEMIABIERTO
+y deja pasar una llamada de prueba: si va bien se cierra, si falla vuelve a abrirse.
+"""
+import os
+import time
+import threading
+from collections import defaultdict
+from typing import Dict
+
+# ============================================================================
+# Configuración
+# ============================================================================
+
+BREAKER_UMBRAL_FALLOS = int(os.getenv("BREAKER_UMBRAL_FALLOS", "3"))        # Fallos seguidos para abrir
+BREAKER_SEGUNDOS_ABIERTO = float(os.getenv("BREAKER_SEGUNDOS_ABIERTO", "30"))
+
+CERRADO = "cerrado"
+ABIERTO = "abierto"
+SEMIABIERTO = "semiabierto"
+
+
+class CircuitoAbiertoError(Exception):
+    """El proveedor está marcado como caído: no se intenta la llamada."""
+
+# ============================================================================
+# Circuit Breaker
+# ============================================================================
+
+class CircuitBreaker:
+    def __init__(self, nombre: str, umbral_fallos: int = BREAKER_UMBRAL_FALLOS,
+                 segundos_abierto: float = BREAKER_SEGUNDOS_ABIERTO):
+        self.nombre = nombre
+        self.umbral_fallos = umbral_fallos
+        self.segundos_abierto = segundos_abierto
+        self.estado = CERRADO
+        self.fallos_seguidos = 0
+        self.abierto_desde = 0.0
+        self.prueba_en_curso = False
+        self.lock = threading.Lock()
+        self.contadores = defaultdict(int)
+
+    def permitir(self) -> bool:
+        """¿Se puede llamar al proveedor ahora? En SEMIABIERTO solo pasa una llamada de prueba."""
+        with self.lock:
+            if self.estado == ABIERTO and time.monotonic() - self.abierto_desde >= self.segundos_abierto:
+                self.estado = SEMIABIERTO
+                self.prueba_en_curso = False
+            if self.estado == CERRADO:
+                return True
+            if self.estado == SEMIABIERTO and not self.prueba_en_curso:
+                self.prueba_en_curso = True
+                return True
+            self.contadores["rechazadas"] += 1
+            return False
+
+    def verificar(self):
+        """Lanza CircuitoAbiertoError si el circuito no deja pasar la llamada."""
+        if not self.permitir():
+            raise CircuitoAbiertoError(f"Circuito '{self.nombre}' abierto")
+
+    def registrar_exito(self):
+        with self.lock:
+            self.contadores["exitos"] += 1
+            self.fallos_seguidos = 0
+            if self.estado != CERRADO:
+                print(f"🟢 Circuito '{self.nombre}' cerrado (proveedor recuperado)")
+            self.estado = CERRADO
+            self.prueba_en_curso = False
+
+    def registrar_fallo(self):
+        with self.lock:
+            self.contadores["fallos"] += 1
+            self.fallos_seguidos += 1
+            if self.estado == SEMIABIERTO or self.fallos_seguidos >= self.umbral_fallos:
+                if self.estado != ABIERTO:
+                    self.contadores["aperturas"] += 1
+                    print(f"🔴 Circuito '{self.nombre}' ABIERTO tras {self.fallos_seguidos} fallos seguidos")
+                self.estado = ABIERTO
+                self.abierto_desde = time.monotonic()
+                self.prueba_en_curso = False
+
+    def esta_abierto(self) -> bool:
+        """Consulta sin consumir la llamada de prueba."""
+        with self.lock:
+            return self.estado == ABIERTO and time.monotonic() - self.abierto_desde < self.segundos_abierto
+
+    def resumen(self) -> Dict:
+        with self.lock:
+            return {
+                "estado": self.estado,
+                "fallos_seguidos": self.fallos_seguidos,
+                **dict(self.contadores),
+            }
+
+
+breaker_embeddings = CircuitBreaker("embeddings")
+breaker_chat = CircuitBreaker("chat")
+
+# ============================================================================
+# Métricas de degradación (fallbacks)
+# ============================================================================
+
+_fallbacks = defaultdict(int)
+_fallbacks_lock = threading.Lock()
+
+
+def registrar_consulta(tipo: str, degradada: bool):
+    """Cuenta consultas normales y degradadas (ej: tipo='busqueda', 'chat')."""
+    with _fallbacks_lock:
+        _fallbacks[f"{tipo}_total"] += 1
+        if degradada:
+            _fallbacks[f"{tipo}_fallback"] += 1
+
+
+def estado_breakers() -> Dict:
+    """Estado de cada circuito y ratio de fallback por tipo de consulta."""
+    with _fallbacks_lock:
+        m = dict(_fallbacks)
+    fallbacks = {}
+    for tipo in ("busqueda", "chat"):
+        total = m.get(f"{tipo}_total", 0)
+        degradadas = m.get(f"{tipo}_fallback", 0)
+        fallbacks[tipo] = {
+            "total": total,
+            "fallback": degradadas,
+            "ratio": round(degradadas / total, 4) if total else 0.0,
+        }
+    return {
+        "circuitos": {b.nombre: b.resumen() for b in (breaker_embeddings, breaker_chat)},
+        "fallbacks": fallbacks,
+    }
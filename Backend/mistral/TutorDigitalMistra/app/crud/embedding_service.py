@@ -1,19 +1,36 @@
 """
 Servicio de Embeddings — Azure OpenAI text-embedding-3-small (1536 dims)
+Proveedor intercambiable (EMBEDDING_PROVIDER): Azure o local determinista sin red.
 Reemplaza el embedding de Mistral. Incluye caché en PostgreSQL.
 """
 import os
 import hashlib
 import time
 import threading
-import functools
-from collections import defaultdict
-from typing import List
+import unicodedata
+import re
+import atexit
+from collections import defaultdict, OrderedDict, Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Dict, Optional, Callable, Tuple
 
+import numpy as np
+
+try:
+    import fcntl  # Cerrojo del almacén en disco (POSIX)
+except ImportError:
+    fcntl = None
+    import msvcrt  # Windows
+
+from sqlalchemy import select, any_, literal, String, text
+from sqlalchemy.dialects.postgresql import ARRAY, insert as pg_insert
 from sqlalchemy.orm import Session
 from openai import AzureOpenAI
 
 from app.models.modelos import EmbeddingCache
+from app.crud.chunking_service import contar_tokens
+from app.crud.rate_limit_service import esperar, retry_with_backoff, PROVEEDOR_AZURE
+from app.crud.circuit_breaker_service import breaker_embeddings
 
 # ============================================================================
 # Configuración del Cliente Azure OpenAI
@@ -23,205 +40,702 @@ AZURE_OPENAI_KEY = os.getenv("OPENAI_API_KEY")
 AZURE_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT", "https://ia-mistral-recurso.cognitiveservices.azure.com/")
 EMBEDDING_DEPLOYMENT = os.getenv("OPENAI_EMBEDDING_MODEL", "text-embedding-3-small")
 EMBEDDING_DIM = 1536  # Dimensión de text-embedding-3-small
+EMBEDDING_TIMEOUT = float(os.getenv("EMBEDDING_TIMEOUT", "30"))                   # Lotes de ingesta (s)
+EMBEDDING_TIMEOUT_CONSULTA = float(os.getenv("EMBEDDING_TIMEOUT_CONSULTA", "4"))  # Preguntas del alumno (s)
+
+# "azure" | "local" | "auto" (azure si hay OPENAI_API_KEY, si no local)
+EMBEDDING_PROVIDER = os.getenv("EMBEDDING_PROVIDER", "auto").lower()
 
 if AZURE_OPENAI_KEY:
     openai_client = AzureOpenAI(
         api_version="2024-12-01-preview",
         azure_endpoint=AZURE_ENDPOINT,
         api_key=AZURE_OPENAI_KEY,
+        timeout=EMBEDDING_TIMEOUT,
+        max_retries=0,  # Los reintentos los gestiona retry_with_backoff
     )
 else:
     openai_client = None
 
 # ============================================================================
-# Rate Limiter (para respetar límites de la API)
+# Proveedores de Embeddings
 # ============================================================================
 
-class RateLimiter:
-    def __init__(self, max_requests: int = 50, time_window: float = 60.0):
-        self.max_requests = max_requests
-        self.time_window = time_window
-        self.requests = defaultdict(list)
-        self.lock = threading.Lock()
-    
-    def wait_if_needed(self, key: str = "embed"):
-        with self.lock:
-            now = time.time()
-            self.requests[key] = [ts for ts in self.requests[key] if now - ts < self.time_window]
-            if len(self.requests[key]) >= self.max_requests:
-                wait_time = self.time_window - (now - self.requests[key][0])
-                if wait_time > 0:
-                    time.sleep(wait_time)
-            self.requests[key].append(time.time())
+class ProveedorEmbeddings:
+    """Interfaz: convierte una lista de textos (ya limpios, no vacíos) en vectores de EMBEDDING_DIM."""
+    nombre = "base"
+    modelo = ""
+    remoto = False  # Los remotos pasan por rate limiter y circuit breaker
 
-rate_limiter = RateLimiter()
+    def embed(self, textos: List[str], timeout: Optional[float] = None) -> List[List[float]]:
+        raise NotImplementedError
+
+
+class ProveedorAzure(ProveedorEmbeddings):
+    """Azure OpenAI text-embedding-3-small."""
+    nombre = "azure"
+    remoto = True
+
+    def __init__(self, cliente: AzureOpenAI, modelo: str):
+        self.cliente = cliente
+        self.modelo = modelo
+
+    def embed(self, textos: List[str], timeout: Optional[float] = None) -> List[List[float]]:
+        cliente = self.cliente.with_options(timeout=timeout) if timeout else self.cliente
+        response = cliente.embeddings.create(model=self.modelo, input=textos)
+        # Ordenar por índice (la API puede devolver desordenado)
+        return [r.embedding for r in sorted(response.data, key=lambda x: x.index)]
+
+
+class ProveedorLocal(ProveedorEmbeddings):
+    """
+    Embeddings deterministas sin red, para benchmarks offline y desarrollo sin API.
+    n-gramas de caracteres (3-5) del texto normalizado → hashing con signo en 4096 cubetas
+    → escala log → proyección aleatoria fija (semilla) a 1536 dims → normalización L2.
+    Todo vectorizado con NumPy: un libro entero se indexa en segundos.
+    """
+    nombre = "local"
+    modelo = "local-ngram-hash-v1"
+    N_CUBETAS = 4096
+    NGRAMAS = (3, 4, 5)
+    SEMILLA = 1536
+
+    def __init__(self, dim: int = EMBEDDING_DIM):
+        rng = np.random.default_rng(self.SEMILLA)
+        self.proyeccion = (rng.standard_normal((self.N_CUBETAS, dim)) / np.sqrt(dim)).astype(np.float32)
+
+    def _caracteristicas(self, texto: str) -> np.ndarray:
+        codigos = np.frombuffer(f" {_normalizar_texto(texto)} ".encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+        x = np.zeros(self.N_CUBETAS, dtype=np.float32)
+        for n in self.NGRAMAS:
+            if len(codigos) < n:
+                continue
+            # Hash polinómico de cada ventana de n caracteres (aritmética uint64 con desbordamiento)
+            h = np.full(len(codigos) - n + 1, n, dtype=np.uint64)
+            for k in range(n):
+                h = h * np.uint64(1000003) + codigos[k:len(codigos) - n + 1 + k]
+            mezcla = h * np.uint64(0x9E3779B97F4A7C15)
+            cubetas = (mezcla >> np.uint64(52)).astype(np.int64)
+            signos = np.where((mezcla >> np.uint64(40)) & np.uint64(1), 1.0, -1.0)
+            x += np.bincount(cubetas, weights=signos, minlength=self.N_CUBETAS).astype(np.float32)
+        return np.sign(x) * np.log1p(np.abs(x))
+
+    def embed(self, textos: List[str], timeout: Optional[float] = None) -> List[List[float]]:
+        matriz = np.stack([self._caracteristicas(t) for t in textos]) @ self.proyeccion
+        normas = np.linalg.norm(matriz, axis=1, keepdims=True)
+        normas[normas == 0] = 1.0
+        return (matriz / normas).tolist()
+
+
+def _crear_proveedor() -> Optional[ProveedorEmbeddings]:
+    if EMBEDDING_PROVIDER == "local" or (EMBEDDING_PROVIDER == "auto" and not openai_client):
+        print("🧮 Embeddings: proveedor LOCAL (n-gramas + proyección aleatoria, sin red)")
+        return ProveedorLocal()
+    if openai_client:
+        return ProveedorAzure(openai_client, EMBEDDING_DEPLOYMENT)
+    print("⚠️ EMBEDDING_PROVIDER=azure sin OPENAI_API_KEY: se devolverán vectores cero")
+    return None
 
-# ============================================================================
-# Retry con Backoff Exponencial
-# ============================================================================
 
-def retry_with_backoff(max_retries: int = 3, base_delay: float = 1.0):
-    def decorator(func):
-        @functools.wraps(func)
-        def wrapper(*args, **kwargs):
-            for attempt in range(max_retries):
-                try:
-                    return func(*args, **kwargs)
-                except Exception as e:
-                    if ("429" in str(e) or "rate" in str(e).lower()) and attempt < max_retries - 1:
-                        time.sleep(base_delay * (2 ** attempt))
-                    elif attempt == max_retries - 1:
-                        raise e
-            return None
-        return wrapper
-    return decorator
+proveedor = _crear_proveedor()
+EMBEDDING_MODELO = proveedor.modelo if proveedor else EMBEDDING_DEPLOYMENT  # Forma parte de las claves de caché
 
 # ============================================================================
 # Funciones de Embedding
 # ============================================================================
 
-BATCH_SIZE = 20  # Cuántos textos enviar por llamada API (máx recomendado ~20)
+# Lotes dimensionados por tokens (límites de text-embedding-3-small: 2048 inputs y 8191 tokens por input)
+EMBEDDING_MAX_INPUTS_LOTE = int(os.getenv("EMBEDDING_MAX_INPUTS_LOTE", "256"))
+EMBEDDING_MAX_TOKENS_LOTE = int(os.getenv("EMBEDDING_MAX_TOKENS_LOTE", "32000"))
+EMBEDDING_MAX_TOKENS_INPUT = 8191
+EMBEDDING_CONCURRENCIA = int(os.getenv("EMBEDDING_CONCURRENCIA", "4"))  # Lotes en vuelo a la vez
 
-@retry_with_backoff()
+@retry_with_backoff(PROVEEDOR_AZURE, EMBEDDING_DEPLOYMENT, max_retries=2)
 def _generate_embedding_api(texto: str) -> List[float]:
-    """Llama a la API de OpenAI para generar un embedding (1 texto)."""
-    if not openai_client:
+    """
+    Genera un embedding (1 texto, ruta de consulta) con el proveedor activo.
+    Si es remoto, está protegido por el circuit breaker: abierto → CircuitoAbiertoError al instante.
+    """
+    if not proveedor:
         return [0.0] * EMBEDDING_DIM
     
-    rate_limiter.wait_if_needed("embed")
-    
     texto_limpio = texto.replace("\n", " ").strip()
     if not texto_limpio:
         return [0.0] * EMBEDDING_DIM
     
-    response = openai_client.embeddings.create(
-        model=EMBEDDING_DEPLOYMENT,
-        input=[texto_limpio]
-    )
-    return response.data[0].embedding
+    if not proveedor.remoto:
+        return proveedor.embed([texto_limpio])[0]
+    
+    breaker_embeddings.verificar()
+    esperar(PROVEEDOR_AZURE, EMBEDDING_DEPLOYMENT, contar_tokens(texto_limpio))
+    
+    try:
+        vector = proveedor.embed([texto_limpio], timeout=EMBEDDING_TIMEOUT_CONSULTA)[0]
+    except Exception:
+        breaker_embeddings.registrar_fallo()
+        raise
+    breaker_embeddings.registrar_exito()
+    return vector
 
 
-@retry_with_backoff()
+@retry_with_backoff(PROVEEDOR_AZURE, EMBEDDING_DEPLOYMENT)
 def _generate_embeddings_batch_api(textos: List[str]) -> List[List[float]]:
-    """Llama a la API de OpenAI para generar embeddings en BATCH (múltiples textos)."""
-    if not openai_client:
+    """Genera embeddings en BATCH (múltiples textos) con el proveedor activo."""
+    if not proveedor:
         return [[0.0] * EMBEDDING_DIM for _ in textos]
     
-    rate_limiter.wait_if_needed("embed")
-    
     textos_limpios = [t.replace("\n", " ").strip() for t in textos]
     # Reemplazar vacíos por un espacio para evitar errores
     textos_limpios = [t if t else " " for t in textos_limpios]
     
-    response = openai_client.embeddings.create(
-        model=EMBEDDING_DEPLOYMENT,
-        input=textos_limpios
-    )
+    if not proveedor.remoto:
+        return proveedor.embed(textos_limpios)
+    
+    esperar(PROVEEDOR_AZURE, EMBEDDING_DEPLOYMENT, sum(contar_tokens(t) for t in textos_limpios))
+    
+    # La ingesta no tiene modo degradado: no se rechaza con el circuito abierto, pero alimenta su estado
+    try:
+        vectores = proveedor.embed(textos_limpios)
+    except Exception:
+        breaker_embeddings.registrar_fallo()
+        raise
+    breaker_embeddings.registrar_exito()
+    return vectores
+
+
+def _agrupar_por_tokens(textos: List[str]) -> Tuple[List[str], List[List[int]]]:
+    """
+    Agrupa los índices de `textos` en lotes que respetan el máximo de inputs y de tokens por petición.
+    Recorta (por proporción de caracteres) los textos que superan el límite de tokens por input.
+    """
+    textos_ajustados = list(textos)
+    lotes, actual, tokens_actual = [], [], 0
+    for i, texto in enumerate(textos):
+        n = contar_tokens(texto)
+        if n > EMBEDDING_MAX_TOKENS_INPUT:
+            textos_ajustados[i] = texto[:int(len(texto) * EMBEDDING_MAX_TOKENS_INPUT / n * 0.95)]
+            n = EMBEDDING_MAX_TOKENS_INPUT
+        if actual and (tokens_actual + n > EMBEDDING_MAX_TOKENS_LOTE or len(actual) >= EMBEDDING_MAX_INPUTS_LOTE):
+            lotes.append(actual)
+            actual, tokens_actual = [], 0
+        actual.append(i)
+        tokens_actual += n
+    if actual:
+        lotes.append(actual)
+    return textos_ajustados, lotes
+
+
+def generar_vectores_concurrente(
+    textos: List[str],
+    al_completar_lote: Optional[Callable[[List[int], List[List[float]]], None]] = None,
+    concurrencia: int = EMBEDDING_CONCURRENCIA,
+) -> List[List[float]]:
+    """
+    Genera embeddings (sin caché) con varios lotes en vuelo a la vez.
+    Todas las llamadas pasan por rate_limit_service (RPM + TPM del modelo), así que comparten presupuesto.
+    El resultado mantiene el orden original de `textos`.
+    `al_completar_lote(indices, vectores)` se invoca en el hilo llamante según van terminando los lotes.
+    """
+    resultados = [None] * len(textos)
+    if not textos:
+        return resultados
     
-    # Ordenar por índice (la API puede devolver desordenado)
-    results = sorted(response.data, key=lambda x: x.index)
-    return [r.embedding for r in results]
+    textos_ajustados, lotes = _agrupar_por_tokens(textos)
+    workers = max(1, min(concurrencia, len(lotes)))
+    
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futuros = {
+            pool.submit(_generate_embeddings_batch_api, [textos_ajustados[i] for i in lote]): lote
+            for lote in lotes
+        }
+        for futuro in as_completed(futuros):
+            lote = futuros[futuro]
+            vectores = futuro.result()
+            for i, vector in zip(lote, vectores):
+                resultados[i] = vector
+            if al_completar_lote:
+                al_completar_lote(lote, vectores)
+    
+    return resultados
 
 
 from app.db.database import SessionLocal
 
-# ... (imports) ...
+# ============================================================================
+# Caché en PostgreSQL (lecturas y escrituras en bloque)
+# ============================================================================
+
+CACHE_LOOKUP_CHUNK = 5000  # Hashes por consulta ANY(...) para no generar sentencias gigantes
+EMBEDDING_CACHE_TEXTO_MAX = int(os.getenv("EMBEDDING_CACHE_TEXTO_MAX", "200"))  # Extracto guardado (0 = nada)
+EMBEDDING_USO_FLUSH_N = int(os.getenv("EMBEDDING_USO_FLUSH_N", "500"))          # Hits pendientes antes de volcar
+EMBEDDING_USO_FLUSH_SEG = float(os.getenv("EMBEDDING_USO_FLUSH_SEG", "60"))
+
+
+def _hash_texto(texto: str) -> str:
+    """Clave de embedding_cache: incluye modelo y dimensión."""
+    base = f"{EMBEDDING_MODELO}|{EMBEDDING_DIM}|{texto}"
+    return hashlib.sha256(base.encode('utf-8')).hexdigest()
+
+
+def _fila_cache(text_hash: str, texto: str, vector: List[float]) -> Dict:
+    return {
+        "text_hash": text_hash,
+        "original_text": texto[:EMBEDDING_CACHE_TEXTO_MAX] if EMBEDDING_CACHE_TEXTO_MAX > 0 else None,
+        "modelo": EMBEDDING_MODELO,
+        "dimension": EMBEDDING_DIM,
+        "embedding": vector,
+        "hit_count": 0,
+    }
+
+# --- Uso (last_used_at / hit_count) acumulado en memoria y volcado en lotes ---
+
+_uso_pendiente: Counter = Counter()  # hash -> aciertos
+_uso_aciertos_pendientes = 0           # Total de aciertos (len(_uso_pendiente) solo cuenta hashes distintos)
+_uso_lock = threading.Lock()
+_uso_ultimo_volcado = time.monotonic()
+
+
+def _registrar_uso(hashes: List[str]) -> None:
+    """Anota aciertos de caché; se escriben en BD cada N aciertos o cada X segundos."""
+    global _uso_ultimo_volcado, _uso_aciertos_pendientes
+    with _uso_lock:
+        _uso_pendiente.update(hashes)
+        _uso_aciertos_pendientes += len(hashes)
+        toca_volcar = (
+            _uso_aciertos_pendientes >= EMBEDDING_USO_FLUSH_N
+            or time.monotonic() - _uso_ultimo_volcado >= EMBEDDING_USO_FLUSH_SEG
+        )
+    if toca_volcar:
+        volcar_uso_cache()
+
+
+def volcar_uso_cache() -> int:
+    """Escribe los aciertos pendientes con un único UPDATE executemany (sesión aislada)."""
+    global _uso_ultimo_volcado, _uso_aciertos_pendientes
+    with _uso_lock:
+        pendientes = dict(_uso_pendiente)
+        _uso_pendiente.clear()
+        _uso_aciertos_pendientes = 0
+        _uso_ultimo_volcado = time.monotonic()
+    if not pendientes:
+        return 0
+    cache_db = SessionLocal()
+    try:
+        cache_db.execute(
+            text(
+                "UPDATE embedding_cache SET hit_count = hit_count + :n, last_used_at = now() "
+                "WHERE text_hash = :h"
+            ),
+            [{"h": h, "n": n} for h, n in pendientes.items()],
+        )
+        cache_db.commit()
+    except Exception as e:
+        cache_db.rollback()
+        print(f"   ⚠️ Error volcando uso de caché: {e}")
+    finally:
+        cache_db.close()
+    return len(pendientes)
+
+
+atexit.register(volcar_uso_cache)
+
+
+def _buscar_cache_bulk(db: Session, hashes: List[str]) -> Dict[str, List[float]]:
+    """Recupera de embedding_cache todos los hashes con un único WHERE text_hash = ANY(...)."""
+    encontrados = {}
+    for inicio in range(0, len(hashes), CACHE_LOOKUP_CHUNK):
+        bloque = hashes[inicio:inicio + CACHE_LOOKUP_CHUNK]
+        filas = db.execute(
+            select(EmbeddingCache.text_hash, EmbeddingCache.embedding).where(
+                EmbeddingCache.text_hash == any_(literal(bloque, ARRAY(String(64))))
+            )
+        ).all()
+        for text_hash, embedding in filas:
+            encontrados[text_hash] = embedding
+    return encontrados
+
+
+def _guardar_cache_bulk(filas: List[Dict]) -> None:
+    """
+    Inserta en embedding_cache con un único INSERT ... ON CONFLICT DO NOTHING (executemany).
+    Usa sesión AISLADA para no hacer commit de cosas pendientes del caller.
+    """
+    if not filas:
+        return
+    cache_db = SessionLocal()
+    try:
+        stmt = pg_insert(EmbeddingCache).on_conflict_do_nothing(index_elements=["text_hash"])
+        cache_db.execute(stmt, filas)
+        cache_db.commit()
+    except Exception as e:
+        # Si falla la caché no pasa nada, los vectores ya están calculados
+        cache_db.rollback()
+        print(f"   ⚠️ Error guardando caché batch: {e}")
+    finally:
+        cache_db.close()
+
+# ============================================================================
+# Caché multinivel para consultas (L1 proceso → L2 disco mmap → L3 PostgreSQL)
+# ============================================================================
+
+EMBEDDING_LRU_SIZE = int(os.getenv("EMBEDDING_LRU_SIZE", "2048"))              # Vectores en memoria
+EMBEDDING_DISK_CACHE_DIR = os.getenv("EMBEDDING_DISK_CACHE_DIR", "")           # Vacío = L2 desactivado
+EMBEDDING_DISK_CACHE_SLOTS = int(os.getenv("EMBEDDING_DISK_CACHE_SLOTS", "20000"))
+
+_RE_ESPACIOS = re.compile(r"\s+")
+
+
+def _normalizar_texto(texto: str) -> str:
+    """Minúsculas, sin tildes y con los espacios colapsados."""
+    texto = unicodedata.normalize("NFKD", texto.lower())
+    texto = "".join(c for c in texto if not unicodedata.combining(c))
+    return _RE_ESPACIOS.sub(" ", texto).strip()
+
+
+def _clave_cache(texto: str) -> str:
+    """Clave L1/L2: texto normalizado + modelo + dimensión."""
+    base = f"{EMBEDDING_MODELO}|{EMBEDDING_DIM}|{_normalizar_texto(texto)}"
+    return hashlib.sha256(base.encode("utf-8")).hexdigest()
+
+
+class LRUEmbeddings:
+    """LRU en proceso de vectores float32 (thread-safe)."""
+
+    def __init__(self, capacidad: int):
+        self.capacidad = capacidad
+        self.datos: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, clave: str) -> Optional[np.ndarray]:
+        with self.lock:
+            vector = self.datos.get(clave)
+            if vector is not None:
+                self.datos.move_to_end(clave)
+            return vector
+
+    def put(self, clave: str, vector: np.ndarray) -> None:
+        if self.capacidad <= 0:
+            return
+        with self.lock:
+            self.datos[clave] = vector
+            self.datos.move_to_end(clave)
+            while len(self.datos) > self.capacidad:
+                self.datos.popitem(last=False)
+
+
+def _cerrojo_exclusivo(ruta: str):
+    """Fichero abierto con cerrojo exclusivo no bloqueante, o None si ya lo tiene otro proceso."""
+    f = open(ruta, "a+b")
+    try:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        f.close()
+        return None
+    return f
+
+
+class DiscoEmbeddings:
+    """
+    Almacén local en disco con np.memmap: `vectors.f32` (slots x dim) + `keys.bin` (slots x 64 bytes)
+    + `cursor.bin` (siguiente slot). Los slots se reutilizan en anillo cuando se llena.
+    
+    Un único proceso escritor por almacén: cada proceso (workers de uvicorn, workers de ingesta)
+    toma con un cerrojo exclusivo el primer subdirectorio libre de `directorio` (0/, 1/, ...),
+    así que se reutiliza entre reinicios pero nunca lo comparten dos procesos vivos.
+    """
+
+    def __init__(self, directorio: str, slots: int, dim: int, max_procesos: int = 64):
+        self.cerrojo = None
+        for n in range(max_procesos):
+            self.directorio = os.path.join(directorio, str(n))
+            os.makedirs(self.directorio, exist_ok=True)
+            self.cerrojo = _cerrojo_exclusivo(os.path.join(self.directorio, ".lock"))
+            if self.cerrojo is not None:
+                break
+        if self.cerrojo is None:
+            raise RuntimeError(f"{max_procesos} procesos ya usan {directorio}")
+        self.slots = slots
+        self.lock = threading.Lock()
+        ruta_vec = os.path.join(self.directorio, "vectors.f32")
+        ruta_keys = os.path.join(self.directorio, "keys.bin")
+        ruta_cursor = os.path.join(self.directorio, "cursor.bin")
+        modo = "r+" if os.path.exists(ruta_vec) and os.path.exists(ruta_keys) else "w+"
+        self.vectores = np.memmap(ruta_vec, dtype=np.float32, mode=modo, shape=(slots, dim))
+        self.claves = np.memmap(ruta_keys, dtype="S64", mode=modo, shape=(slots,))
+        # Reconstruir índice clave → slot
+        self.indice: Dict[str, int] = {}
+        for slot, clave in enumerate(self.claves):
+            if clave:
+                self.indice[clave.decode("ascii")] = slot
+        # El cursor se persiste: tras dar la vuelta al anillo, len(indice) ya no dice dónde seguir
+        nuevo_cursor = modo == "w+" or not os.path.exists(ruta_cursor)
+        self.cursor = np.memmap(ruta_cursor, dtype=np.int64, mode="w+" if nuevo_cursor else "r+", shape=(1,))
+        if nuevo_cursor:
+            self.cursor[0] = len(self.indice) % slots
+        self.siguiente = int(self.cursor[0]) % slots
+
+    def get(self, clave: str) -> Optional[np.ndarray]:
+        with self.lock:
+            slot = self.indice.get(clave)
+            # La clave guardada en el slot debe coincidir: nunca se sirve el vector de otro texto
+            if slot is None or self.claves[slot] != clave.encode("ascii"):
+                return None
+            return np.array(self.vectores[slot])  # Copia fuera del mmap
+
+    def put(self, clave: str, vector: np.ndarray) -> None:
+        with self.lock:
+            if clave in self.indice:
+                return
+            slot = self.siguiente
+            anterior = self.claves[slot]
+            if anterior:
+                self.indice.pop(anterior.decode("ascii"), None)
+            self.vectores[slot] = vector
+            self.claves[slot] = clave.encode("ascii")
+            self.indice[clave] = slot
+            self.siguiente = (slot + 1) % self.slots
+            self.cursor[0] = self.siguiente
+
+
+_cache_l1 = LRUEmbeddings(EMBEDDING_LRU_SIZE)
+_cache_l2 = None
+if EMBEDDING_DISK_CACHE_DIR:
+    try:
+        _cache_l2 = DiscoEmbeddings(EMBEDDING_DISK_CACHE_DIR, EMBEDDING_DISK_CACHE_SLOTS, EMBEDDING_DIM)
+        print(f"💾 Caché de embeddings en disco: {_cache_l2.directorio} ({len(_cache_l2.indice)} vectores)")
+    except Exception as e:
+        print(f"⚠️ No se pudo abrir la caché de embeddings en disco: {e}")
+
+_metricas_cache = defaultdict(int)
+_metricas_lock = threading.Lock()
+
+
+def _contar(evento: str) -> None:
+    with _metricas_lock:
+        _metricas_cache[evento] += 1
+
+
+def _contar_batch(hits: int, misses: int) -> None:
+    with _metricas_lock:
+        _metricas_cache["batch_hit"] += hits
+        _metricas_cache["batch_miss"] += misses
+
+
+def obtener_metricas_cache() -> Dict:
+    """Aciertos por nivel y ratios sobre el total de consultas de generar_embedding (+ ingesta)."""
+    with _metricas_lock:
+        m = dict(_metricas_cache)
+    total = m.get("consultas", 0)
+    ratio = lambda n: round(n / total, 4) if total else 0.0
+    total_batch = m.get("batch_hit", 0) + m.get("batch_miss", 0)
+    return {
+        "ingesta": {"hits": m.get("batch_hit", 0), "misses": m.get("batch_miss", 0),
+                    "ratio": round(m.get("batch_hit", 0) / total_batch, 4) if total_batch else 0.0},
+        "consultas": total,
+        "l1_memoria": {"hits": m.get("l1_hit", 0), "ratio": ratio(m.get("l1_hit", 0)),
+                       "tamano": len(_cache_l1.datos), "capacidad": _cache_l1.capacidad},
+        "l2_disco": {"activo": _cache_l2 is not None, "hits": m.get("l2_hit", 0), "ratio": ratio(m.get("l2_hit", 0)),
+                     "tamano": len(_cache_l2.indice) if _cache_l2 else 0},
+        "l3_postgres": {"hits": m.get("l3_hit", 0), "ratio": ratio(m.get("l3_hit", 0))},
+        "api": {"llamadas": m.get("api", 0), "ratio": ratio(m.get("api", 0))},
+    }
+
+
+def _guardar_niveles_locales(clave: str, vector) -> np.ndarray:
+    """Promociona un vector a L1 (y L2 si está activo)."""
+    vector_f32 = np.asarray(vector, dtype=np.float32)
+    _cache_l1.put(clave, vector_f32)
+    if _cache_l2 is not None:
+        try:
+            _cache_l2.put(clave, vector_f32)
+        except Exception as e:
+            print(f"   ⚠️ Error escribiendo caché en disco: {e}")
+    return vector_f32
+
+# ============================================================================
+# Funciones Públicas
+# ============================================================================
 
 def generar_embedding(db: Session, texto: str) -> List[float]:
     """
-    Genera un embedding revisando caché primero.
-    Si no existe en caché, llama a OpenAI text-embedding-3-small.
+    Genera un embedding revisando la caché multinivel primero:
+    L1 (LRU en proceso) → L2 (disco mmap, opcional) → L3 (tabla embedding_cache).
+    Si no existe en ninguna, llama a OpenAI text-embedding-3-small.
     """
-    text_hash = hashlib.sha256(texto.encode('utf-8')).hexdigest()
+    _contar("consultas")
+    clave = _clave_cache(texto)
     
-    # 1. Lectura: Usamos la sesión actual (puede estar en transaccion)
+    # L1: memoria del proceso
+    vector = _cache_l1.get(clave)
+    if vector is not None:
+        _contar("l1_hit")
+        return vector.tolist()
+    
+    # L2: disco local
+    if _cache_l2 is not None:
+        vector = _cache_l2.get(clave)
+        if vector is not None:
+            _contar("l2_hit")
+            _cache_l1.put(clave, vector)
+            return vector.tolist()
+    
+    # L3: PostgreSQL (usamos la sesión actual, puede estar en transaccion)
+    text_hash = _hash_texto(texto)
     cached = db.query(EmbeddingCache).filter(
         EmbeddingCache.text_hash == text_hash
     ).first()
     
     if cached:
-        return cached.embedding
+        _contar("l3_hit")
+        _registrar_uso([text_hash])
+        return _guardar_niveles_locales(clave, cached.embedding).tolist()
     
-    # 2. Generación
+    # Generación
+    _contar("api")
     vector = _generate_embedding_api(texto)
     
-    # 3. Escritura en Caché: Usamos sesión AISLADA para no afectar la principal
-    # ni hacer commit de cosas pendientes del caller.
-    cache_db = SessionLocal()
-    try:
-        cache_db.add(EmbeddingCache(
-            text_hash=text_hash,
-            original_text=texto[:2000],
-            embedding=vector
-        ))
-        cache_db.commit()
-    except Exception as e:
-        # Si falla (ej: race condition, duplicado), no pasa nada, seguimos
-        cache_db.rollback()
-        # print(f"Cache write error: {e}")
-    finally:
-        cache_db.close()
+    # Escritura en Caché (sesión aislada, sin error en duplicados por race condition)
+    _guardar_cache_bulk([_fila_cache(text_hash, texto, vector)])
+    _guardar_niveles_locales(clave, vector)
     
     return vector
 
 
 def generar_embeddings_batch(db: Session, textos: List[str]) -> List[List[float]]:
     """
-    Genera embeddings en BATCH. Revisa caché con sesión actual.
-    Guarda nuevos en caché con sesión aislada.
+    Genera embeddings en BATCH.
+    1. Deduplica los textos del lote (mismo hash → una sola llamada)
+    2. Una sola consulta a la caché para todos los hashes (sesión actual)
+    3. Genera solo los que faltan en lotes por tokens concurrentes y guarda cada lote
+       con un único upsert (sesión aislada)
     """
     resultados = [None] * len(textos)
-    indices_sin_cache = []
-    textos_sin_cache = []
     
-    # 1. Buscar en caché (Sesión actual)
-    for i, texto in enumerate(textos):
-        text_hash = hashlib.sha256(texto.encode('utf-8')).hexdigest()
-        cached = db.query(EmbeddingCache).filter(
-            EmbeddingCache.text_hash == text_hash
-        ).first()
-        if cached:
-            resultados[i] = cached.embedding
-        else:
-            indices_sin_cache.append(i)
-            textos_sin_cache.append(texto)
+    # 1. Deduplicar: hash -> índices del lote que lo comparten
+    hashes = [_hash_texto(t) for t in textos]
+    posiciones: Dict[str, List[int]] = {}
+    for i, h in enumerate(hashes):
+        posiciones.setdefault(h, []).append(i)
+    hashes_unicos = list(posiciones.keys())
+    
+    # 2. Buscar en caché (una consulta)
+    t0 = time.perf_counter()
+    cacheados = _buscar_cache_bulk(db, hashes_unicos)
+    t_lookup = (time.perf_counter() - t0) * 1000
+    
+    for h, vector in cacheados.items():
+        for i in posiciones[h]:
+            resultados[i] = vector
+    _contar_batch(len(cacheados), len(hashes_unicos) - len(cacheados))
+    if cacheados:
+        _registrar_uso(list(cacheados.keys()))
     
-    if not textos_sin_cache:
-        print(f"   [Cache] Todos los {len(textos)} embeddings estaban en caché ✓")
+    hashes_sin_cache = [h for h in hashes_unicos if h not in cacheados]
+    duplicados = len(textos) - len(hashes_unicos)
+    
+    if not hashes_sin_cache:
+        print(f"   [Cache] Todos los {len(textos)} embeddings estaban en caché ✓ (lookup {t_lookup:.0f} ms)")
         return resultados
     
-    print(f"   [Embedding] {len(textos) - len(textos_sin_cache)} en caché, {len(textos_sin_cache)} por generar...")
+    print(
+        f"   [Embedding] {len(cacheados)} en caché, {len(hashes_sin_cache)} por generar, "
+        f"{duplicados} duplicados en el lote (lookup {t_lookup:.0f} ms)..."
+    )
+    
+    # 3. Generar en lotes concurrentes (API) — un texto representativo por hash.
+    #    Cada lote se guarda en caché nada más llegar, así un fallo posterior no pierde lo ya pagado.
+    textos_sin_cache = [textos[posiciones[h][0]] for h in hashes_sin_cache]
+    t_write = 0.0
     
-    # 2. Generar en batches (API)
-    todos_vectores = []
-    for batch_start in range(0, len(textos_sin_cache), BATCH_SIZE):
-        batch_textos = textos_sin_cache[batch_start:batch_start + BATCH_SIZE]
-        vectores = _generate_embeddings_batch_api(batch_textos)
-        todos_vectores.extend(vectores)
+    def _guardar_lote(indices: List[int], vectores: List[List[float]]):
+        nonlocal t_write
+        filas_cache = []
+        for j, vector in zip(indices, vectores):
+            h = hashes_sin_cache[j]
+            for i in posiciones[h]:
+                resultados[i] = vector
+            filas_cache.append(_fila_cache(h, textos_sin_cache[j], vector))
+        t0_lote = time.perf_counter()
+        _guardar_cache_bulk(filas_cache)
+        t_write += (time.perf_counter() - t0_lote) * 1000
     
-    # 3. Guardar en Caché (Sesión AISLADA)
-    cache_db = SessionLocal()
-    try:
-        for j, idx_original in enumerate(indices_sin_cache):
-            vector = todos_vectores[j]
-            resultados[idx_original] = vector
-            
-            texto = textos[idx_original]
-            text_hash = hashlib.sha256(texto.encode('utf-8')).hexdigest()
-            
-            # Verificar si ya existe en esta nueva sesión (race condition)
-            if not cache_db.query(EmbeddingCache).filter(EmbeddingCache.text_hash == text_hash).first():
-                cache_db.add(EmbeddingCache(
-                    text_hash=text_hash,
-                    original_text=texto[:2000],
-                    embedding=vector
-                ))
-        cache_db.commit()
-    except Exception as e:
-        cache_db.rollback()
-        print(f"   ⚠️ Error guardando caché batch: {e}")
-    finally:
-        cache_db.close()
+    t0 = time.perf_counter()
+    generar_vectores_concurrente(textos_sin_cache, al_completar_lote=_guardar_lote)
+    t_api = (time.perf_counter() - t0) * 1000 - t_write
     
-    print(f"   [Embedding] ✓ {len(textos_sin_cache)} embeddings generados")
+    print(
+        f"   [Embedding] ✓ {len(textos_sin_cache)} embeddings generados "
+        f"(API {t_api:.0f} ms, escritura caché {t_write:.0f} ms)"
+    )
     return resultados
+
+
+# ============================================================================
+# Mantenimiento de la caché en PostgreSQL (informe y compactación)
+# ============================================================================
+
+def informe_cache_db(db: Session) -> Dict:
+    """
+    Tamaño y tasa de aciertos de embedding_cache.
+    Cada fila nació de un fallo de caché, así que hit_rate ≈ hits / (hits + filas).
+    """
+    volcar_uso_cache()
+    fila = db.execute(text("""
+        SELECT COUNT(*) AS filas,
+               COALESCE(SUM(hit_count), 0) AS hits,
+               COUNT(*) FILTER (WHERE hit_count = 0) AS nunca_usadas,
+               COUNT(*) FILTER (WHERE original_text IS NOT NULL) AS con_texto,
+               pg_total_relation_size('embedding_cache') AS bytes
+        FROM embedding_cache
+    """)).one()
+    por_modelo = db.execute(text("""
+        SELECT COALESCE(modelo, '(sin modelo)') AS modelo, dimension, COUNT(*) AS filas
+        FROM embedding_cache GROUP BY modelo, dimension ORDER BY filas DESC
+    """)).all()
+    total = fila.hits + fila.filas
+    return {
+        "filas": fila.filas,
+        "tamano_mb": round(fila.bytes / 1024 / 1024, 1),
+        "hits": int(fila.hits),
+        "hit_rate": round(fila.hits / total, 4) if total else 0.0,
+        "nunca_usadas": fila.nunca_usadas,
+        "con_texto": fila.con_texto,
+        "por_modelo": [
+            {"modelo": m.modelo, "dimension": m.dimension, "filas": m.filas} for m in por_modelo
+        ],
+        "proceso": obtener_metricas_cache(),
+    }
+
+
+def compactar_cache(db: Session, dias_sin_uso: int = 90, min_hits: int = 1, vaciar_texto: bool = False,
+                    modelos_validos: Optional[List[str]] = None) -> Dict:
+    """
+    1. Borra entradas de otros modelos/dimensiones (inalcanzables con las claves actuales).
+       Por defecto se conservan el modelo de Azure y el local, para poder alternar proveedor.
+    2. Borra entradas frías: sin uso en `dias_sin_uso` días y con menos de `min_hits` aciertos
+    3. Opcional: vacía original_text del resto
+    """
+    volcar_uso_cache()
+    obsoletas = db.execute(
+        text("DELETE FROM embedding_cache WHERE modelo IS NULL OR modelo <> ALL(:modelos) OR dimension IS DISTINCT FROM :dim"),
+        {"modelos": modelos_validos or [EMBEDDING_DEPLOYMENT, ProveedorLocal.modelo], "dim": EMBEDDING_DIM}
+    ).rowcount
+    frias = db.execute(
+        text("""
+            DELETE FROM embedding_cache
+            WHERE COALESCE(last_used_at, created_at) < LOCALTIMESTAMP - make_interval(days => :dias)
+              AND hit_count < :min_hits
+        """),
+        {"dias": dias_sin_uso, "min_hits": min_hits}
+    ).rowcount
+    textos = 0
+    if vaciar_texto:
+        textos = db.execute(
+            text("UPDATE embedding_cache SET original_text = NULL WHERE original_text IS NOT NULL")
+        ).rowcount
+    db.commit()
+    return {"obsoletas": obsoletas, "frias": frias, "textos_vaciados": textos}
@@ -3,45 +3,345 @@ Servicio de Ingesta de Documentos — Versión Final RAG Híbrido
 - Soporte para Múltiples Libros (tabla 'libros')
 - Lista Enlazada para Navegación Secuencial
 - Chunking Token-Based
+- Pipeline en streaming: extracción → temas → chunking → embeddings → BD,
+  unidas por colas acotadas (la memoria no crece con el tamaño del libro)
+- Checkpoints por fases: una ingesta interrumpida se reanuda desde el último lote escrito
+- Mantenimiento de índices diferido: full-text por lotes sin trigger + ANALYZE al final
 """
 import json
 import os
+import re
+import hashlib
+import unicodedata
+import mmap
+import struct
+import time
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-from typing import List, Dict, Any
+from itertools import chain, islice
+from typing import List, Dict, Any, Iterable, Iterator, Tuple, Union, Callable, Optional
+import numpy as np
+from sqlalchemy import select, update, delete, func, text
 from sqlalchemy.orm import Session
 from fastapi import UploadFile
 from pypdf import PdfReader
 from io import BytesIO
 from mistralai import Mistral
 
+try:
+    import resource  # Solo Unix: pico de memoria del proceso
+except ImportError:
+    resource = None
+
 # Importamos modelos y servicios
+from app.db.database import SessionLocal
 from app.models.modelos import Temario, BaseConocimiento, Libro
-from app.crud.embedding_service import generar_embeddings_batch
-from app.crud.chunking_service import procesar_texto_tema
+from app.crud.embedding_service import generar_embeddings_batch, EMBEDDING_DIM
+from app.crud.chunking_service import procesar_temas_stream, CHUNK_SIZE, CHUNK_OVERLAP, TOKENIZER
+from app.crud.rate_limit_service import esperar, estimar_tokens_mensajes, retry_with_backoff, PROVEEDOR_MISTRAL
 
 api_key = os.getenv("MISTRAL_API_KEY")
 client = Mistral(api_key=api_key) if api_key else None
+MODELO_INDICE = "mistral-large-latest"
+
+# Tamaño de las colas entre etapas (elementos, no bytes) y de los lotes
+INGEST_COLA_PAGINAS = int(os.getenv("INGEST_COLA_PAGINAS", "32"))
+INGEST_COLA_TEMAS = int(os.getenv("INGEST_COLA_TEMAS", "4"))
+INGEST_COLA_CHUNKS = int(os.getenv("INGEST_COLA_CHUNKS", "512"))
+INGEST_COLA_LOTES = int(os.getenv("INGEST_COLA_LOTES", "2"))
+INGEST_LOTE_EMBEDDING = int(os.getenv("INGEST_LOTE_EMBEDDING", "256"))  # Chunks por llamada a generar_embeddings_batch
+INGEST_LOTE_EMBEDDING_INICIAL = int(os.getenv("INGEST_LOTE_EMBEDDING_INICIAL", "32"))  # Se duplica hasta el máximo
+PAGINAS_INDICE = 10  # Páginas iniciales donde se busca el índice (y que se envían al LLM)
+INDICE_MAX_PAGINAS = int(os.getenv("INDICE_MAX_PAGINAS", "30"))  # Índices impresos largos: hasta esta página
+INDICE_DESFASE_MAX = 40  # Máxima diferencia entre página impresa y página física del PDF
+
+# Extracción en paralelo por rangos de páginas (solo cuando el PDF está en disco)
+INGEST_PROCESOS_PDF = int(os.getenv("INGEST_PROCESOS_PDF", str(min(4, os.cpu_count() or 1))))  # 1 = sin pool
+INGEST_PAGINAS_SHARD = int(os.getenv("INGEST_PAGINAS_SHARD", "16"))
+INGEST_MIN_PAGINAS_POOL = int(os.getenv("INGEST_MIN_PAGINAS_POOL", "64"))
+
+# Escritura de base_conocimiento con COPY binario (PostgreSQL + psycopg2); 0 = ORM por lotes
+INGEST_COPY = os.getenv("INGEST_COPY", "1") == "1"
+
+# Mantenimiento diferido: sin trigger de full-text por fila durante la carga (busqueda_texto
+# se calcula en el INSERT ... SELECT de cada lote); al final se vacía la lista pendiente de
+# los GIN y se hace ANALYZE
+INGEST_FTS_DIFERIDO = os.getenv("INGEST_FTS_DIFERIDO", "1") == "1"
+INGEST_ANALYZE = os.getenv("INGEST_ANALYZE", "1") == "1"
+INDICES_GIN_CHUNKS = ("idx_base_conocimiento_fts", "idx_base_conocimiento_metadatos")
 
 # ============================================================================
 # 1. UTILIDADES DE EXTRACCIÓN PDF
 # ============================================================================
 
+def _limpiar_pagina(txt: str) -> str:
+    # Limpieza básica
+    txt = txt.replace("Python para todos", "").replace("Raúl González Duque", "")
+    return txt.strip()
+
+
+def abrir_pdf(fuente: Union[bytes, str]) -> PdfReader:
+    """Abre el PDF desde bytes o desde una ruta (la ruta evita tener el fichero entero en memoria)."""
+    return PdfReader(BytesIO(fuente) if isinstance(fuente, (bytes, bytearray)) else fuente)
+
+
+def iterar_paginas_pdf(pdf_reader: PdfReader) -> Iterator[Tuple[int, str]]:
+    """Extrae el texto página a página: (número de página desde 1, texto limpio)."""
+    for i, pag in enumerate(pdf_reader.pages, start=1):
+        yield i, _limpiar_pagina(pag.extract_text() or "")
+
+
 def extraer_texto_pdf(contenido_bytes: bytes) -> Dict[int, str]:
     """Extrae texto de todas las páginas del PDF desde bytes."""
-    pdf_file = BytesIO(contenido_bytes)
-    pdf_reader = PdfReader(pdf_file)
-    doc_completo = {}
-    for i, pag in enumerate(pdf_reader.pages, start=1):
-        txt = pag.extract_text() or ""
-        # Limpieza básica
-        txt = txt.replace("Python para todos", "").replace("Raúl González Duque", "")
-        doc_completo[i] = txt.strip()
-    return doc_completo
+    return dict(iterar_paginas_pdf(abrir_pdf(contenido_bytes)))
+
+
+class HistogramaPaginas:
+    """
+    Tiempo de CPU de extracción por página (thread_time: no se infla si los procesos compiten por CPU):
+    cubetas + las páginas más lentas, para detectar páginas patológicas.
+    """
+
+    CUBETAS = [(0.01, "<10ms"), (0.05, "10-50ms"), (0.2, "50-200ms"), (1.0, "200ms-1s"), (float("inf"), ">1s")]
+
+    def __init__(self, peores: int = 5):
+        self.conteo = {etiqueta: 0 for _, etiqueta in self.CUBETAS}
+        self.peores: List[Tuple[float, int]] = []
+        self.max_peores = peores
+        self.total = 0.0
+
+    def registrar(self, num_pagina: int, segundos: float):
+        self.total += segundos
+        for limite, etiqueta in self.CUBETAS:
+            if segundos < limite:
+                self.conteo[etiqueta] += 1
+                break
+        self.peores.append((segundos, num_pagina))
+        if len(self.peores) > self.max_peores * 4:
+            self.peores = sorted(self.peores, reverse=True)[:self.max_peores]
+
+    def resumen(self) -> Dict:
+        return {
+            "cubetas": dict(self.conteo),
+            "mas_lentas": [{"pagina": p, "ms": round(t * 1000, 1)} for t, p in sorted(self.peores, reverse=True)[:self.max_peores]],
+            "segundos_totales": round(self.total, 2),
+        }
+
+    def imprimir(self):
+        r = self.resumen()
+        print(f"    📊 Extracción por página ({r['segundos_totales']}s de CPU): "
+              + " | ".join(f"{k}: {v}" for k, v in r["cubetas"].items()))
+        print("       Más lentas: " + ", ".join(f"pág {x['pagina']} ({x['ms']} ms)" for x in r["mas_lentas"]))
+
+
+# Estado de cada proceso worker: el PDF se abre UNA vez por proceso sobre un mmap de solo lectura
+# (las páginas del fichero se comparten vía caché del SO, no se serializan los bytes).
+_pdf_worker: Optional[PdfReader] = None
+
+
+def _iniciar_worker_pdf(ruta_pdf: str):
+    global _pdf_worker
+    with open(ruta_pdf, "rb") as f:
+        mapa = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)  # Sigue válido tras cerrar el fichero
+    _pdf_worker = PdfReader(mapa)
+
+
+def _extraer_rango_worker(rango: Tuple[int, int]) -> List[Tuple[int, str, float]]:
+    """Extrae las páginas [inicio, fin] (desde 1) y devuelve (número, texto, segundos) por página."""
+    inicio, fin = rango
+    resultado = []
+    for num in range(inicio, fin + 1):
+        t0 = time.thread_time()
+        texto = _limpiar_pagina(_pdf_worker.pages[num - 1].extract_text() or "")
+        resultado.append((num, texto, time.thread_time() - t0))
+    return resultado
+
+
+def extraer_paginas(fuente: Union[bytes, str], pdf_reader: PdfReader,
+                    procesos: int = INGEST_PROCESOS_PDF) -> Iterator[Tuple[int, str]]:
+    """
+    Extrae el texto página a página EN ORDEN y registra el tiempo de CPU de cada una.
+    Si el PDF está en disco y es grande, reparte rangos de INGEST_PAGINAS_SHARD páginas
+    entre un pool de procesos (como mucho procesos*2 rangos en vuelo, memoria acotada).
+    """
+    num_paginas = len(pdf_reader.pages)
+    histograma = HistogramaPaginas()
+
+    if procesos <= 1 or not isinstance(fuente, str) or num_paginas < INGEST_MIN_PAGINAS_POOL:
+        for num, pag in enumerate(pdf_reader.pages, start=1):
+            t0 = time.thread_time()
+            texto = _limpiar_pagina(pag.extract_text() or "")
+            histograma.registrar(num, time.thread_time() - t0)
+            yield num, texto
+    else:
+        rangos = [
+            (inicio, min(inicio + INGEST_PAGINAS_SHARD - 1, num_paginas))
+            for inicio in range(1, num_paginas + 1, INGEST_PAGINAS_SHARD)
+        ]
+        print(f"    ⚙️ Extracción en {procesos} procesos ({len(rangos)} rangos de {INGEST_PAGINAS_SHARD} págs)")
+        en_vuelo = deque()
+        with ProcessPoolExecutor(max_workers=procesos, initializer=_iniciar_worker_pdf, initargs=(fuente,)) as pool:
+            try:
+                for rango in rangos:
+                    en_vuelo.append(pool.submit(_extraer_rango_worker, rango))
+                    if len(en_vuelo) >= procesos * 2:
+                        for num, texto, segundos in en_vuelo.popleft().result():
+                            histograma.registrar(num, segundos)
+                            yield num, texto
+                while en_vuelo:
+                    for num, texto, segundos in en_vuelo.popleft().result():
+                        histograma.registrar(num, segundos)
+                        yield num, texto
+            finally:
+                pool.shutdown(cancel_futures=True)
+
+    histograma.imprimir()
 
 # ============================================================================
-# 2. ANÁLISIS DE ESTRUCTURA (LLM)
+# 2. ANÁLISIS DE ESTRUCTURA (marcadores → índice impreso → LLM)
 # ============================================================================
 
+# Línea de índice: [numeración] título [puntos guía] página
+_RE_LINEA_INDICE = re.compile(
+    r"^(?P<num>(?:\d+\.)*\d+\.?\s+|(?:cap[íi]tulo|tema|parte|unidad|lecci[óo]n)\s+\w+[.:]?\s+)?"
+    r"(?P<titulo>\S.*?)"
+    r"(?:\s*(?:\.{2,}|…+|·{2,}|_{2,})\s*|\s+)"
+    r"(?P<pagina>\d{1,4})$",
+    re.IGNORECASE,
+)
+
+
+def _normalizar_titulo(texto: str) -> str:
+    """Minúsculas, sin tildes y espacios colapsados (para buscar un título en el texto de una página)."""
+    texto = unicodedata.normalize("NFKD", texto.lower())
+    return " ".join("".join(c for c in texto if not unicodedata.combining(c)).split())
+
+
+def _estructura_valida(temas: List[Dict], num_paginas: int, minimo: int) -> bool:
+    """Suficientes temas, páginas dentro del libro y (casi) siempre crecientes."""
+    if len(temas) < minimo:
+        return False
+    paginas = [t["pagina_inicio"] for t in temas]
+    if min(paginas) < 1 or max(paginas) > num_paginas:
+        return False
+    crecientes = sum(1 for a, b in zip(paginas, paginas[1:]) if b >= a)
+    return crecientes >= 0.8 * (len(paginas) - 1)
+
+
+def _estructura_marcadores(pdf_reader: PdfReader, num_paginas: int) -> List[Dict]:
+    """
+    Marcadores (outline) del PDF con la página física de su destino. Jerarquía real del
+    documento: en pypdf una lista anidada son los hijos del marcador anterior.
+    """
+    temas = []
+
+    def _recorrer(nodos, nivel):
+        for nodo in nodos:
+            if isinstance(nodo, list):
+                _recorrer(nodo, nivel + 1)
+                continue
+            try:
+                indice = pdf_reader.get_destination_page_number(nodo)
+            except Exception:
+                continue
+            titulo = " ".join(str(nodo.title or "").split())
+            if titulo and indice is not None and indice >= 0:
+                temas.append({"nombre": titulo, "nivel": nivel, "pagina_inicio": indice + 1, "orden": len(temas) + 1})
+
+    try:
+        _recorrer(pdf_reader.outline, 1)
+    except Exception as e:
+        print(f"    ⚠️ No se pudieron leer los marcadores del PDF: {e}")
+        return []
+    return temas if _estructura_valida(temas, num_paginas, minimo=2) else []
+
+
+def _lineas_indice(texto: str) -> Tuple[List[Dict], int]:
+    """Entradas de índice de una página y nº de líneas no vacías."""
+    lineas = [l.strip() for l in texto.splitlines() if l.strip()]
+    entradas = []
+    for linea in lineas:
+        m = _RE_LINEA_INDICE.match(linea)
+        if m:
+            numeracion = (m.group("num") or "").strip().rstrip(".")
+            nivel = numeracion.count(".") + 1 if numeracion[:1].isdigit() else 1
+            entradas.append({"nombre": " ".join(m.group("titulo").split()), "nivel": nivel, "pagina": int(m.group("pagina"))})
+    return entradas, len(lineas)
+
+
+def _es_pagina_indice(entradas: List[Dict], lineas: int) -> bool:
+    return len(entradas) >= 3 and len(entradas) >= 0.5 * lineas
+
+
+def _desfase_paginas(pdf_reader: PdfReader, entradas: List[Dict], paginas_indice: set, num_paginas: int) -> int:
+    """
+    Diferencia entre la página impresa del índice y la física del PDF (portada, prólogo...).
+    Primero con las etiquetas de página del PDF (/PageLabels); si no tiene, buscando el
+    título de las primeras entradas en las páginas candidatas. 0 si no se encuentra.
+    """
+    if "/PageLabels" in pdf_reader.trailer["/Root"]:
+        etiquetas = {etiqueta: i + 1 for i, etiqueta in reversed(list(enumerate(pdf_reader.page_labels)))}
+        for entrada in entradas[:3]:
+            fisica = etiquetas.get(str(entrada["pagina"]))
+            if fisica is not None:
+                return fisica - entrada["pagina"]
+
+    textos: Dict[int, str] = {}
+
+    def _texto(pagina):
+        if pagina not in textos:
+            textos[pagina] = _normalizar_titulo(pdf_reader.pages[pagina - 1].extract_text() or "")
+        return textos[pagina]
+
+    for entrada in entradas[:3]:
+        titulo = _normalizar_titulo(entrada["nombre"])
+        if len(titulo) < 4:
+            continue
+        for desfase in range(0, INDICE_DESFASE_MAX + 1):
+            pagina = entrada["pagina"] + desfase
+            if pagina > num_paginas:
+                break
+            if pagina not in paginas_indice and titulo in _texto(pagina):
+                return desfase
+    return 0
+
+
+def _estructura_indice_impreso(pdf_reader: PdfReader, paginas: List[Tuple[int, str]], num_paginas: int) -> List[Dict]:
+    """
+    Índice impreso reconocido con expresiones regulares: páginas donde la mayoría de
+    líneas son "título ... página". Si el índice sigue en la última página recibida se
+    leen más (hasta INDICE_MAX_PAGINAS). El nivel sale de la numeración (1.2 → nivel 2).
+    """
+    textos = dict(paginas)
+    entradas: List[Dict] = []
+    paginas_indice = set()
+    pagina = min(textos) if textos else 1
+    while pagina <= min(num_paginas, INDICE_MAX_PAGINAS):
+        if pagina not in textos:
+            if not paginas_indice:
+                break  # El índice no empieza en las primeras páginas
+            textos[pagina] = _limpiar_pagina(pdf_reader.pages[pagina - 1].extract_text() or "")
+        encontradas, lineas = _lineas_indice(textos[pagina])
+        if _es_pagina_indice(encontradas, lineas):
+            entradas.extend(encontradas)
+            paginas_indice.add(pagina)
+        elif paginas_indice:
+            break  # Fin del índice
+        pagina += 1
+    if not entradas:
+        return []
+
+    desfase = _desfase_paginas(pdf_reader, entradas, paginas_indice, num_paginas)
+    temas = [
+        {"nombre": e["nombre"], "nivel": e["nivel"], "pagina_inicio": e["pagina"] + desfase, "orden": i + 1}
+        for i, e in enumerate(entradas)
+    ]
+    return temas if _estructura_valida(temas, num_paginas, minimo=3) else []
+
+
 def generar_estructura_temario(texto_indice: str) -> List[Dict]:
     """Usa Mistral para entender la jerarquía del índice."""
     if not client:
@@ -68,302 +368,1195 @@ def generar_estructura_temario(texto_indice: str) -> List[Dict]:
     }
     """
     
-    try:
-        response = client.chat.complete(
-            model="mistral-large-latest",
-            messages=[
-                {"role": "system", "content": prompt}, 
-                {"role": "user", "content": f"ÍNDICE:\n{texto_indice}"}
-            ],
+    messages = [
+        {"role": "system", "content": prompt}, 
+        {"role": "user", "content": f"ÍNDICE:\n{texto_indice}"}
+    ]
+    
+    @retry_with_backoff(PROVEEDOR_MISTRAL, MODELO_INDICE)
+    def _llamar():
+        esperar(PROVEEDOR_MISTRAL, MODELO_INDICE, estimar_tokens_mensajes(messages))
+        return client.chat.complete(
+            model=MODELO_INDICE,
+            messages=messages,
             response_format={"type": "json_object"}
         )
+    
+    try:
+        response = _llamar()
         data = json.loads(response.choices[0].message.content)
         return data.get("temas", [])
     except Exception as e:
         print(f"Error analizando índice: {e}")
         return []
 
+
+def extraer_estructura(archivo: Union[bytes, str], paginas: List[Tuple[int, str]]) -> Tuple[List[Dict], str]:
+    """
+    Estructura del temario, de la vía más barata a la más cara:
+    1. Marcadores del PDF (páginas físicas exactas, jerarquía del documento)
+    2. Índice impreso con heurísticas (aunque ocupe más de PAGINAS_INDICE páginas)
+    3. LLM con el texto de las primeras páginas
+    4. Un único tema con todo el libro
+    `paginas` son las primeras páginas ya extraídas. Usa su propio PdfReader: el de la
+    extracción puede estar leyendo en otro hilo. Devuelve (temas, vía usada).
+    """
+    pdf_reader = abrir_pdf(archivo)
+    num_paginas = len(pdf_reader.pages)
+    vias = (
+        ("marcadores", lambda: _estructura_marcadores(pdf_reader, num_paginas)),
+        ("indice", lambda: _estructura_indice_impreso(pdf_reader, paginas, num_paginas)),
+        ("llm", lambda: generar_estructura_temario("\n".join(texto for _, texto in paginas))),
+    )
+    for via, extraer in vias:
+        t0 = time.perf_counter()
+        try:
+            temas = extraer()
+        except Exception as e:
+            print(f"    ⚠️ Error en la vía '{via}' de estructura: {e}")
+            temas = []
+        segundos = time.perf_counter() - t0
+        if temas:
+            print(f"    📑 Estructura por '{via}': {len(temas)} temas en {segundos:.2f}s")
+            return temas, via
+        print(f"    … Vía '{via}' sin resultado ({segundos:.2f}s)")
+
+    print("    Original index not found. Creating default structure.")
+    return [{"nombre": "Contenido Completo", "nivel": 1, "pagina_inicio": 1, "orden": 1}], "defecto"
+
+# ============================================================================
+# 3. PIPELINE POR ETAPAS (colas acotadas)
+# ============================================================================
+
+_FIN = object()  # Marca de fin de una cola
+
+
+class _ControlPipeline:
+    """
+    Coordina los hilos de las etapas. Cada etapa lee de una cola acotada y escribe en
+    la siguiente: si la de salida está llena, la etapa espera (backpressure).
+    El primer error cancela todo el pipeline y se relanza en el hilo principal.
+    Por etapa se anota además el tiempo "ocupado": el que pasa produciendo, sin contar
+    lo que espera a la etapa anterior (las etapas se solapan, así se ve cuál limita).
+    """
+
+    def __init__(self):
+        self.cancelado = threading.Event()
+        self.error: Optional[BaseException] = None
+        self.hilos: List[threading.Thread] = []
+        self.t0 = time.perf_counter()
+        self.tiempos: Dict[str, Dict[str, float]] = {}
+        self.esperas: Dict[int, float] = {}  # Por hilo: segundos bloqueado leyendo de una cola
+
+    def _marcar(self, etapa: str, evento: str):
+        self.tiempos.setdefault(etapa, {}).setdefault(evento, round(time.perf_counter() - self.t0, 2))
+
+    def poner(self, cola: queue.Queue, item) -> bool:
+        while not self.cancelado.is_set():
+            try:
+                cola.put(item, timeout=0.2)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def consumir(self, cola: queue.Queue, limite: Optional[int] = None) -> Iterator:
+        hilo = threading.get_ident()
+        recibidos = 0
+        while limite is None or recibidos < limite:
+            t0 = time.perf_counter()
+            try:
+                item = cola.get(timeout=0.2)
+            except queue.Empty:
+                if self.cancelado.is_set():
+                    return
+                continue
+            finally:
+                self.esperas[hilo] = self.esperas.get(hilo, 0.0) + time.perf_counter() - t0
+            if item is _FIN:
+                return
+            recibidos += 1
+            yield item
+
+    def lanzar(self, etapa: str, productor: Callable[[], Iterable], salida: queue.Queue):
+        """Ejecuta `productor()` en un hilo y vuelca lo que genera en `salida`, terminando con _FIN."""
+        def _ejecutar():
+            self._marcar(etapa, "inicio")
+            hilo = threading.get_ident()
+            ocupado = 0.0
+            try:
+                iterador = iter(productor())
+                while True:
+                    t0, espera0 = time.perf_counter(), self.esperas.get(hilo, 0.0)
+                    try:
+                        item = next(iterador)
+                    except StopIteration:
+                        break
+                    finally:
+                        ocupado += time.perf_counter() - t0 - (self.esperas.get(hilo, 0.0) - espera0)
+                    self._marcar(etapa, "primer_resultado")
+                    if not self.poner(salida, item):
+                        return
+                self._marcar(etapa, "fin")
+                self.poner(salida, _FIN)
+            except BaseException as e:
+                if self.error is None:
+                    self.error = e
+                print(f"    ❌ Error en etapa '{etapa}': {e}")
+                self.cancelado.set()
+            finally:
+                self.tiempos.setdefault(etapa, {})["ocupado"] = round(ocupado, 2)
+
+        hilo = threading.Thread(target=_ejecutar, name=f"ingesta-{etapa}", daemon=True)
+        hilo.start()
+        self.hilos.append(hilo)
+
+    def cancelar(self):
+        self.cancelado.set()
+
+    def terminar(self):
+        """Espera a todas las etapas y relanza el primer error que haya habido."""
+        for hilo in self.hilos:
+            hilo.join()
+        if self.error is not None:
+            raise self.error
+
+
+def _rangos_temas(temas_struct: List[Dict], num_paginas: int) -> List[Tuple[int, int]]:
+    """(página inicio, página fin) de cada tema: hasta el inicio del siguiente o el final del libro."""
+    rangos = []
+    for i, tema in enumerate(temas_struct):
+        pag_inicio = tema.get("pagina_inicio", 1)
+        if i < len(temas_struct) - 1:
+            pag_fin = temas_struct[i + 1].get("pagina_inicio", num_paginas + 1) - 1
+        else:
+            pag_fin = num_paginas
+        rangos.append((pag_inicio, max(pag_inicio, pag_fin)))  # Evitar rangos negativos
+    return rangos
+
+
+def _ensamblar_temas(paginas: Iterable[Tuple[int, str]], temas_struct: List[Dict],
+                     num_paginas: int) -> Iterator[Tuple[int, str]]:
+    """
+    Monta el texto de cada tema según llegan las páginas y lo emite en orden de temario.
+    Solo retiene las páginas que todavía necesita algún tema pendiente.
+    """
+    rangos = _rangos_temas(temas_struct, num_paginas)
+    # primera_necesaria[i] = página más baja que usan los temas i, i+1, ...
+    primera_necesaria = [float("inf")] * (len(rangos) + 1)
+    for i in range(len(rangos) - 1, -1, -1):
+        primera_necesaria[i] = min(rangos[i][0], primera_necesaria[i + 1])
+
+    paginas_retenidas: Dict[int, str] = {}
+    siguiente = 0
+
+    def _temas_completos(ultima_pagina):
+        nonlocal siguiente
+        while siguiente < len(rangos) and min(rangos[siguiente][1], num_paginas) <= ultima_pagina:
+            pag_inicio, pag_fin = rangos[siguiente]
+            texto_tema = "\n".join(
+                paginas_retenidas.get(p, "") for p in range(pag_inicio, min(pag_fin, num_paginas) + 1)
+            ) + "\n"
+            indice = siguiente
+            siguiente += 1
+            for p in [p for p in paginas_retenidas if p < primera_necesaria[siguiente]]:
+                del paginas_retenidas[p]
+            if texto_tema.strip():
+                yield indice, texto_tema
+
+    for num_pagina, texto in paginas:
+        if num_pagina >= primera_necesaria[siguiente]:
+            paginas_retenidas[num_pagina] = texto
+        yield from _temas_completos(num_pagina)
+    yield from _temas_completos(float("inf"))
+
+
+def _fragmentar_temas(temas_listos: Iterable[Tuple[int, str]], temas_struct: List[Dict],
+                      temario_ids: List[int], estadisticas: Dict) -> Iterator[Dict]:
+    """Chunking + detección de tipo por tema (en orden). Emite un dict ligero por chunk."""
+    pendientes = deque()
+
+    def _tareas():
+        for i, texto_tema in temas_listos:
+            tema = temas_struct[i]
+            pendientes.append(i)
+            yield (texto_tema, tema["nombre"], tema.get("nivel", 1), tema.get("orden", 1),
+                   tema.get("pagina_inicio", 1), "")
+
+    for bloques, cpu_tema in procesar_temas_stream(_tareas()):
+        i = pendientes.popleft()
+        estadisticas["chunking_cpu"] += cpu_tema
+        tema = temas_struct[i]
+        print(f"    ... Procesando tema {i+1}/{len(temas_struct)} ({tema['nombre']})...")
+        pag_inicio = tema.get("pagina_inicio", 1)
+        for j, bloque in enumerate(bloques):
+            yield {
+                "tema": i,
+                "avance": (i + (j + 1) / len(bloques)) / len(temas_struct),  # Fracción del libro (también dentro del tema)
+                "temario_id": temario_ids[i],
+                "contenido": bloque["contenido"],
+                "tipo": bloque["tipo"],  # 'texto' o 'codigo'
+                "pagina": pag_inicio,  # Aproximado
+                "metadata": {"titulo_tema": tema["nombre"], **bloque["metadata"]},
+            }
+
+
+def _embeber_lotes(chunks: Iterable[Dict], temas_struct: List[Dict]) -> Iterator[Tuple[List[Dict], List[np.ndarray]]]:
+    """
+    Agrupa chunks en lotes y genera sus embeddings (sesión propia: la del hilo principal escribe).
+    El primer lote es pequeño para que los embeddings empiecen mientras se sigue extrayendo;
+    después el tamaño se duplica hasta INGEST_LOTE_EMBEDDING.
+    """
+    db_embeddings = SessionLocal()
+    tam_lote = min(INGEST_LOTE_EMBEDDING_INICIAL, INGEST_LOTE_EMBEDDING)
+    try:
+        lote = []
+        for chunk in chain(chunks, [None]):
+            if chunk is not None:
+                lote.append(chunk)
+            if lote and (chunk is None or len(lote) >= tam_lote):
+                # Texto para embedding: Contextualizado
+                textos = [f"[{temas_struct[c['tema']]['nombre']}]: {c['contenido']}" for c in lote]
+                vectores = generar_embeddings_batch(db_embeddings, textos)
+                yield lote, [None if v is None else np.asarray(v, dtype=np.float32) for v in vectores]
+                lote = []
+                tam_lote = min(tam_lote * 2, INGEST_LOTE_EMBEDDING)
+    finally:
+        db_embeddings.close()
+
+
+def _validar_vectores(vectores: List[Optional[np.ndarray]], primer_orden: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Apila los vectores del lote en una matriz float32 y marca los válidos.
+    Vacíos, de otra dimensión, con NaN o todo ceros (la distancia coseno daría NaN)
+    se guardan SIN embedding: el chunk sigue en la lista enlazada y en el full-text.
+    """
+    matriz = np.zeros((len(vectores), EMBEDDING_DIM), dtype=np.float32)
+    validos = np.zeros(len(vectores), dtype=bool)
+    for i, vec in enumerate(vectores):
+        if vec is not None and vec.shape == (EMBEDDING_DIM,):
+            matriz[i] = vec
+            validos[i] = True
+    validos &= ~np.isnan(matriz).any(axis=1)
+    validos &= np.any(matriz != 0, axis=1)
+    for i in np.flatnonzero(~validos):
+        print(f"    ⚠️ Embedding vacío, cero o con NaN en chunk {primer_orden + i}. Se guarda sin embedding.")
+    return matriz, validos
+
+
+def _guardar_lote_chunks(db: Session, lote: List[Dict], vectores: List[np.ndarray], estado: Dict) -> int:
+    """
+    Inserta un lote de chunks, lo enlaza con el anterior (lista enlazada) y hace commit.
+    Si el lote falla se reintenta fila a fila con savepoints, saltando las filas corruptas.
+    Tras el commit no se guarda ninguna referencia: solo el id del último chunk.
+    El checkpoint del lote (si hay) va en la misma transacción.
+    """
+    matriz, validos = _validar_vectores(vectores, estado["orden"] + 1)
+    objetos = []
+    for i, chunk in enumerate(lote):
+        estado["orden"] += 1
+        objetos.append(BaseConocimiento(
+            temario_id=chunk["temario_id"],
+            contenido=chunk["contenido"],
+            tipo_contenido=chunk["tipo"],
+            pagina=chunk["pagina"],
+            ref_fuente=f"Pág {chunk['pagina']}",
+            metadata_info=chunk["metadata"],
+            embedding=matriz[i] if validos[i] else None,
+            orden_aparicion=estado["orden"],
+        ))
+
+    try:
+        db.add_all(objetos)
+        db.flush()
+        guardados = objetos
+    except Exception as e:
+        print(f"       ⚠️ Error en Batch Flush (orden {objetos[0].orden_aparicion}-{objetos[-1].orden_aparicion}): {e}. Trying Row-by-Row...")
+        db.rollback()
+        guardados = []
+        for c in objetos:
+            try:
+                with db.begin_nested():
+                    db.add(c)
+            except Exception as e_row:
+                print(f"       ❌ Skipping Chunk Corrupto (orden {c.orden_aparicion}): {e_row}")
+                continue
+            guardados.append(c)
+
+    if not guardados:
+        _checkpoint_lote(db, estado, estado["orden"], estado["ultimo_id"])
+        db.commit()
+        return 0
+
+    # Enlaces (Anterior / Siguiente): dentro del lote y con el último chunk del lote anterior
+    anterior_id = estado["ultimo_id"]
+    if anterior_id is not None:
+        db.execute(
+            update(BaseConocimiento)
+            .where(BaseConocimiento.id == anterior_id)
+            .values(chunk_siguiente_id=guardados[0].id)
+        )
+    for c in guardados:
+        c.chunk_anterior_id = anterior_id
+        anterior_id = c.id
+    for c, siguiente in zip(guardados, guardados[1:]):
+        c.chunk_siguiente_id = siguiente.id
+    estado["ultimo_id"] = anterior_id
+    _checkpoint_lote(db, estado, estado["orden"], anterior_id)
+    db.commit()
+    return len(guardados)
+
+
+# --- Escritura masiva con COPY binario ---
+
+# busqueda_texto no va en el COPY: la rellena el trigger BEFORE INSERT o, con
+# INGEST_FTS_DIFERIDO, el INSERT ... SELECT desde la tabla de carga
+_COLUMNAS_COPY = (
+    "id", "temario_id", "contenido", "tipo_contenido", "ref_fuente", "pagina", "orden_aparicion",
+    "chunk_anterior_id", "chunk_siguiente_id", "embedding", "metadatos",
+)
+_COPY_CABECERA = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)  # Firma + flags + extensión
+_COPY_FIN = struct.pack(">h", -1)
+_COPY_NULL = struct.pack(">i", -1)
+_COPY_FILA = struct.pack(">h", len(_COLUMNAS_COPY))
+# Formato binario de pgvector (vector_recv): int16 dimensión, int16 sin uso, float4 big-endian
+_COPY_VECTOR = struct.pack(">ihh", 4 + 4 * EMBEDDING_DIM, EMBEDDING_DIM, 0)
+
+
+def _copy_texto(valor: Optional[str]) -> bytes:
+    if valor is None:
+        return _COPY_NULL
+    datos = valor.replace("\x00", "").encode("utf-8")  # PostgreSQL no admite NUL en TEXT
+    return struct.pack(">i", len(datos)) + datos
+
+
+def _copy_int4(valor: Optional[int]) -> bytes:
+    return _COPY_NULL if valor is None else struct.pack(">ii", 4, valor)
+
+
+def _copy_int8(valor: Optional[int]) -> bytes:
+    return _COPY_NULL if valor is None else struct.pack(">iq", 8, valor)
+
+
+def _copy_jsonb(valor: Dict) -> bytes:
+    datos = b"\x01" + json.dumps(valor, ensure_ascii=False).encode("utf-8")  # Byte de versión de jsonb
+    return struct.pack(">i", len(datos)) + datos
+
+
+# Tabla temporal sin índices ni triggers (por conexión; se vacía en cada commit)
+_SQL_TABLA_CARGA = (
+    "CREATE TEMP TABLE IF NOT EXISTS carga_chunks "
+    "(LIKE base_conocimiento INCLUDING DEFAULTS) ON COMMIT DELETE ROWS"
+)
+_SQL_VOLCAR_CARGA = f"""
+    INSERT INTO base_conocimiento ({', '.join(_COLUMNAS_COPY)}, busqueda_texto)
+    SELECT {', '.join(_COLUMNAS_COPY)},
+           setweight(to_tsvector('spanish', unaccent(COALESCE(contenido, ''))), 'A')
+    FROM carga_chunks
+"""
+
+
+def _reservar_ids(db: Session, n: int) -> List[int]:
+    """Reserva n ids de la secuencia de base_conocimiento en una sola consulta."""
+    filas = db.execute(
+        text("SELECT nextval(pg_get_serial_sequence('base_conocimiento', 'id')) FROM generate_series(1, :n)"),
+        {"n": n},
+    )
+    return [fila[0] for fila in filas]
+
+
+def _guardar_lote_copy(db: Session, lote: List[Dict], vectores: List[np.ndarray], estado: Dict) -> int:
+    """
+    Escribe un lote con un único COPY binario:
+    1. Reserva los ids de la secuencia (nextval + generate_series)
+    2. Calcula en memoria los enlaces anterior/siguiente (el primero apunta al último del lote previo)
+    3. Valida los vectores con NumPy y serializa las filas (pgvector y jsonb en binario)
+    4. COPY + un UPDATE para enlazar el último chunk del lote anterior + checkpoint, y commit
+    Con estado["fts_diferido"] el COPY va a una tabla temporal y pasa a base_conocimiento
+    con un INSERT ... SELECT que calcula busqueda_texto para todo el lote (sin trigger por
+    fila y con una sola versión de cada fila: rellenarlo después con un UPDATE duplicaría
+    las inserciones en el HNSW).
+    Si algo falla se deshace el lote y se escribe con el ORM (fallback fila a fila incluido).
+    """
+    n = len(lote)
+    primer_orden = estado["orden"] + 1
+    try:
+        _diferir_fts(db, estado)
+        ids = _reservar_ids(db, n)
+        matriz, validos = _validar_vectores(vectores, primer_orden)
+        vectores_be = matriz.astype(">f4")
+        anterior_id = estado["ultimo_id"]
+
+        buffer = bytearray(_COPY_CABECERA)
+        for i, chunk in enumerate(lote):
+            buffer += _COPY_FILA
+            buffer += _copy_int8(ids[i])
+            buffer += _copy_int4(chunk["temario_id"])
+            buffer += _copy_texto(chunk["contenido"])
+            buffer += _copy_texto(chunk["tipo"])
+            buffer += _copy_texto(f"Pág {chunk['pagina']}")
+            buffer += _copy_int4(chunk["pagina"])
+            buffer += _copy_int4(primer_orden + i)
+            buffer += _copy_int8(ids[i - 1] if i > 0 else anterior_id)
+            buffer += _copy_int8(ids[i + 1] if i < n - 1 else None)
+            if validos[i]:
+                buffer += _COPY_VECTOR
+                buffer += vectores_be[i].tobytes()
+            else:
+                buffer += _COPY_NULL
+            buffer += _copy_jsonb(chunk["metadata"])
+        buffer += _COPY_FIN
+
+        conexion = db.connection().connection  # Conexión psycopg2 de la transacción de la sesión
+        with conexion.cursor() as cursor:
+            if estado.get("fts_diferido"):
+                cursor.execute(_SQL_TABLA_CARGA)
+                cursor.copy_expert(
+                    f"COPY carga_chunks ({', '.join(_COLUMNAS_COPY)}) FROM STDIN WITH (FORMAT binary)",
+                    BytesIO(buffer),
+                )
+                cursor.execute(_SQL_VOLCAR_CARGA)
+            else:
+                cursor.copy_expert(
+                    f"COPY base_conocimiento ({', '.join(_COLUMNAS_COPY)}) FROM STDIN WITH (FORMAT binary)",
+                    BytesIO(buffer),
+                )
+        if anterior_id is not None:
+            db.execute(
+                update(BaseConocimiento)
+                .where(BaseConocimiento.id == anterior_id)
+                .values(chunk_siguiente_id=ids[0])
+            )
+        _checkpoint_lote(db, estado, primer_orden + n - 1, ids[-1])
+        db.commit()
+    except Exception as e:
+        print(f"       ⚠️ Error en COPY (orden {primer_orden}-{primer_orden + n - 1}): {e}. Usando ORM...")
+        db.rollback()
+        return _guardar_lote_chunks(db, lote, vectores, estado)
+
+    estado["orden"] += n
+    estado["ultimo_id"] = ids[-1]
+    return n
+
+
+# --- Checkpoints (ingesta reanudable) ---
+
+FASE_LIBRO = "libro"              # Libro creado
+FASE_ESTRUCTURA = "estructurado"  # Índice analizado y temario guardado (inactivo)
+FASE_EMBEBIDO = "embebido"        # Los primeros N chunks escritos con embedding y enlazados
+FASE_ENLAZADO = "enlazado"        # Lista completa y temario activado: ingesta terminada
+
+
+class CheckpointIngesta:
+    """
+    Dónde guarda la ingesta lo que ya ha completado, para poder reanudarla.
+    `guardar` se llama dentro de la transacción de cada fase, antes de su commit: el
+    checkpoint y los datos que describe se confirman juntos o no se confirma ninguno.
+    Esta base no guarda nada (llamadas directas, sin reanudación); la cola de trabajos
+    usa job_service.CheckpointJob, que lo guarda en la fila de ingest_jobs.
+    """
+
+    def cargar(self) -> Dict:
+        return {}
+
+    def guardar(self, db: Session, fase: str, **datos) -> None:
+        pass
+
+
+def _checkpoint_lote(db: Session, estado: Dict, orden: int, ultimo_id: Optional[int]):
+    checkpoint = estado.get("checkpoint")
+    if checkpoint is not None:
+        checkpoint.guardar(db, FASE_EMBEBIDO, chunks=orden, ultimo_id=ultimo_id)
+
+
+def _huella_ingesta(archivo: Union[bytes, str], pdf_sha256: Optional[str] = None) -> str:
+    """
+    SHA-256 del PDF y de los parámetros de chunking. El chunking es determinista, así
+    que con la misma huella los chunks se regeneran idénticos y se puede saltar los ya
+    escritos; si cambia, los escritos no sirven. Si ya se conoce el hash del PDF
+    (almacén de blob_service) no se vuelve a leer el fichero.
+    """
+    h = hashlib.sha256()
+    if pdf_sha256:
+        h.update(pdf_sha256.encode())
+    elif isinstance(archivo, (bytes, bytearray)):
+        h.update(archivo)
+    else:
+        with open(archivo, "rb") as f:
+            for bloque in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(bloque)
+    h.update(f"|{CHUNK_SIZE}|{CHUNK_OVERLAP}|{getattr(TOKENIZER, 'name', 'caracteres')}".encode())
+    return h.hexdigest()
+
+
+def _descartar_chunks(db: Session, temario_ids: List[int]) -> int:
+    """Borra los chunks de un checkpoint que ya no sirve (un solo DELETE: los enlaces entre ellos se van juntos)."""
+    return db.execute(delete(BaseConocimiento).where(BaseConocimiento.temario_id.in_(temario_ids))).rowcount
+
+
+def _contar_chunks(db: Session, temario_ids: List[int]) -> int:
+    return db.query(func.count(BaseConocimiento.id)).filter(BaseConocimiento.temario_id.in_(temario_ids)).scalar()
+
+
+def _usar_copy(db: Session) -> bool:
+    return INGEST_COPY and db.get_bind().dialect.driver == "psycopg2"
+
+
+# --- Mantenimiento de índices diferido ---
+
+def _diferir_fts(db: Session, estado: Dict):
+    """Desactiva el trigger de full-text solo en la transacción del lote (SET LOCAL: se va con el commit)."""
+    if estado.get("fts_diferido"):
+        db.execute(text("SELECT set_config('tutor.fts_diferido', 'on', true)"))
+
+
+def _rellenar_fts(db: Session, temario_ids: List[int]) -> int:
+    """
+    Red de seguridad: busqueda_texto de los chunks que lo tengan vacío (p. ej. escritos
+    por una versión anterior sin trigger), en un solo UPDATE. Normalmente no toca ninguna fila.
+    No hace commit.
+    """
+    return db.execute(
+        text("""
+            UPDATE base_conocimiento
+            SET busqueda_texto = setweight(to_tsvector('spanish', unaccent(COALESCE(contenido, ''))), 'A')
+            WHERE temario_id = ANY(CAST(:temas AS integer[])) AND busqueda_texto IS NULL
+        """),
+        {"temas": temario_ids},
+    ).rowcount
+
+
+def _mantenimiento_indices(db: Session) -> Dict[str, float]:
+    """
+    Tras la carga (ya confirmada): vuelca la lista pendiente de los índices GIN
+    (fastupdate) para que la primera búsqueda no la pague, y ANALYZE para que el
+    planificador vea las filas nuevas. El HNSW se mantiene fila a fila: la tabla es
+    compartida por todos los libros y no se puede reconstruir en cada ingesta (para
+    cargas masivas, ver scripts/reconstruir_indices.py). Devuelve segundos por paso.
+    """
+    tiempos = {}
+    t0 = time.perf_counter()
+    for indice in INDICES_GIN_CHUNKS:
+        try:
+            with db.begin_nested():
+                db.execute(text("SELECT gin_clean_pending_list(CAST(:indice AS regclass))"), {"indice": indice})
+        except Exception as e:
+            print(f"    ⚠️ No se pudo vaciar la lista pendiente de {indice}: {e}")
+    db.commit()
+    tiempos["indices_gin"] = round(time.perf_counter() - t0, 3)
+    if INGEST_ANALYZE:
+        t0 = time.perf_counter()
+        db.execute(text("ANALYZE base_conocimiento"))
+        db.commit()
+        tiempos["analyze"] = round(time.perf_counter() - t0, 3)
+    return tiempos
+
+
+def _pico_memoria_mb() -> Optional[float]:
+    if resource is None:
+        return None
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)  # Linux: KB
+
 # ============================================================================
-# 3. PROCESO PRINCIPAL
+# 4. PROCESO PRINCIPAL
 # ============================================================================
 
-def procesar_archivo_temario(db: Session, archivo_bytes: bytes, filename: str, account_id: str, progress_callback=None, titulo: str = None, licencia_id: int = None):
+def procesar_archivo_temario(db: Session, archivo: Union[bytes, str], filename: str, account_id: str, progress_callback=None, titulo: str = None, licencia_id: int = None,
+                             checkpoint: Optional[CheckpointIngesta] = None, pdf_sha256: Optional[str] = None):
     """
     Flujo completo de ingestión con soporte para Libros y Lista Enlazada.
+    `archivo` puede ser la ruta del PDF (recomendado: no se carga entero en memoria) o sus bytes.
+    Con la ruta del almacén de PDFs y su `pdf_sha256`, el libro queda apuntando al blob.
+
+    Las etapas corren a la vez, unidas por colas acotadas:
+        extracción → montaje de temas → chunking → lotes de embeddings → BD (hilo actual)
+    así los embeddings empiezan mientras aún se extraen páginas y solo hay en memoria
+    unos pocos lotes en vuelo, sea cual sea el tamaño del libro.
+
+    Con `checkpoint` cada fase confirmada queda registrada (libro, estructura, cada lote
+    escrito, enlazado). Si la ingesta se relanza tras una caída se reutilizan el libro y
+    el temario, no se vuelve a llamar al LLM del índice y se saltan los chunks ya
+    escritos antes de pedir embeddings: solo se piden los que faltan. El temario queda
+    inactivo (invisible para el RAG) hasta la última fase.
     """
     print("\n" + "="*80)
     print(f"PROCESANDO LIBRO: {filename}")
     print("="*80 + "\n")
-    
-    # 1. Crear registro de Libro
+
+    checkpoint = checkpoint or CheckpointIngesta()
+    previo = checkpoint.cargar()
+
+    # 1. Crear registro de Libro (o reutilizar el del checkpoint)
     if progress_callback: progress_callback("Creando registro de libro...", 5)
-    
+
     # Determinar título final
     titulo_libro = titulo if titulo and titulo.strip() else filename.replace(".pdf", "")
-    
+
     try:
-        print(" -> 1. Creando registro de LIBRO...")
-        libro = Libro(
-            titulo=titulo_libro,
-            descripcion=f"Subido el {datetime.now().strftime('%Y-%m-%d %H:%M')}",
-            pdf_path=f"uploads/{account_id}/{filename}",
-            activo=True,
-            licencia_id=licencia_id
-        )
-        db.add(libro)
-        db.commit() # COMMIT INMEDIATO para asegurar que el libro existe
-        db.refresh(libro)
-        print(f"    ✅ [Libro ID: {libro.id}] Creado y commiteado exitosamente.")
+        huella = _huella_ingesta(archivo, pdf_sha256)
+        libro = db.get(Libro, previo["libro_id"]) if previo.get("libro_id") else None
+        if libro is not None:
+            libro_id = libro.id
+            print(f" -> 1. ♻️ Reanudando LIBRO {libro_id} desde la fase '{previo.get('fase')}' "
+                  f"({previo.get('chunks', 0)} chunks ya escritos)")
+            if previo.get("temario_ids") and previo.get("huella") != huella:
+                print("    ⚠️ El PDF o el chunking cambiaron desde el checkpoint: se descartan los chunks escritos.")
+                _descartar_chunks(db, previo["temario_ids"])
+                previo.update(chunks=0, ultimo_id=None)
+                checkpoint.guardar(db, FASE_ESTRUCTURA, huella=huella, chunks=0, ultimo_id=None)
+                db.commit()
+        else:
+            previo = {}
+            print(" -> 1. Creando registro de LIBRO...")
+            libro = Libro(
+                titulo=titulo_libro,
+                descripcion=f"Subido el {datetime.now().strftime('%Y-%m-%d %H:%M')}",
+                pdf_path=archivo if isinstance(archivo, str) else f"uploads/{account_id}/{filename}",
+                pdf_sha256=pdf_sha256,
+                activo=True,
+                licencia_id=licencia_id
+            )
+            db.add(libro)
+            db.flush()
+            checkpoint.guardar(db, FASE_LIBRO, libro_id=libro.id, huella=huella)
+            db.commit() # COMMIT INMEDIATO para asegurar que el libro existe
+            db.refresh(libro)
+            libro_id = libro.id
+            print(f"    ✅ [Libro ID: {libro_id}] Creado y commiteado exitosamente.")
     except Exception as e:
+        db.rollback()
         print(f"    ❌ ERROR creando libro: {e}")
         return {"error": str(e)}
 
-    # 2. Extraer texto
+    if previo.get("fase") == FASE_ENLAZADO:
+        # La caída fue después del último commit: no queda nada por hacer
+        print("    ✅ La ingesta ya estaba completa.")
+        return {
+            "mensaje": "Libro procesado correctamente",
+            "libro_id": libro_id,
+            "bloques": _contar_chunks(db, previo["temario_ids"]),
+            "reanudado": True,
+        }
+
+    # 2. Abrir el PDF y arrancar la extracción en segundo plano
     try:
-        print(" -> 2. Extrayendo texto del PDF...")
-        doc_completo = extraer_texto_pdf(archivo_bytes)
-        num_paginas = len(doc_completo)
-        print(f"    ✅ {num_paginas} páginas extraídas.")
+        print(" -> 2. Extrayendo texto del PDF (streaming)...")
+        pdf_reader = abrir_pdf(archivo)
+        num_paginas = len(pdf_reader.pages)
+        print(f"    ✅ {num_paginas} páginas a extraer.")
     except Exception as e:
         print(f"    ❌ ERROR extrayendo texto: {e}")
         return {"error": str(e)}
-    
+
     if num_paginas == 0:
         print("    ⚠️ PDF vacío o ilegible.")
         return {"error": "PDF vacío"}
 
+    control = _ControlPipeline()
+    cola_paginas = queue.Queue(maxsize=INGEST_COLA_PAGINAS)
+    cola_temas = queue.Queue(maxsize=INGEST_COLA_TEMAS)
+    cola_chunks = queue.Queue(maxsize=INGEST_COLA_CHUNKS)
+    cola_lotes = queue.Queue(maxsize=INGEST_COLA_LOTES)
+    control.lanzar("extraccion", lambda: extraer_paginas(archivo, pdf_reader), cola_paginas)
+
     try:
-        # 3. Analizar índice (primeras 10 págs)
-        print(" -> 3. Analizando estructura del índice...")
-        texto_indice = "\n".join([doc_completo.get(i, "") for i in range(1, min(11, num_paginas))])
-        try:
-            temas_struct = generar_estructura_temario(texto_indice)
-        except Exception as e:
-            print(f"    ⚠️ Error en Mistral (Índice): {e}. Usando estructura por defecto.")
-            temas_struct = []
-        
-        if not temas_struct:
-            print("    Original index not found via AI. Creating default structure.")
-            temas_struct = [{"nombre": "Contenido Completo", "nivel": 1, "pagina_inicio": 1, "orden": 1}]
-            
-        if progress_callback: progress_callback("Estructura analizada. Guardando...", 10)
-
-        # 4. Guardar Temario en BD
-        print(" -> 4. Guardando estructura del TEMARIO...")
-        mapa_temario = {} # indice_lista -> objeto_db
-        
-        for i, t in enumerate(temas_struct):
-            # Determinar padre (si nivel > 1, buscar el último de nivel-1)
-            parent_id = None
-            if t.get("nivel", 1) > 1:
-                # Buscar hacia atrás el primer tema con nivel menor
-                for prev_idx in range(i - 1, -1, -1):
-                    if temas_struct[prev_idx].get("nivel", 1) < t.get("nivel", 1):
-                        parent_id = mapa_temario[prev_idx].id
-                        break
-            
-            nombre_tema = t["nombre"]
-            if len(nombre_tema) > 250:
-                nombre_tema = nombre_tema[:250] + "..."
-                
-            nuevo_tema = Temario(
-                libro_id=libro.id,
-                parent_id=parent_id,
-                nombre=nombre_tema,
-                nivel=t.get("nivel", 1),
-                orden=i + 1,
-                pagina_inicio=t.get("pagina_inicio", 1),
-                activo=True
-            )
-            db.add(nuevo_tema)
-            db.flush()
-            mapa_temario[i] = nuevo_tema
+        if previo.get("temario_ids"):
+            # 3-4. Estructura ya guardada en el checkpoint
+            temas_struct = previo["temas_struct"]
+            via_estructura = previo.get("estructura", "checkpoint")
+            t_estructura = 0.0
+            temario_ids = previo["temario_ids"]
+            paginas_indice = []
+            print(f" -> 3-4. ♻️ Estructura del checkpoint: {len(temario_ids)} temas.")
+        else:
+            # 3. Analizar índice (primeras páginas; la extracción sigue mientras tanto)
+            print(" -> 3. Analizando estructura del índice...")
+            paginas_indice = list(control.consumir(cola_paginas, limite=min(PAGINAS_INDICE, num_paginas)))
+            if control.error is not None:
+                raise control.error
+            t0 = time.perf_counter()
+            temas_struct, via_estructura = extraer_estructura(archivo, paginas_indice)
+            t_estructura = time.perf_counter() - t0
 
-        db.commit()
-        print(f"    ✅ {len(mapa_temario)} temas guardados.")
-
-        # 5. Fragmentar y Crear Embeddings
-        print(" -> 5. Procesando contenido y generando EMBEDDINGS...")
-        
-        todos_chunks = [] # Lista de tuplas (objeto_BaseConocimiento, texto_para_vector)
-        
-        # Iterar temas para asignar contenido
-        for i in range(len(temas_struct)):
-            # Log de progreso cada 5 temas para ver que avanza
-            if i % 1 == 0: 
-                print(f"    ... Procesando tema {i+1}/{len(temas_struct)} ({temas_struct[i]['nombre']})...")
-                if progress_callback:
-                    pct = 10 + int((i / len(temas_struct)) * 75)
-                    progress_callback(f"Procesando tema {i+1}/{len(temas_struct)} ({temas_struct[i]['nombre']})...", pct)
+            if progress_callback: progress_callback("Estructura analizada. Guardando...", 10)
 
-            tema_actual = temas_struct[i]
-            tema_db = mapa_temario[i]
-            
-            pag_inicio = tema_actual.get("pagina_inicio", 1)
-            # Pag fin es el inicio del siguiente tema - 1, o el final del libro
-            if i < len(temas_struct) - 1:
-                pag_fin = temas_struct[i+1].get("pagina_inicio", num_paginas + 1) - 1
-            else:
-                pag_fin = num_paginas
-                
-            pag_fin = max(pag_inicio, pag_fin) # Evitar rangos negativos
-            
-            # Extraer texto del rango de páginas
-            texto_tema = ""
-            for p in range(pag_inicio, pag_fin + 1):
-                texto_tema += doc_completo.get(p, "") + "\n"
-                
-            if not texto_tema.strip():
-                continue
-                
-            # Calcular nombre del padre si existe
-            nombre_padre = ""
-            
-            bloques = procesar_texto_tema(
-                texto=texto_tema,
-                nombre_tema=tema_actual["nombre"],
-                nivel=tema_actual.get("nivel", 1),
-                orden=tema_actual.get("orden", 1),
-                pagina_inicio=pag_inicio,
-                parent_nombre=nombre_padre
-            )
-            
-            for bloque in bloques:
-                meta = bloque["metadata"]
-                
-                # Pre-crear objeto (sin IDs de enlace aún)
-                chunk_obj = BaseConocimiento(
-                    temario_id=tema_db.id,
-                    contenido=bloque["contenido"],
-                    tipo_contenido=bloque["tipo"], # 'texto' o 'codigo'
-                    pagina=pag_inicio, # Aproximado
-                    ref_fuente=f"Pág {pag_inicio}",
-                    metadata_info={
-                        "titulo_tema": tema_actual["nombre"],
-                        **meta
-                    }
+            # 4. Guardar Temario en BD (inactivo hasta terminar la ingesta)
+            print(" -> 4. Guardando estructura del TEMARIO...")
+            mapa_temario = {} # indice_lista -> objeto_db
+
+            for i, t in enumerate(temas_struct):
+                # Determinar padre (si nivel > 1, buscar el último de nivel-1)
+                parent_id = None
+                if t.get("nivel", 1) > 1:
+                    # Buscar hacia atrás el primer tema con nivel menor
+                    for prev_idx in range(i - 1, -1, -1):
+                        if temas_struct[prev_idx].get("nivel", 1) < t.get("nivel", 1):
+                            parent_id = mapa_temario[prev_idx].id
+                            break
+
+                nombre_tema = t["nombre"]
+                if len(nombre_tema) > 250:
+                    nombre_tema = nombre_tema[:250] + "..."
+
+                nuevo_tema = Temario(
+                    libro_id=libro_id,
+                    parent_id=parent_id,
+                    nombre=nombre_tema,
+                    nivel=t.get("nivel", 1),
+                    orden=i + 1,
+                    pagina_inicio=t.get("pagina_inicio", 1),
+                    activo=False
                 )
-                # Texto para embedding: Contextualizado
-                texto_vector = f"[{tema_actual['nombre']}]: {bloque['contenido']}"
-                todos_chunks.append((chunk_obj, texto_vector))
+                db.add(nuevo_tema)
+                db.flush()
+                mapa_temario[i] = nuevo_tema
+
+            temario_ids = [mapa_temario[i].id for i in range(len(temas_struct))]
+            checkpoint.guardar(db, FASE_ESTRUCTURA, temas_struct=temas_struct, temario_ids=temario_ids, huella=huella,
+                               estructura=via_estructura)
+            db.commit()
+            print(f"    ✅ {len(mapa_temario)} temas guardados.")
+
+        # 5. Temas → chunks → embeddings, cada etapa en su hilo
+        print(" -> 5. Procesando contenido y generando EMBEDDINGS (pipeline)...")
+        ya_escritos = previo.get("chunks", 0)
+        if ya_escritos:
+            print(f"    ♻️ Se saltan los {ya_escritos} chunks ya escritos (sin pedir sus embeddings).")
+        estadisticas = {"chunking_cpu": 0.0}
+        control.lanzar(
+            "temas",
+            lambda: _ensamblar_temas(chain(paginas_indice, control.consumir(cola_paginas)), temas_struct, num_paginas),
+            cola_temas,
+        )
+        control.lanzar(
+            "chunking",
+            lambda: _fragmentar_temas(control.consumir(cola_temas), temas_struct, temario_ids, estadisticas),
+            cola_chunks,
+        )
+        control.lanzar(
+            "embeddings",
+            lambda: _embeber_lotes(islice(control.consumir(cola_chunks), ya_escritos, None), temas_struct),
+            cola_lotes,
+        )
 
-        print(f"    Total chunks generados: {len(todos_chunks)}")
-        
-        if not todos_chunks:
+        # 6. Guardar con Lista Enlazada según llegan los lotes (este hilo, sesión `db`)
+        print(" -> 6. Guardando en BaseConocimiento por lotes (COPY binario, fallback ORM fila a fila)...")
+        fts_diferido = INGEST_FTS_DIFERIDO and _usar_copy(db)
+        estado = {"orden": ya_escritos, "ultimo_id": previo.get("ultimo_id"), "checkpoint": checkpoint,
+                  "fts_diferido": fts_diferido}
+        guardar_lote = _guardar_lote_copy if _usar_copy(db) else _guardar_lote_chunks
+        t_escritura = 0.0
+        try:
+            for lote, vectores in control.consumir(cola_lotes):
+                t0 = time.perf_counter()
+                guardar_lote(db, lote, vectores, estado)
+                t_escritura += time.perf_counter() - t0
+                if progress_callback:
+                    i = lote[-1]["tema"]
+                    pct = 10 + int(lote[-1]["avance"] * 85)
+                    progress_callback(f"Procesando tema {i+1}/{len(temas_struct)} ({temas_struct[i]['nombre']})...", pct)
+        except BaseException:
+            control.cancelar()
+            raise
+        finally:
+            control.terminar()
+
+        print(f"    Total chunks generados: {estado['orden']}")
+        if estado["orden"] == 0:
             print("    ⚠️ No se generaron chunks. Verifica el contenido del PDF.")
             return {"error": "No chunks generated"}
 
-        # 6. Generar Embeddings en Batch
-        print(" -> 6. Llamando a OpenAI Embeddings (Batch)...")
-        textos_batch = [item[1] for item in todos_chunks]
-        if progress_callback: progress_callback("Generando embeddings (BATCH)...", 85)
-        vectores = generar_embeddings_batch(db, textos_batch)
-        
-        # 7. Guardar con Lista Enlazada (por lotes para evitar timeouts/db errors)
-        print(" -> 7. Guardando en BaseConocimiento (Batch con Row-by-Row Fallback)...")
-        if progress_callback: progress_callback("Guardando en base de datos...", 90)
-        
-        chunks_guardados = []
-        
-        # Batch size
-        BATCH_FLUSH = 10
-        chunks_batch = []
-        
-        for i, (chunk_obj, _) in enumerate(todos_chunks):
-            # Validar Embedding (evitar NaN)
-            vec = vectores[i]
-            if vec is None:
-                vec = []
-
-            # --- FIX: Convertir explícitamente a lista de Python para evitar problemas con NumPy ---
-            if hasattr(vec, "tolist"):
-                vec = vec.tolist()
-            elif isinstance(vec, (tuple, range)):
-                vec = list(vec)
-            
-            # Si es None o vacío, vector cero
-            if not vec or len(vec) == 0:
-                 print(f"    ⚠️ Embedding vacío/None en chunk {i}. Se usará vector cero.")
-                 vec = [0.0] * 1536
-            
-            # Check for NaNs safely (ahora seguro porque es lista)
-            if any(x != x for x in vec): # x!=x detecta NaN
-                  print(f"    ⚠️ Embedding corrupto (NaN) en chunk {i}. Se usará vector cero.")
-                  vec = [0.0] * 1536
-
-            chunk_obj.embedding = vec
-            chunk_obj.orden_aparicion = i + 1
-            chunks_batch.append(chunk_obj)
-            chunks_guardados.append(chunk_obj)
-            
-            # Flush cada N
-            if len(chunks_batch) >= BATCH_FLUSH:
-                try:
-                    db.add_all(chunks_batch)
-                    db.flush()
-                except Exception as e:
-                    print(f"       ⚠️ Error en Batch Flush (chunk {i-BATCH_FLUSH}-{i}): {e}. Trying Row-by-Row...")
-                    db.rollback()
-                    # Reintentar uno por uno
-                    for c in chunks_batch:
-                        try:
-                            # Re-add porque rollback lo detachó
-                            db.add(c)
-                            db.flush()
-                        except Exception as e_row:
-                            print(f"       ❌ Skipping Chunk Corrupto (orden {c.orden_aparicion}): {e_row}")
-                            db.rollback() # Skip this row
-                            chunks_guardados.remove(c) # No lo contamos
-                finally:
-                    chunks_batch = [] # Reset batch
-        
-        # Flush final para los restantes
-        if chunks_batch:
-            try:
-                db.add_all(chunks_batch)
-                db.flush()
-            except Exception as e:
-                 print(f"       ⚠️ Error en Último Batch Flush: {e}. Trying Row-by-Row...")
-                 db.rollback()
-                 for c in chunks_batch:
-                    try:
-                        db.add(c)
-                        db.flush()
-                    except Exception as e_row:
-                        print(f"       ❌ Skipping Chunk Corrupto (orden {c.orden_aparicion}): {e_row}")
-                        db.rollback()
-                        chunks_guardados.remove(c) 
-
-        # Establecer enlaces (Anterior / Siguiente)
-        print(" -> 7b. Estableciendo enlaces...")
-        try:
-            for i in range(len(chunks_guardados)):
-                current = chunks_guardados[i]
-                if i > 0:
-                    current.chunk_anterior_id = chunks_guardados[i-1].id
-                if i < len(chunks_guardados) - 1:
-                    current.chunk_siguiente_id = chunks_guardados[i+1].id
-            db.commit()
-        except Exception as e_link:
-             print(f"    ⚠️ Error linking chunks (non-critical): {e_link}")
-             # Intentar al menos salvar los chunks sin links
-             db.rollback()
-        
+        t_carga = time.perf_counter() - control.t0
+
+        # 7. Fase final: full-text pendiente y activar el temario (el libro pasa a ser visible
+        # para el RAG), en la misma transacción: nunca hay chunks visibles sin busqueda_texto
+        if progress_callback: progress_callback("Indexando texto completo...", 96)
+        mantenimiento = {}
+        if db.get_bind().dialect.name == "postgresql":  # También los que dejó a medias un intento anterior
+            t0 = time.perf_counter()
+            filas_fts = _rellenar_fts(db, temario_ids)
+            mantenimiento["fts_pendiente"] = round(time.perf_counter() - t0, 3)
+            if filas_fts:
+                print(f"    🔤 busqueda_texto rellenado en {filas_fts} chunks: {mantenimiento['fts_pendiente']:.2f}s")
+        db.execute(update(Temario).where(Temario.id.in_(temario_ids)).values(activo=True))
+        checkpoint.guardar(db, FASE_ENLAZADO, chunks=estado["orden"], ultimo_id=estado["ultimo_id"])
+        db.commit()
+        if db.get_bind().dialect.name == "postgresql":
+            mantenimiento.update(_mantenimiento_indices(db))
+        chunks_guardados = _contar_chunks(db, temario_ids)
+
+        t_total = time.perf_counter() - control.t0
+        pico_mb = _pico_memoria_mb()
+        print(
+            f"    ⏱️ Pipeline: {t_carga:.2f}s | extracción terminó a {control.tiempos['extraccion'].get('fin', 0):.2f}s, "
+            f"primer lote de embeddings a {control.tiempos['embeddings'].get('primer_resultado', 0):.2f}s | "
+            f"CPU chunking {estadisticas['chunking_cpu']:.2f}s | pico memoria {pico_mb} MB"
+        )
+        print(f"    ⏱️ Mantenimiento: {' | '.join(f'{k} {v:.2f}s' for k, v in mantenimiento.items()) or '-'} | total {t_total:.2f}s")
+        # Tiempo ocupado por fase (las etapas del pipeline se solapan: la suma supera al total)
+        desglose = {
+            "extraccion": control.tiempos.get("extraccion", {}).get("ocupado", 0.0),
+            "estructura": round(t_estructura, 2),
+            "chunking": round(control.tiempos.get("temas", {}).get("ocupado", 0.0)
+                              + control.tiempos.get("chunking", {}).get("ocupado", 0.0), 2),
+            "embeddings": control.tiempos.get("embeddings", {}).get("ocupado", 0.0),
+            "escritura_bd": round(t_escritura, 2),
+            "mantenimiento": round(sum(mantenimiento.values()), 2),
+        }
+        print("    ⏱️ Ocupado por fase: " + " | ".join(f"{k} {v:.2f}s" for k, v in desglose.items()))
+
         print("\n" + "="*80)
         print(f"PROCESO TERMINADO EXITOSAMENTE")
-        print(f"Libro: {libro.titulo}")
-        print(f"Chunks indexados: {len(chunks_guardados)}")
+        print(f"Libro: {titulo_libro}")
+        print(f"Chunks indexados: {chunks_guardados}")
         print("="*80 + "\n")
-        
+
         return {
             "mensaje": "Libro procesado correctamente",
-            "libro_id": libro.id,
-            "bloques": len(chunks_guardados)
+            "libro_id": libro_id,
+            "bloques": chunks_guardados,
+            "reanudado": bool(previo),
+            "chunks_reutilizados": ya_escritos,
+            "estructura": via_estructura,
+            "segundos": round(t_total, 2),
+            "segundos_carga": round(t_carga, 2),
+            "etapas": control.tiempos,
+            "mantenimiento": mantenimiento,
+            "desglose": desglose,
+            "chunking_cpu_segundos": round(estadisticas["chunking_cpu"], 2),
+            "pico_memoria_mb": pico_mb,
         }
 
     except Exception as e:
+        control.cancelar()
         db.rollback()
         import traceback
         traceback.print_exc()
         print(f"    ❌ CRITICAL ERROR en proceso de ingestión: {e}")
-        return {"error": str(e)}
\ No newline at end of file
+        return {"error": str(e)}
+
+# ============================================================================
+# 5. NUEVA EDICIÓN (re-ingesta incremental)
+# ============================================================================
+
+TEMA_RETIRADO = "Contenido retirado (ediciones anteriores)"
+
+
+def _hash_contenido(nombre_tema: str, contenido: str) -> str:
+    """
+    Hash del tema y del texto normalizados (espacios): identifica un chunk entre ediciones.
+    Incluye el tema porque el embedding se calculó sobre "[tema]: contenido": un chunk que
+    pasa a otro tema (o cuyo tema se renombra) se vuelve a embeber.
+    """
+    clave = f"{' '.join(nombre_tema.split())}\n{' '.join(contenido.split())}"
+    return hashlib.sha256(clave.encode("utf-8")).hexdigest()
+
+
+def _emparejar_temario(db: Session, libro_id: int, temas_struct: List[Dict]) -> Tuple[List[Optional[Temario]], List[Temario]]:
+    """
+    Empareja cada tema de la nueva edición con un tema activo del libro por nombre
+    (normalizado, en orden). Devuelve (tema existente o None por cada tema nuevo, temas sin pareja).
+    """
+    existentes = db.query(Temario).filter(Temario.libro_id == libro_id, Temario.activo == True).order_by(Temario.orden).all()
+    por_nombre: Dict[str, deque] = {}
+    for t in existentes:
+        por_nombre.setdefault(" ".join(t.nombre.lower().split()), deque()).append(t)
+    parejas = []
+    for t in temas_struct:
+        candidatos = por_nombre.get(" ".join(t["nombre"][:250].lower().split()))
+        parejas.append(candidatos.popleft() if candidatos else None)
+    usados = {t.id for t in parejas if t is not None}
+    return parejas, [t for t in existentes if t.id not in usados]
+
+
+def _mapa_mas_cercano(orden_viejo: List[int], supervivientes: set, orden_nuevo: List[int]) -> Dict[int, int]:
+    """
+    Para cada chunk retirado, el superviviente más cercano en el orden de la edición
+    anterior: el anterior (el alumno retoma donde iba) y, si no hay, el siguiente.
+    Si no sobrevive ninguno, el chunk nuevo en la misma posición relativa.
+    """
+    mapa = {}
+    previo = None
+    pendientes = []  # (posición, id) de retirados antes del primer superviviente
+    for posicion, chunk_id in enumerate(orden_viejo):
+        if chunk_id in supervivientes:
+            for _, retirado in pendientes:  # Sin anterior: van al siguiente
+                mapa[retirado] = chunk_id
+            pendientes = []
+            previo = chunk_id
+        elif previo is not None:
+            mapa[chunk_id] = previo
+        else:
+            pendientes.append((posicion, chunk_id))
+    for posicion, retirado in pendientes:
+        relativa = posicion / len(orden_viejo)
+        mapa[retirado] = orden_nuevo[min(int(relativa * len(orden_nuevo)), len(orden_nuevo) - 1)]
+    return mapa
+
+
+def procesar_nueva_edicion(db: Session, libro_id: int, archivo: Union[bytes, str], filename: str,
+                           progress_callback=None, pdf_sha256: Optional[str] = None) -> Dict:
+    """
+    Actualiza un libro ya ingerido con una edición revisada sin borrarlo:
+    1. Extrae, analiza el índice y trocea la nueva edición como una ingesta normal
+    2. Empareja temas por nombre y chunks por hash del tema y del contenido con los actuales
+    3. Pide embeddings SOLO de los chunks nuevos o modificados
+    4. En una única transacción: inserta los nuevos, re-enlaza la lista completa (solo se
+       actualizan las filas que cambian), lleva el progreso de los alumnos al chunk
+       superviviente más cercano y retira lo que ya no está
+    Los chunks retirados sin referencias se borran; los citados en chats o ejercicios se
+    mueven a un tema inactivo (las citas siguen siendo válidas, pero no salen en el RAG).
+    Los temas sin pareja se desactivan (conservan sesiones y tests). Las preguntas del banco
+    cuyos bloques_fuente incluyen chunks retirados se desactivan.
+    """
+    print("\n" + "="*80)
+    print(f"NUEVA EDICIÓN DEL LIBRO {libro_id}: {filename}")
+    print("="*80 + "\n")
+    t0 = time.perf_counter()
+
+    libro = db.get(Libro, libro_id)
+    if libro is None:
+        return {"error": f"No se encontró el libro con ID {libro_id}"}
+
+    try:
+        # 1. Extraer y estructurar la nueva edición
+        if progress_callback: progress_callback("Leyendo la nueva edición...", 5)
+        pdf_reader = abrir_pdf(archivo)
+        num_paginas = len(pdf_reader.pages)
+        if num_paginas == 0:
+            return {"error": "PDF vacío"}
+        paginas = extraer_paginas(archivo, pdf_reader)
+        paginas_indice = list(islice(paginas, min(PAGINAS_INDICE, num_paginas)))
+        temas_struct, via_estructura = extraer_estructura(archivo, paginas_indice)
+
+        if progress_callback: progress_callback("Comparando con la edición actual...", 15)
+        estadisticas = {"chunking_cpu": 0.0}
+        nuevos_chunks = list(_fragmentar_temas(
+            _ensamblar_temas(chain(paginas_indice, paginas), temas_struct, num_paginas),
+            temas_struct, [None] * len(temas_struct), estadisticas,
+        ))
+        if not nuevos_chunks:
+            return {"error": "No chunks generated"}
+
+        # 2. Diff: temas por nombre, chunks por hash del tema y del contenido
+        parejas, temas_sin_pareja = _emparejar_temario(db, libro_id, temas_struct)
+        actuales = db.execute(
+            select(
+                BaseConocimiento.id, BaseConocimiento.contenido, BaseConocimiento.temario_id,
+                BaseConocimiento.orden_aparicion, BaseConocimiento.pagina, BaseConocimiento.chunk_anterior_id,
+                BaseConocimiento.chunk_siguiente_id, BaseConocimiento.metadata_info,
+                Temario.nombre.label("nombre_tema"),
+            )
+            .join(Temario, Temario.id == BaseConocimiento.temario_id)
+            .where(Temario.libro_id == libro_id, Temario.activo == True)
+            .order_by(BaseConocimiento.orden_aparicion, BaseConocimiento.id)
+        ).all()
+        por_hash: Dict[str, deque] = {}
+        for fila in actuales:
+            por_hash.setdefault(_hash_contenido(fila.nombre_tema, fila.contenido), deque()).append(fila)
+
+        reutilizados: List[Optional[Any]] = []  # Fila actual reutilizada (o None) por cada chunk nuevo
+        for chunk in nuevos_chunks:
+            nombre_tema = temas_struct[chunk["tema"]]["nombre"]
+            if len(nombre_tema) > 250:
+                nombre_tema = nombre_tema[:250] + "..."  # Como queda guardado en temario.nombre
+            candidatos = por_hash.get(_hash_contenido(nombre_tema, chunk["contenido"]))
+            reutilizados.append(candidatos.popleft() if candidatos else None)
+        supervivientes = {f.id for f in reutilizados if f is not None}
+        retirados = [f.id for f in actuales if f.id not in supervivientes]
+        a_embeber = [c for c, f in zip(nuevos_chunks, reutilizados) if f is None]
+        print(f"    🔍 {len(supervivientes)} chunks sin cambios, {len(a_embeber)} nuevos/modificados, {len(retirados)} retirados")
+
+        # 3. Embeddings solo de lo nuevo (sin escribir aún: la BD se toca al final, de una vez)
+        vectores_nuevos: List[Optional[np.ndarray]] = []
+        for lote, vectores in _embeber_lotes(iter(a_embeber), temas_struct):
+            vectores_nuevos.extend(vectores)
+            if progress_callback:
+                pct = 15 + int(len(vectores_nuevos) / len(a_embeber) * 70)
+                progress_callback(f"Embeddings de contenido nuevo: {len(vectores_nuevos)}/{len(a_embeber)}", pct)
+
+        # 4. Escritura en una sola transacción
+        if progress_callback: progress_callback("Aplicando cambios...", 90)
+
+        # 4a. Temario: actualizar emparejados, crear nuevos, desactivar los que ya no están
+        temario_ids: List[int] = []
+        for i, t in enumerate(temas_struct):
+            parent_id = None
+            if t.get("nivel", 1) > 1:
+                for prev_idx in range(i - 1, -1, -1):
+                    if temas_struct[prev_idx].get("nivel", 1) < t.get("nivel", 1):
+                        parent_id = temario_ids[prev_idx]
+                        break
+            tema = parejas[i] or Temario(libro_id=libro_id, activo=True)
+            tema.nombre = t["nombre"] if len(t["nombre"]) <= 250 else t["nombre"][:250] + "..."
+            tema.parent_id = parent_id
+            tema.nivel = t.get("nivel", 1)
+            tema.orden = i + 1
+            tema.pagina_inicio = t.get("pagina_inicio", 1)
+            db.add(tema)
+            db.flush()
+            temario_ids.append(tema.id)
+        for tema in temas_sin_pareja:
+            tema.activo = False
+
+        # 4b. Insertar los chunks nuevos (los enlaces se ponen en 4c)
+        matriz, validos = _validar_vectores(vectores_nuevos, 1)
+        objetos = [
+            BaseConocimiento(
+                temario_id=temario_ids[c["tema"]],
+                contenido=c["contenido"],
+                tipo_contenido=c["tipo"],
+                pagina=c["pagina"],
+                ref_fuente=f"Pág {c['pagina']}",
+                metadata_info=c["metadata"],
+                embedding=matriz[k] if validos[k] else None,
+            )
+            for k, c in enumerate(a_embeber)
+        ]
+        db.add_all(objetos)
+        db.flush()
+        nuevos_ids = iter([o.id for o in objetos])
+        orden_final = [f.id if f is not None else next(nuevos_ids) for f in reutilizados]
+
+        # 4c. Re-enlazar la lista completa; solo se actualizan las filas que cambian
+        filas_actuales = {f.id: f for f in actuales}
+        cambios = []
+        for k, (chunk_id, chunk) in enumerate(zip(orden_final, nuevos_chunks)):
+            valores = (
+                chunk_id, temario_ids[chunk["tema"]], k + 1, chunk["pagina"],
+                orden_final[k - 1] if k > 0 else None,
+                orden_final[k + 1] if k < len(orden_final) - 1 else None,
+                chunk["metadata"],
+            )
+            f = filas_actuales.get(chunk_id)
+            if f is None or (f.temario_id, f.orden_aparicion, f.pagina, f.chunk_anterior_id,
+                             f.chunk_siguiente_id, f.metadata_info) != valores[1:]:
+                cambios.append(valores)
+        if cambios:
+            columnas = list(zip(*cambios))
+            db.execute(
+                text("""
+                    UPDATE base_conocimiento bc
+                    SET temario_id = v.temario_id, orden_aparicion = v.orden, pagina = v.pagina,
+                        ref_fuente = 'Pág ' || v.pagina, chunk_anterior_id = v.anterior,
+                        chunk_siguiente_id = v.siguiente, metadatos = CAST(v.metadatos AS jsonb)
+                    FROM unnest(
+                        CAST(:ids AS bigint[]), CAST(:temarios AS integer[]), CAST(:ordenes AS integer[]),
+                        CAST(:paginas AS integer[]), CAST(:anteriores AS bigint[]), CAST(:siguientes AS bigint[]),
+                        CAST(:metadatos AS text[])
+                    ) AS v(id, temario_id, orden, pagina, anterior, siguiente, metadatos)
+                    WHERE bc.id = v.id
+                """),
+                {
+                    "ids": list(columnas[0]), "temarios": list(columnas[1]), "ordenes": list(columnas[2]),
+                    "paginas": list(columnas[3]), "anteriores": list(columnas[4]), "siguientes": list(columnas[5]),
+                    "metadatos": [json.dumps(m, ensure_ascii=False) for m in columnas[6]],
+                },
+            )
+
+        # 4d. Progreso de alumnos: del chunk retirado al superviviente más cercano
+        progresos = 0
+        borrados = 0
+        preguntas_desactivadas = 0
+        if retirados:
+            mapa = _mapa_mas_cercano([f.id for f in actuales], supervivientes, orden_final)
+            progresos = db.execute(
+                text("""
+                    UPDATE progreso_alumno p SET ultimo_contenido_visto_id = m.nuevo
+                    FROM unnest(CAST(:viejos AS bigint[]), CAST(:nuevos AS bigint[])) AS m(viejo, nuevo)
+                    WHERE p.ultimo_contenido_visto_id = m.viejo
+                """),
+                {"viejos": list(mapa.keys()), "nuevos": list(mapa.values())},
+            ).rowcount
+
+            # Banco de preguntas: las generadas a partir de contenido retirado no se vuelven a servir
+            preguntas_desactivadas = db.execute(
+                text("""
+                    UPDATE banco_preguntas bp SET activa = FALSE
+                    WHERE bp.activa
+                      AND bp.temario_id IN (SELECT id FROM temario WHERE libro_id = :libro_id)
+                      AND EXISTS (
+                          SELECT 1
+                          FROM jsonb_array_elements_text(CASE WHEN jsonb_typeof(CAST(bp.bloques_fuente AS jsonb)) = 'array'
+                                                              THEN CAST(bp.bloques_fuente AS jsonb) ELSE '[]' END) AS b(id)
+                          WHERE CAST(b.id AS bigint) = ANY(CAST(:ids AS bigint[]))
+                      )
+                """),
+                {"libro_id": libro_id, "ids": retirados},
+            ).rowcount
+
+            # 4e. Retirar: fuera de la lista; se borran si nadie los referencia
+            db.execute(
+                update(BaseConocimiento).where(BaseConocimiento.id.in_(retirados))
+                .values(chunk_anterior_id=None, chunk_siguiente_id=None)
+            )
+            borrados = db.execute(
+                text("""
+                    DELETE FROM base_conocimiento bc
+                    WHERE bc.id = ANY(CAST(:ids AS bigint[]))
+                      AND NOT EXISTS (SELECT 1 FROM chat_citas c WHERE c.base_conocimiento_id = bc.id)
+                      AND NOT EXISTS (SELECT 1 FROM ejercicios_codigo e WHERE e.base_conocimiento_id = bc.id)
+                      AND NOT EXISTS (SELECT 1 FROM progreso_alumno p WHERE p.ultimo_contenido_visto_id = bc.id)
+                """),
+                {"ids": retirados},
+            ).rowcount
+            if borrados < len(retirados):
+                tema_retirado = db.query(Temario).filter(
+                    Temario.libro_id == libro_id, Temario.nombre == TEMA_RETIRADO, Temario.activo == False
+                ).first()
+                if tema_retirado is None:
+                    tema_retirado = Temario(libro_id=libro_id, nombre=TEMA_RETIRADO, nivel=1, orden=0, activo=False)
+                    db.add(tema_retirado)
+                    db.flush()
+                db.execute(
+                    update(BaseConocimiento).where(BaseConocimiento.id.in_(retirados))
+                    .values(temario_id=tema_retirado.id, orden_aparicion=0)
+                )
+
+        # Progresos de temas desactivados: pasan al tema de su chunk (ya re-mapeado)
+        if temas_sin_pareja:
+            db.execute(
+                text("""
+                    UPDATE progreso_alumno p SET temario_id = bc.temario_id
+                    FROM base_conocimiento bc
+                    WHERE p.ultimo_contenido_visto_id = bc.id
+                      AND p.temario_id = ANY(CAST(:temas AS integer[]))
+                      AND bc.temario_id = ANY(CAST(:activos AS integer[]))
+                """),
+                {"temas": [t.id for t in temas_sin_pareja], "activos": temario_ids},
+            )
+
+        libro.descripcion = f"Actualizado el {datetime.now().strftime('%Y-%m-%d %H:%M')}"
+        if isinstance(archivo, str):
+            libro.pdf_path = archivo
+        if pdf_sha256:
+            libro.pdf_sha256 = pdf_sha256
+        db.commit()
+
+    except Exception as e:
+        db.rollback()
+        import traceback
+        traceback.print_exc()
+        print(f"    ❌ CRITICAL ERROR en nueva edición: {e}")
+        return {"error": str(e)}
+
+    t_total = time.perf_counter() - t0
+    print(f"    ✅ Nueva edición aplicada en {t_total:.2f}s: {len(a_embeber)} embeddings nuevos, "
+          f"{len(cambios)} filas actualizadas, {borrados} chunks borrados, {progresos} progresos re-mapeados, "
+          f"{preguntas_desactivadas} preguntas del banco desactivadas")
+    return {
+        "mensaje": "Nueva edición aplicada",
+        "libro_id": libro_id,
+        "bloques": len(orden_final),
+        "reutilizados": len(supervivientes),
+        "nuevos": len(a_embeber),
+        "filas_actualizadas": len(cambios),
+        "retirados": len(retirados),
+        "borrados": borrados,
+        "progresos_remapeados": progresos,
+        "preguntas_desactivadas": preguntas_desactivadas,
+        "estructura": via_estructura,
+        "temas_nuevos": sum(1 for p in parejas if p is None),
+        "temas_retirados": len(temas_sin_pareja),
+        "segundos": round(t_total, 2),
+    }
@@ -0,0 +1,661 @@
+"""
+Cola persistente de trabajos de ingesta (tabla ingest_jobs).
+
+La API solo guarda el PDF en el almacén (blob_service) y encola el trabajo. Un pool de procesos worker
+(lanzado por la API con INGEST_WORKERS > 0, o aparte con scripts/ingest_worker.py)
+reclama los trabajos con SELECT ... FOR UPDATE SKIP LOCKED: varios workers o varias
+instancias de la API nunca cogen el mismo. El progreso se guarda en la propia fila en
+lotes (como mucho cada JOB_PROGRESO_SEG), así cualquier worker de la API lo puede
+consultar. Si un worker muere, su trabajo deja de dar latidos y se vuelve a encolar.
+Todas las fechas de la fila se escriben con el reloj de la base de datos (LOCALTIMESTAMP),
+el mismo con el que se comparan los latidos: no dependen de la hora del servidor de la API.
+
+La ingesta guarda checkpoints por fases en la fila (fase / checkpoint): el worker que
+recoge un trabajo reencolado o reintentado continúa desde el último lote escrito en
+lugar de crear otro libro y volver a pedir todos los embeddings.
+
+Un trabajo en modo MODO_EDICION no crea un libro: aplica una edición revisada sobre
+job.libro_id (ver ingest_service.procesar_nueva_edicion).
+
+Cada escritura de progreso lanza además un pg_notify (canal CANAL_PROGRESO). En cada
+proceso de la API un único DifusorProgreso escucha ese canal y reparte los eventos a los
+clientes SSE (/upload/jobs/{job_id}/eventos): no hay un bucle de consultas por cliente.
+"""
+import os
+import json
+import time
+import select
+import signal
+import asyncio
+import socket
+import threading
+import traceback
+import multiprocessing
+from typing import Dict, List, Optional
+
+from sqlalchemy import func, text, update
+from sqlalchemy.orm import Session
+
+from app.db.database import SessionLocal, engine
+from app.models.modelos import IngestJob
+
+# ============================================================================
+# Configuración
+# ============================================================================
+
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "1"))  # Procesos que lanza la API (0 = scripts/ingest_worker.py)
+JOB_PROGRESO_SEG = float(os.getenv("JOB_PROGRESO_SEG", "2"))     # Frecuencia máxima de escritura de progreso
+JOB_LATIDO_SEG = float(os.getenv("JOB_LATIDO_SEG", "30"))        # Latido aunque no haya progreso nuevo
+JOB_HUERFANO_SEG = float(os.getenv("JOB_HUERFANO_SEG", "300"))   # Sin latido → el worker murió
+JOB_MAX_INTENTOS = int(os.getenv("JOB_MAX_INTENTOS", "2"))
+JOB_POLL_SEG = float(os.getenv("JOB_POLL_SEG", "2"))
+JOB_PARADA_SEG = float(os.getenv("JOB_PARADA_SEG", "30"))       # Al apagar: margen para reencolar antes de kill()
+SSE_PING_SEG = float(os.getenv("SSE_PING_SEG", "15"))             # Comentario keep-alive en el stream SSE
+SSE_COLA_EVENTOS = int(os.getenv("SSE_COLA_EVENTOS", "16"))       # Por cliente; si se llena se descarta el más viejo
+CANAL_PROGRESO = "ingest_progreso"                                 # Canal LISTEN/NOTIFY
+
+# Pre-renderizar TTS de respuestas fijas tras cada ingesta (ver scripts/prerender_tts.py)
+TTS_PRERENDER_AFTER_INGEST = os.getenv("TTS_PRERENDER_AFTER_INGEST", "0") == "1"
+
+PENDIENTE = "pendiente"
+PROCESANDO = "procesando"
+COMPLETADO = "completado"
+ERROR = "error"
+
+MODO_NUEVO = "nuevo"      # Libro nuevo (o enlazado/clonado si el PDF ya estaba)
+MODO_EDICION = "edicion"  # Nueva edición de un libro existente (re-ingesta incremental)
+
+# ============================================================================
+# API: encolar y consultar
+# ============================================================================
+
+def encolar_ingesta(db: Session, ruta_pdf: str, filename: str, account_id: str,
+                    titulo: Optional[str] = None, licencia_id: Optional[int] = None,
+                    pdf_sha256: Optional[str] = None, modo: str = MODO_NUEVO,
+                    libro_id: Optional[int] = None) -> IngestJob:
+    """Encola una ingesta. En MODO_EDICION, libro_id es el libro que se actualiza."""
+    job = IngestJob(
+        account_id=account_id,
+        licencia_id=licencia_id,
+        filename=filename,
+        titulo=titulo,
+        ruta_pdf=ruta_pdf,
+        pdf_sha256=pdf_sha256,
+        modo=modo,
+        libro_id=libro_id,
+        estado=PENDIENTE,
+        mensaje="En cola...",
+        porcentaje=0,
+    )
+    db.add(job)
+    db.commit()
+    db.refresh(job)
+    print(f"📥 Ingesta encolada: job {job.id} ({filename}, cuenta {account_id}, modo {modo})")
+    return job
+
+
+def registrar_libro_existente(db: Session, ruta_pdf: str, pdf_sha256: str, filename: str, account_id: str,
+                              libro_id: int, titulo: Optional[str] = None,
+                              licencia_id: Optional[int] = None) -> IngestJob:
+    """
+    El PDF ya está ingerido en esta licencia: se registra un trabajo ya completado que
+    apunta a ese libro, sin pasar por los workers (el frontend lo sigue igual que una ingesta).
+    """
+    job = IngestJob(
+        account_id=account_id,
+        licencia_id=licencia_id,
+        filename=filename,
+        titulo=titulo,
+        ruta_pdf=ruta_pdf,
+        pdf_sha256=pdf_sha256,
+        estado=COMPLETADO,
+        mensaje="Este PDF ya estaba procesado: se reutiliza el libro existente",
+        porcentaje=100,
+        libro_id=libro_id,
+        resultado={"mensaje": "Libro ya existente", "libro_id": libro_id, "duplicado": True},
+        fecha_fin=func.localtimestamp(),
+    )
+    db.add(job)
+    db.commit()
+    db.refresh(job)
+    print(f"♻️ PDF duplicado ({pdf_sha256[:12]}…): job {job.id} enlaza el libro {libro_id}")
+    return job
+
+
+def obtener_job(db: Session, job_id: int) -> Optional[IngestJob]:
+    return db.get(IngestJob, job_id)
+
+
+def reintentar_job(db: Session, job_id: int) -> Optional[IngestJob]:
+    """
+    Vuelve a encolar un trabajo en error. Se reanuda desde su checkpoint. Devuelve None
+    si no está en error o si su PDF ya no está en el almacén.
+    """
+    job = db.get(IngestJob, job_id)
+    if job is None or job.estado != ERROR or not os.path.exists(job.ruta_pdf):
+        return None
+    job.estado = PENDIENTE
+    job.intentos = 0
+    job.mensaje = "Reintento en cola..."
+    job.fecha_actualizacion = func.localtimestamp()
+    job.fecha_fin = None
+    _notificar(db, _evento(job.id, PENDIENTE, job.mensaje, job.porcentaje, fase=job.fase))
+    db.commit()
+    print(f"🔁 Job {job_id} reencolado (fase '{job.fase}')")
+    return job
+
+
+def listar_jobs(db: Session, account_id: str, limite: int = 20) -> List[IngestJob]:
+    return (
+        db.query(IngestJob)
+        .filter(IngestJob.account_id == account_id)
+        .order_by(IngestJob.id.desc())
+        .limit(limite)
+        .all()
+    )
+
+
+# Estados de ingest_jobs → estados que espera el frontend (/upload/progress)
+_STATUS_FRONT = {PENDIENTE: "processing", PROCESANDO: "processing", COMPLETADO: "completed", ERROR: "error"}
+
+
+def job_a_dict(job: IngestJob) -> Dict:
+    """Serializa el trabajo. Incluye status/message/percent con el formato de /upload/progress."""
+    return {
+        "job_id": job.id,
+        "estado": job.estado,
+        "status": _STATUS_FRONT.get(job.estado, "processing"),
+        "message": job.mensaje,
+        "percent": job.porcentaje,
+        "filename": job.filename,
+        # Mismo criterio que ingest_service para el título del libro
+        "titulo": job.titulo if job.titulo else job.filename.replace(".pdf", ""),
+        "libro_id": job.libro_id,
+        "intentos": job.intentos,
+        "worker": job.worker,
+        "resultado": job.resultado,
+        "fase": job.fase,
+        "modo": job.modo,
+        "fecha_creacion": job.fecha_creacion,
+        "fecha_inicio": job.fecha_inicio,
+        "fecha_actualizacion": job.fecha_actualizacion,
+        "fecha_fin": job.fecha_fin,
+    }
+
+
+def _evento(job_id: int, estado: str, mensaje: Optional[str], porcentaje: int, **detalle) -> Dict:
+    """Evento de progreso (NOTIFY y SSE). status/message/percent con el formato de /upload/progress."""
+    return {
+        "job_id": job_id,
+        "estado": estado,
+        "status": _STATUS_FRONT.get(estado, "processing"),
+        "message": mensaje,
+        "percent": porcentaje,
+        **detalle,
+    }
+
+
+def _notificar(db: Session, evento: Dict):
+    """pg_notify dentro de la transacción en curso: solo se entrega si se hace commit."""
+    if db.get_bind().dialect.name != "postgresql":
+        return
+    db.execute(
+        text("SELECT pg_notify(:canal, :datos)"),
+        {"canal": CANAL_PROGRESO, "datos": json.dumps(evento, default=str)},
+    )
+
+# ============================================================================
+# Worker: reclamar, informar progreso y procesar
+# ============================================================================
+
+class TrabajoAbandonadoError(Exception):
+    """El worker se detiene (SIGTERM) o murió su proceso padre: se corta la ingesta en curso para reencolarla."""
+
+
+def _reclamar_job(db: Session, worker: str) -> Optional[int]:
+    """Pasa el pendiente más antiguo a 'procesando' de forma atómica (SKIP LOCKED)."""
+    job_id = db.execute(
+        text("""
+            UPDATE ingest_jobs
+            SET estado = :procesando, worker = :worker, intentos = intentos + 1,
+                fecha_inicio = LOCALTIMESTAMP, fecha_actualizacion = LOCALTIMESTAMP,
+                mensaje = 'Iniciando...', porcentaje = 0
+            WHERE id = (
+                SELECT id FROM ingest_jobs
+                WHERE estado = :pendiente
+                ORDER BY id
+                FOR UPDATE SKIP LOCKED
+                LIMIT 1
+            )
+            RETURNING id
+        """),
+        {"procesando": PROCESANDO, "pendiente": PENDIENTE, "worker": worker},
+    ).scalar()
+    db.commit()
+    return job_id
+
+
+def recuperar_jobs_huerfanos(db: Session) -> int:
+    """
+    Trabajos 'procesando' sin latido desde hace JOB_HUERFANO_SEG: su worker murió
+    (reinicio, OOM...). Se vuelven a encolar, o se marcan como error si agotaron intentos.
+    """
+    filas = db.execute(
+        text("""
+            UPDATE ingest_jobs
+            SET estado = CASE WHEN intentos < :max_intentos THEN :pendiente ELSE :error END,
+                mensaje = CASE WHEN intentos < :max_intentos
+                               THEN 'Reencolado: se reanudará desde el último checkpoint'
+                               ELSE 'El worker dejó de responder demasiadas veces' END,
+                fecha_actualizacion = LOCALTIMESTAMP
+            WHERE estado = :procesando
+              AND fecha_actualizacion < LOCALTIMESTAMP - make_interval(secs => :segundos)
+        """),
+        {
+            "max_intentos": JOB_MAX_INTENTOS, "pendiente": PENDIENTE, "error": ERROR,
+            "procesando": PROCESANDO, "segundos": JOB_HUERFANO_SEG,
+        },
+    ).rowcount
+    db.commit()
+    if filas:
+        print(f"♻️ {filas} trabajos de ingesta huérfanos recuperados")
+    return filas
+
+
+class ReportadorProgreso:
+    """
+    progress_callback para ingest_service. La llamada solo guarda el último (mensaje, %)
+    en memoria; un hilo lo escribe en la fila como mucho cada JOB_PROGRESO_SEG y, aunque
+    no haya cambios, refresca fecha_actualizacion cada JOB_LATIDO_SEG (latido).
+    Cada escritura con progreso nuevo se notifica (fase y chunks del checkpoint, y ETA).
+    
+    Con `ppid`, el mismo hilo vigila al proceso padre: si muere, deja de dar latidos y la
+    siguiente llamada lanza TrabajoAbandonadoError para cortar la ingesta. Lo mismo si se
+    activa `parar_worker` (el worker recibió SIGTERM).
+    """
+
+    def __init__(self, job_id: int, checkpoint: Optional["CheckpointJob"] = None, ppid: Optional[int] = None,
+                 parar_worker: Optional[threading.Event] = None):
+        self.job_id = job_id
+        self.checkpoint = checkpoint
+        self.ppid = ppid
+        self.parar_worker = parar_worker
+        self.abandonado = threading.Event()
+        self.pendiente: Optional[tuple] = None
+        self.ultima_escritura = 0.0
+        self.referencia_eta: Optional[tuple] = None  # (instante, %) al terminar la estructura
+        self.lock = threading.Lock()
+        self.parar = threading.Event()
+        self.hilo = threading.Thread(target=self._bucle, name=f"progreso-job-{job_id}", daemon=True)
+        self.hilo.start()
+
+    def __call__(self, mensaje: str, porcentaje: int):
+        if self.parar_worker is not None and self.parar_worker.is_set():
+            self.abandonado.set()
+        if self.abandonado.is_set():
+            raise TrabajoAbandonadoError(f"Worker detenido: job {self.job_id} abandonado")
+        with self.lock:
+            self.pendiente = (mensaje, porcentaje)
+            if self.referencia_eta is None and porcentaje >= 10:
+                self.referencia_eta = (time.monotonic(), porcentaje)
+
+    def _eta_seg(self, porcentaje: int) -> Optional[int]:
+        """Extrapolación lineal del ritmo desde que empezaron los embeddings."""
+        if self.referencia_eta is None or porcentaje <= self.referencia_eta[1]:
+            return None
+        t0, p0 = self.referencia_eta
+        return int((time.monotonic() - t0) / (porcentaje - p0) * (100 - porcentaje))
+
+    def _detalle(self, porcentaje: int) -> Dict:
+        datos = self.checkpoint.datos if self.checkpoint is not None else {}
+        return {"fase": datos.get("fase"), "chunks": datos.get("chunks", 0), "eta_seg": self._eta_seg(porcentaje)}
+
+    def _escribir(self, forzar_latido: bool = False):
+        with self.lock:
+            pendiente, self.pendiente = self.pendiente, None
+        if pendiente is None and not forzar_latido:
+            return
+        valores = {"fecha_actualizacion": func.localtimestamp()}
+        if pendiente is not None:
+            valores["mensaje"], valores["porcentaje"] = pendiente
+        db = SessionLocal()
+        try:
+            db.execute(update(IngestJob).where(IngestJob.id == self.job_id).values(**valores))
+            if pendiente is not None:
+                _notificar(db, _evento(self.job_id, PROCESANDO, *pendiente, **self._detalle(pendiente[1])))
+            db.commit()
+            self.ultima_escritura = time.monotonic()
+        except Exception as e:
+            db.rollback()
+            print(f"   ⚠️ No se pudo guardar el progreso del job {self.job_id}: {e}")
+        finally:
+            db.close()
+
+    def _bucle(self):
+        while not self.parar.wait(JOB_PROGRESO_SEG):
+            if self.ppid is not None and os.getppid() != self.ppid:
+                self.abandonado.set()
+                return
+            self._escribir(forzar_latido=time.monotonic() - self.ultima_escritura >= JOB_LATIDO_SEG)
+
+    def cerrar(self):
+        self.parar.set()
+        self.hilo.join()
+        self._escribir()
+
+
+class CheckpointJob:
+    """
+    Checkpoint de ingest_service (misma interfaz que ingest_service.CheckpointIngesta)
+    guardado en ingest_jobs.fase / ingest_jobs.checkpoint. Escribe en la sesión y
+    transacción de la ingesta, sin commit: se confirma junto con la fase.
+    """
+
+    def __init__(self, job: IngestJob):
+        self.job_id = job.id
+        self.datos = dict(job.checkpoint or {})
+
+    def cargar(self) -> Dict:
+        return dict(self.datos)
+
+    def guardar(self, db: Session, fase: str, **datos):
+        self.datos.update(datos, fase=fase)
+        db.execute(
+            update(IngestJob).where(IngestJob.id == self.job_id)
+            .values(fase=fase, checkpoint=dict(self.datos))
+        )
+
+
+def _reencolar_job(db: Session, job_id: int):
+    """
+    Devuelve a la cola un trabajo que este worker abandona: otro lo reanuda desde su checkpoint.
+    No es un fallo del trabajo, así que se descuenta el intento que sumó _reclamar_job.
+    """
+    mensaje = "Reencolado: se reanudará desde el último checkpoint"
+    db.execute(
+        update(IngestJob).where(IngestJob.id == job_id, IngestJob.estado == PROCESANDO)
+        .values(estado=PENDIENTE, mensaje=mensaje, fecha_actualizacion=func.localtimestamp(),
+                intentos=func.greatest(IngestJob.intentos - 1, 0))
+    )
+    _notificar(db, _evento(job_id, PENDIENTE, mensaje, 0))
+    db.commit()
+
+
+def _finalizar_job(db: Session, job_id: int, estado: str, mensaje: str, porcentaje: int,
+                   libro_id: Optional[int] = None, resultado: Optional[Dict] = None):
+    db.execute(
+        update(IngestJob).where(IngestJob.id == job_id).values(
+            estado=estado, mensaje=mensaje, porcentaje=porcentaje,
+            resultado=resultado, fecha_actualizacion=func.localtimestamp(), fecha_fin=func.localtimestamp(),
+            # Un error no borra el libro de destino de una nueva edición (lo necesita reintentar_job)
+            **({"libro_id": libro_id} if libro_id is not None else {}),
+        )
+    )
+    _notificar(db, _evento(job_id, estado, mensaje, porcentaje, libro_id=libro_id))
+    db.commit()
+
+
+def procesar_job(job_id: int, ppid: Optional[int] = None, parar: Optional[threading.Event] = None):
+    """
+    Ejecuta la ingesta de un trabajo ya reclamado y deja la fila en su estado final.
+    Si muere el proceso padre `ppid` o se activa `parar` a mitad, la corta y la deja pendiente.
+    """
+    from app.crud import ingest_service  # Importación diferida: solo la necesitan los workers
+
+    db = SessionLocal()
+    job = db.get(IngestJob, job_id)
+    checkpoint = CheckpointJob(job)
+    reportador = ReportadorProgreso(job_id, checkpoint, ppid, parar)
+    estado_final = ERROR
+    try:
+        print(f"⚙️ Job {job_id}: procesando {job.filename} (intento {job.intentos}, fase '{job.fase or '-'}')")
+        if job.modo == MODO_EDICION:
+            # Transacción única: si se interrumpe, se repite entera (el diff es idempotente)
+            resultado = ingest_service.procesar_nueva_edicion(
+                db, job.libro_id, job.ruta_pdf, job.filename,
+                progress_callback=reportador, pdf_sha256=job.pdf_sha256,
+            )
+        else:
+            resultado = _reutilizar_libro(db, job) if job.pdf_sha256 and not job.fase else None
+        if resultado is None:
+            resultado = ingest_service.procesar_archivo_temario(
+                db, job.ruta_pdf, job.filename, job.account_id,
+                progress_callback=reportador, titulo=job.titulo, licencia_id=job.licencia_id,
+                checkpoint=checkpoint, pdf_sha256=job.pdf_sha256,
+            )
+        reportador.cerrar()
+        if reportador.abandonado.is_set():
+            # La ingesta convierte la excepción en {"error": ...}; lo confirmado hasta el último checkpoint se conserva
+            _reencolar_job(db, job_id)
+            estado_final = PENDIENTE
+        elif not isinstance(resultado, dict) or "error" in resultado:
+            error = resultado.get("error") if isinstance(resultado, dict) else "Resultado inesperado"
+            _finalizar_job(db, job_id, ERROR, f"Error en la ingesta: {error}", 0, resultado=resultado)
+        else:
+            estado_final = COMPLETADO
+            _finalizar_job(db, job_id, COMPLETADO, "Proceso completado exitosamente", 100,
+                           libro_id=resultado.get("libro_id"), resultado=resultado)
+            if TTS_PRERENDER_AFTER_INGEST and not resultado.get("duplicado"):
+                _prerenderizar_tts(db, resultado["libro_id"])
+    except Exception as e:
+        reportador.cerrar()
+        db.rollback()
+        if reportador.abandonado.is_set():
+            _reencolar_job(db, job_id)
+            estado_final = PENDIENTE
+        else:
+            traceback.print_exc()
+            _finalizar_job(db, job_id, ERROR, str(e), 0)
+    finally:
+        # El PDF se queda en el almacén: lo referencia Libro.pdf_path y permite reintentar_job()
+        db.close()
+    print(f"{'✅' if estado_final == COMPLETADO else '⏸️' if estado_final == PENDIENTE else '❌'} Job {job_id}: {estado_final}")
+
+
+def _reutilizar_libro(db: Session, job: IngestJob) -> Optional[Dict]:
+    """
+    Antes de ingestar, comprueba si el mismo PDF ya se ingirió (p. ej. otra subida que
+    terminó mientras este trabajo esperaba en la cola): en la misma licencia se enlaza
+    ese libro; en otra, se clona. None si hay que ingestar.
+    """
+    from app.crud import blob_service
+
+    libro = blob_service.buscar_libro(db, job.pdf_sha256, job.licencia_id)
+    if libro is not None:
+        return {"mensaje": "Libro ya existente", "libro_id": libro.id, "duplicado": True}
+    origen = blob_service.buscar_libro_origen(db, job.pdf_sha256)
+    if origen is None:
+        return None
+    libro, chunks = blob_service.clonar_libro(db, origen, job.licencia_id, job.titulo)
+    return {"mensaje": f"Libro copiado del libro {origen.id}", "libro_id": libro.id, "bloques": chunks, "clonado_de": origen.id}
+
+
+def _prerenderizar_tts(db: Session, libro_id: int):
+    """Pre-renderizar audio de respuestas fijas/bloques del libro recién ingerido."""
+    try:
+        from app.crud import rag_service, tts_service
+        respuestas = rag_service.obtener_respuestas_pre_renderizables(db, libro_id=libro_id)
+        tts_service.prerenderizar_frases(respuestas)
+    except Exception as e_tts:
+        print(f"[TTS prerender] ⚠️ Error tras ingesta (no crítico): {e_tts}")
+
+
+def ejecutar_worker(nombre: str, parar: Optional[threading.Event] = None, ppid: Optional[int] = None):
+    """
+    Bucle de un worker: reclama y procesa trabajos de uno en uno hasta que se le pida
+    parar (o muera el proceso padre, si se indica `ppid`). Ambas cosas cortan también
+    el trabajo en curso, que se reencola sin gastar un intento.
+    """
+    print(f"👷 Worker de ingesta '{nombre}' iniciado")
+    ultima_recuperacion = 0.0
+    while not (parar and parar.is_set()):
+        if ppid is not None and os.getppid() != ppid:
+            print(f"👷 Worker '{nombre}': el proceso padre terminó, saliendo")
+            return
+        db = SessionLocal()
+        try:
+            if time.monotonic() - ultima_recuperacion >= JOB_LATIDO_SEG:
+                recuperar_jobs_huerfanos(db)
+                ultima_recuperacion = time.monotonic()
+            job_id = _reclamar_job(db, nombre)
+        except Exception as e:
+            print(f"   ⚠️ Worker '{nombre}': error consultando la cola: {e}")
+            job_id = None
+        finally:
+            db.close()
+
+        if job_id is None:
+            if parar:
+                parar.wait(JOB_POLL_SEG)
+            else:
+                time.sleep(JOB_POLL_SEG)
+            continue
+        procesar_job(job_id, ppid, parar)
+
+# ============================================================================
+# Difusión de progreso (LISTEN/NOTIFY → SSE)
+# ============================================================================
+
+def _entregar(cola: asyncio.Queue, evento: Dict):
+    """Encola sin bloquear; si el cliente va lento se descarta el evento más viejo (el progreso se pisa)."""
+    if cola.full():
+        cola.get_nowait()
+    cola.put_nowait(evento)
+
+
+class DifusorProgreso:
+    """
+    Reparte los NOTIFY de CANAL_PROGRESO entre los clientes SSE de este proceso.
+    Un solo hilo con una conexión LISTEN (se abre con el primer suscriptor y se
+    reconecta si se cae); cada cliente solo tiene una asyncio.Queue. Cuántas pestañas
+    sigan un trabajo no cambia la carga de la base de datos.
+    """
+
+    def __init__(self):
+        self.suscriptores: Dict[int, List[tuple]] = {}  # job_id -> [(loop, cola)]
+        self.lock = threading.Lock()
+        self.hilo: Optional[threading.Thread] = None
+
+    def suscribir(self, job_id: int) -> asyncio.Queue:
+        cola = asyncio.Queue(maxsize=SSE_COLA_EVENTOS)
+        with self.lock:
+            self.suscriptores.setdefault(job_id, []).append((asyncio.get_running_loop(), cola))
+            if self.hilo is None or not self.hilo.is_alive():
+                self.hilo = threading.Thread(target=self._escuchar, name="difusor-progreso", daemon=True)
+                self.hilo.start()
+        return cola
+
+    def desuscribir(self, job_id: int, cola: asyncio.Queue):
+        with self.lock:
+            restantes = [s for s in self.suscriptores.get(job_id, []) if s[1] is not cola]
+            if restantes:
+                self.suscriptores[job_id] = restantes
+            else:
+                self.suscriptores.pop(job_id, None)
+
+    def _repartir(self, evento: Dict):
+        with self.lock:
+            destinos = list(self.suscriptores.get(evento.get("job_id"), []))
+        for loop, cola in destinos:
+            try:
+                loop.call_soon_threadsafe(_entregar, cola, evento)
+            except RuntimeError:
+                pass  # Bucle cerrado: el cliente ya se fue
+
+    def _escuchar(self):
+        while True:
+            conexion = None
+            try:
+                conexion = engine.raw_connection()
+                pg = conexion.driver_connection  # psycopg2
+                pg.autocommit = True
+                with pg.cursor() as cursor:
+                    cursor.execute(f"LISTEN {CANAL_PROGRESO}")
+                print(f"📡 Difusor de progreso escuchando '{CANAL_PROGRESO}'")
+                while True:
+                    if select.select([pg], [], [], SSE_PING_SEG) == ([], [], []):
+                        continue
+                    pg.poll()
+                    while pg.notifies:
+                        notificacion = pg.notifies.pop(0)
+                        try:
+                            self._repartir(json.loads(notificacion.payload))
+                        except ValueError:
+                            pass
+            except Exception as e:
+                print(f"   ⚠️ Difusor de progreso: {e}. Reconectando...")
+                if conexion is not None:
+                    conexion.invalidate()  # No devolver al pool una conexión con LISTEN
+                time.sleep(JOB_POLL_SEG)
+
+
+difusor = DifusorProgreso()
+
+
+def evento_actual(job_id: int) -> Optional[Dict]:
+    """Estado actual del trabajo como evento (primer mensaje de cada cliente SSE)."""
+    db = SessionLocal()
+    try:
+        job = db.get(IngestJob, job_id)
+        if job is None:
+            return None
+        return _evento(
+            job.id, job.estado, job.mensaje, job.porcentaje, fase=job.fase,
+            chunks=(job.checkpoint or {}).get("chunks", 0), libro_id=job.libro_id,
+        )
+    finally:
+        db.close()
+
+
+def formato_sse(evento: Dict, nombre: str = "progreso") -> str:
+    return f"event: {nombre}\ndata: {json.dumps(evento, default=str)}\n\n"
+
+# ============================================================================
+# Pool de procesos
+# ============================================================================
+
+def _proceso_worker(indice: int, ppid: int):
+    """
+    Punto de entrada de cada proceso del pool (función de módulo para poder lanzarla con spawn).
+    SIGTERM/SIGINT no matan el proceso: piden parar, y el trabajo en curso se reencola.
+    """
+    parar = threading.Event()
+    for senal in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(senal, lambda *_: parar.set())
+    ejecutar_worker(f"{socket.gethostname()}:{os.getpid()}:{indice}", parar=parar, ppid=ppid)
+
+
+def iniciar_pool_workers(procesos: int = INGEST_WORKERS) -> List[multiprocessing.Process]:
+    """
+    Lanza `procesos` workers con spawn (no heredan hilos ni conexiones de la API).
+    No son daemon porque la ingesta abre a su vez pools de procesos; salen solos si
+    muere el padre y se terminan con detener_pool_workers().
+    """
+    contexto = multiprocessing.get_context("spawn")
+    pool = []
+    for indice in range(procesos):
+        proceso = contexto.Process(
+            target=_proceso_worker, args=(indice, os.getpid()), name=f"ingest-worker-{indice}"
+        )
+        proceso.start()
+        pool.append(proceso)
+    return pool
+
+
+def detener_pool_workers(pool: List[multiprocessing.Process], timeout: float = JOB_PARADA_SEG):
+    """
+    Pide parar a los workers (terminate() = SIGTERM en POSIX): cada uno reencola su trabajo
+    en curso sin gastar intento y sale. Los que sigan vivos tras `timeout` se matan; su
+    trabajo lo recupera recuperar_jobs_huerfanos. En Windows terminate() ya es inmediato.
+    """
+    for proceso in pool:
+        if proceso.is_alive():
+            proceso.terminate()
+    limite = time.monotonic() + timeout
+    for proceso in pool:
+        proceso.join(max(0.0, limite - time.monotonic()))
+    for proceso in pool:
+        if proceso.is_alive():
+            print(f"⚠️ {proceso.name} no terminó en {timeout:.0f}s: kill()")
+            proceso.kill()
+            proceso.join()
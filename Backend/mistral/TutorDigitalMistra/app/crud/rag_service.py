@@ -1,17 +1,15 @@
 from typing import Optional, List, Dict, Any
 from sqlalchemy.orm import Session, joinedload
-from sqlalchemy import select, func, and_
+from sqlalchemy import select, func, and_, text
 from app.models.modelos import (
     BaseConocimiento, MensajeChat, SesionChat, Usuario, Temario, EmbeddingCache, ProgresoAlumno,
     Libro, ChatCitas, PreguntaComun, Test, IntentoAlumno, EjercicioCodigo, Enrollment, Assessment, TestScore
 )
 from app.schemas.schemas import PreguntaUsuario, RespuestaTutor, ConocimientoCreate
 from app.crud.embedding_service import generar_embedding  # OpenAI embeddings
+from app.crud.rate_limit_service import esperar, estimar_tokens_mensajes, PROVEEDOR_MISTRAL
+from app.crud.circuit_breaker_service import breaker_embeddings, breaker_chat, registrar_consulta
 import os
-import time
-import threading
-import functools
-from collections import defaultdict
 
 try:
     from mistralai import Mistral
@@ -22,9 +20,10 @@ except ImportError:
 api_key = os.getenv("MISTRAL_API_KEY")
 agent_id = os.getenv("MISTRAL_AGENT_ID", "ag_019c417c78a875a6abb18436607fae73") 
 DEFAULT_MODEL = os.getenv("LLM_MODEL", "mistral-large-latest")
+CHAT_TIMEOUT_MS = int(os.getenv("CHAT_TIMEOUT_MS", "30000"))
 
 if api_key and Mistral:
-    client = Mistral(api_key=api_key)
+    client = Mistral(api_key=api_key, timeout_ms=CHAT_TIMEOUT_MS)
 else:
     client = None
 
@@ -126,42 +125,58 @@ NUNCA pidas perdón como IA. Si te equivocas, sigue actuando.
 """.strip()
 
 # ============================================================================
-# 1. RATE LIMITING & RETRY
+# RESPUESTAS FIJAS (Deterministas → pre-renderizables en la caché TTS)
 # ============================================================================
 
-class RateLimiter:
-    def __init__(self, max_requests: int = 20, time_window: float = 60.0):
-        self.max_requests = max_requests
-        self.time_window = time_window
-        self.requests = defaultdict(list)
-        self.lock = threading.Lock()
+MSG_SIN_TEMARIO = "[NoneBrows] No tienes ningún temario asignado todavía."
+MSG_CONTENIDO_COMPLETADO = "[Happy] ¡Felicidades! Has completado todo el contenido disponible. ¿Quieres repasar algún tema en particular?"
+MSG_LAPSUS_TECNICO = "[UpBrows] Lo siento, tuve un pequeño lapsus técnico. ¿Podrías repetirme la pregunta?"
+MSG_RESPUESTA_CORTADA = "[UpBrows] Perdona, se me ha cortado la respuesta. ¿Quieres que te la repita?"
+MSG_SIMULACION = "[NoneBrows] Modo simulación (Sin API Key)."
+MSG_SIMULACION_STREAM = "[NoneBrows] Modo simulación (Sin API Key configurada)."
+
+RESPUESTAS_FIJAS = [
+    MSG_SIN_TEMARIO,
+    MSG_CONTENIDO_COMPLETADO,
+    MSG_LAPSUS_TECNICO,
+    MSG_RESPUESTA_CORTADA,
+    MSG_SIMULACION,
+    MSG_SIMULACION_STREAM,
+]
+
+
+def _formatear_bloque_sin_api(contenido_libro: str, tipo: str) -> str:
+    """Texto literal que devuelve el modo AVANCE cuando no hay cliente Mistral."""
+    if tipo == 'codigo':
+        return f"[NoneBrows][LHandAletear] Aquí tienes el ejemplo práctico:\n\n```python\n{contenido_libro}\n```\n\n¿Lo analizamos juntos?"
+    return f"[NoneBrows][LHandAletear] {contenido_libro}\n\n¿Te hace sentido? ¿Seguimos?"
+
+
+def obtener_respuestas_pre_renderizables(db: Session, libro_id: int = None, incluir_bloques: bool = None) -> List[str]:
+    """
+    Devuelve las respuestas deterministas del tutor para pre-renderizar su audio.
+    Los bloques del libro solo se incluyen en modo fallback (sin API) o si se pide
+    explícitamente, porque con Mistral activo el texto de AVANCE lo genera el LLM.
+    """
+    respuestas = list(RESPUESTAS_FIJAS)
     
-    def wait_if_needed(self, key: str = "default"):
-        with self.lock:
-            now = time.time()
-            self.requests[key] = [ts for ts in self.requests[key] if now - ts < self.time_window]
-            if len(self.requests[key]) >= self.max_requests:
-                wait_time = self.time_window - (now - self.requests[key][0])
-                if wait_time > 0: time.sleep(wait_time)
-            self.requests[key].append(time.time())
-
-rate_limiter = RateLimiter()
-
-def retry_with_backoff(max_retries: int = 3, base_delay: float = 1.0):
-    def decorator(func):
-        @functools.wraps(func)
-        def wrapper(*args, **kwargs):
-            for attempt in range(max_retries):
-                try:
-                    return func(*args, **kwargs)
-                except Exception as e:
-                    if "429" in str(e) and attempt < max_retries - 1:
-                        time.sleep(base_delay * (2 ** attempt))
-                    elif attempt == max_retries - 1:
-                        raise e
-            return None
-        return wrapper
-    return decorator
+    if incluir_bloques is None:
+        incluir_bloques = client is None
+    
+    if incluir_bloques:
+        query = db.query(BaseConocimiento.contenido, BaseConocimiento.tipo_contenido)
+        if libro_id:
+            query = query.join(Temario).filter(Temario.libro_id == libro_id)
+        for contenido, tipo in query.yield_per(500):
+            respuestas.append(_formatear_bloque_sin_api(contenido, tipo))
+    
+    return respuestas
+
+# ============================================================================
+# 1. RATE LIMITING & RETRY
+# ============================================================================
+
+# Límites RPM/TPM compartidos por modelo: ver app.crud.rate_limit_service
 
 # ============================================================================
 # 2. EMBEDDINGS — Delegados a embedding_service.py
@@ -169,6 +184,53 @@ def retry_with_backoff(max_retries: int = 3, base_delay: float = 1.0):
 # La función generar_embedding() se importa desde app.crud.embedding_service
 # Usa OpenAI text-embedding-3-small (1536 dims) con caché en PostgreSQL
 
+def _embedding_consulta(db: Session, texto: str) -> Optional[list]:
+    """
+    Embedding de la pregunta o None si el proveedor no responde (circuito abierto,
+    timeout tras reintentos...). Con None el llamante usa búsqueda léxica.
+    """
+    if breaker_embeddings.esta_abierto():
+        return None
+    try:
+        return generar_embedding(db, texto)
+    except Exception as e:
+        print(f"⚠️ Embeddings no disponibles ({e}). Modo degradado: búsqueda léxica.")
+        return None
+
+
+def _buscar_lexico(db: Session, texto: str, licencia_id: Optional[int], limite: int) -> list:
+    """Búsqueda solo full-text (índice GIN de busqueda_texto), sin embeddings."""
+    return db.execute(
+        text("""
+            SELECT bc.id, bc.contenido, bc.pagina, bc.temario_id,
+                   ts_rank(bc.busqueda_texto, q)::FLOAT AS score
+            FROM base_conocimiento bc
+            JOIN temario t ON bc.temario_id = t.id
+            JOIN libros l ON t.libro_id = l.id,
+                 plainto_tsquery('spanish', unaccent(:q_text)) q
+            WHERE bc.busqueda_texto @@ q
+              AND t.activo
+              AND (CAST(:licencia_id AS INT) IS NULL OR l.licencia_id = :licencia_id)
+            ORDER BY score DESC
+            LIMIT :limit
+        """),
+        {"q_text": texto, "licencia_id": licencia_id, "limit": limite}
+    ).all()
+
+
+def _chat_protegido(msgs: list) -> Optional[str]:
+    """Llamada de chat a Mistral tras el circuit breaker. None si el circuito está abierto."""
+    if not breaker_chat.permitir():
+        return None
+    esperar(PROVEEDOR_MISTRAL, DEFAULT_MODEL, estimar_tokens_mensajes(msgs))
+    try:
+        resp = client.chat.complete(model=DEFAULT_MODEL, messages=msgs)
+    except Exception:
+        breaker_chat.registrar_fallo()
+        raise
+    breaker_chat.registrar_exito()
+    return resp.choices[0].message.content
+
 # ============================================================================
 # 3. UTILIDADES DE CONTEXTO JERÁRQUICO
 # ============================================================================
@@ -423,7 +485,7 @@ def preguntar_al_tutor(db: Session, pregunta: PreguntaUsuario) -> RespuestaTutor
             ubicacion = _obtener_info_ubicacion(db, temario_id)
             respuesta_texto = f"[NoneBrows] {ubicacion}"
         else:
-            respuesta_texto = "[NoneBrows] No tienes ningún temario asignado todavía."
+            respuesta_texto = MSG_SIN_TEMARIO
         fuentes = ["Navegación jerárquica"]
     
     # --- RAMA B: MODO TUTOR SECUENCIAL (Enseñar palabra a palabra) ---
@@ -459,20 +521,20 @@ def preguntar_al_tutor(db: Session, pregunta: PreguntaUsuario) -> RespuestaTutor
             msgs.extend(historial)
             msgs.append({"role": "user", "content": prompt_contenido})
             
+            respuesta_texto = None
             if client:
-                rate_limiter.wait_if_needed("chat")
-                resp = client.chat.complete(model=DEFAULT_MODEL, messages=msgs)
-                respuesta_texto = resp.choices[0].message.content
-            else:
-                # Fallback sin API: mostrar contenido directo (usando nuevas etiquetas)
-                if tipo == 'codigo':
-                    respuesta_texto = f"[NoneBrows][LHandAletear] Aquí tienes el ejemplo práctico:\n\n```python\n{contenido_libro}\n```\n\n¿Lo analizamos juntos?"
-                else:
-                    respuesta_texto = f"[NoneBrows][LHandAletear] {contenido_libro}\n\n¿Te hace sentido? ¿Seguimos?"
+                try:
+                    respuesta_texto = _chat_protegido(msgs)
+                except Exception as e:
+                    print(f"Error Mistral: {e}")
+                registrar_consulta("chat", degradada=respuesta_texto is None)
+            if respuesta_texto is None:
+                # Fallback sin API (o proveedor caído): mostrar contenido directo (usando nuevas etiquetas)
+                respuesta_texto = _formatear_bloque_sin_api(contenido_libro, tipo)
             
             fuentes = [f"Ref: {bloque.ref_fuente} (Pag {bloque.pagina})"]
         else:
-            respuesta_texto = "[Happy] ¡Felicidades! Has completado todo el contenido disponible. ¿Quieres repasar algún tema en particular?"
+            respuesta_texto = MSG_CONTENIDO_COMPLETADO
     
     # --- RAMA C: MODO RAG "MEGA CONTEXTO" (Estructura Global + Tema Actual + Búsqueda) ---
     else:
@@ -498,19 +560,24 @@ def preguntar_al_tutor(db: Session, pregunta: PreguntaUsuario) -> RespuestaTutor
                 docs_map[b.id] = b
 
         # C. BÚSQUEDA HÍBRIDA COMPLEMENTARIA (Para dudas que cruzan temas)
-        vector = generar_embedding(db, pregunta.texto)
+        #    Si el proveedor de embeddings está caído → solo full-text (latencia acotada)
+        vector = _embedding_consulta(db, pregunta.texto)
+        registrar_consulta("busqueda", degradada=vector is None)
         
-        docs_raw = db.execute(
-            text("SELECT * FROM buscar_contenido_hibrido(:q_text, :q_emb, :thresh, :limit, :libro_id, :licencia_id)"),
-            {
-                "q_text": pregunta.texto,
-                "q_emb": str(vector),
-                "thresh": 0.25, 
-                "limit": 15, 
-                "libro_id": None,
-                "licencia_id": licencia_id
-            }
-        ).all()
+        if vector is not None:
+            docs_raw = db.execute(
+                text("SELECT * FROM buscar_contenido_hibrido(:q_text, :q_emb, :thresh, :limit, :libro_id, :licencia_id)"),
+                {
+                    "q_text": pregunta.texto,
+                    "q_emb": str(vector),
+                    "thresh": 0.25, 
+                    "limit": 15, 
+                    "libro_id": None,
+                    "licencia_id": licencia_id
+                }
+            ).all()
+        else:
+            docs_raw = _buscar_lexico(db, pregunta.texto, licencia_id, limite=15)
         
         for row in docs_raw:
             if row.id not in docs_map:
@@ -563,15 +630,16 @@ def preguntar_al_tutor(db: Session, pregunta: PreguntaUsuario) -> RespuestaTutor
         
         # Llamada a Mistral
         if client:
-            rate_limiter.wait_if_needed("chat")
             try:
-                resp = client.chat.complete(model=DEFAULT_MODEL, messages=msgs)
-                respuesta_texto = resp.choices[0].message.content
+                respuesta_texto = _chat_protegido(msgs)
             except Exception as e:
                 print(f"Error Mistral: {e}")
-                respuesta_texto = "[UpBrows] Lo siento, tuve un pequeño lapsus técnico. ¿Podrías repetirme la pregunta?"
+                respuesta_texto = None
+            registrar_consulta("chat", degradada=respuesta_texto is None)
+            if respuesta_texto is None:
+                respuesta_texto = MSG_LAPSUS_TECNICO
         else:
-            respuesta_texto = "[NoneBrows] Modo simulación (Sin API Key)."
+            respuesta_texto = MSG_SIMULACION
 
     # Guardar historial y citas
     msg_user = MensajeChat(sesion_id=sesion.id, rol="user", texto=pregunta.texto)
@@ -634,12 +702,19 @@ def preguntar_al_tutor_stream(db: Session, pregunta: PreguntaUsuario):
     alias_context = f"SITUACIÓN: El alumno con el que hablas se llama {alumno_nombre}. Ya le conoces."
     
     # Buscar contexto RAG (Filtrado por Licencia)
-    vector = generar_embedding(db, pregunta.texto)
-    docs = db.query(BaseConocimiento).join(Temario).join(Libro).filter(
-        Libro.licencia_id == alumno.licencia_id
-    ).order_by(
-        BaseConocimiento.embedding.cosine_distance(vector)
-    ).limit(5).all()
+    vector = _embedding_consulta(db, pregunta.texto)
+    registrar_consulta("busqueda", degradada=vector is None)
+    if vector is not None:
+        docs = db.query(BaseConocimiento).join(Temario).join(Libro).filter(
+            Libro.licencia_id == alumno.licencia_id,
+            Temario.activo == True
+        ).order_by(
+            BaseConocimiento.embedding.cosine_distance(vector)
+        ).limit(5).all()
+    else:
+        ids = [row.id for row in _buscar_lexico(db, pregunta.texto, alumno.licencia_id, limite=5)]
+        por_id = {b.id: b for b in db.query(BaseConocimiento).filter(BaseConocimiento.id.in_(ids)).all()}
+        docs = [por_id[i] for i in ids if i in por_id]
     
     contexto_str = _construir_contexto_enriquecido(db, docs)
     
@@ -665,36 +740,66 @@ def preguntar_al_tutor_stream(db: Session, pregunta: PreguntaUsuario):
         "content": user_msg_stream
     })
     
-    if client:
-        rate_limiter.wait_if_needed("stream")
-        stream = client.chat.stream(model=DEFAULT_MODEL, messages=msgs)
+    if client and not breaker_chat.permitir():
+        registrar_consulta("chat", degradada=True)
+        yield MSG_LAPSUS_TECNICO
+    elif client:
+        esperar(PROVEEDOR_MISTRAL, DEFAULT_MODEL, estimar_tokens_mensajes(msgs))
+        try:
+            stream = client.chat.stream(model=DEFAULT_MODEL, messages=msgs)
+        except Exception as e:
+            breaker_chat.registrar_fallo()
+            registrar_consulta("chat", degradada=True)
+            print(f"Error Mistral (stream): {e}")
+            yield MSG_LAPSUS_TECNICO
+            return
         full_text = ""
-        for chunk in stream:
-            try:
-                # La estructura de Mistral devuelve CompletionEvent con .data que contiene el payload
-                if hasattr(chunk, 'data'):
-                    response_obj = chunk.data
-                else:
-                    response_obj = chunk
-
-                # Acceder al contenido de manera segura
-                content = response_obj.choices[0].delta.content
-                if content:
-                    full_text += content
-                    yield content
-            except AttributeError as e:
-                print(f"Error procesando chunk Mistral: {e} | Chunk dir: {dir(chunk)}")
-                continue
-            except Exception as e:
-                print(f"Error inesperado en stream: {e}")
-                continue
-        
+        interrumpido = None
+        try:
+            for chunk in stream:
+                try:
+                    # La estructura de Mistral devuelve CompletionEvent con .data que contiene el payload
+                    if hasattr(chunk, 'data'):
+                        response_obj = chunk.data
+                    else:
+                        response_obj = chunk
+
+                    # Acceder al contenido de manera segura
+                    content = response_obj.choices[0].delta.content
+                    if content:
+                        full_text += content
+                        yield content
+                except AttributeError as e:
+                    print(f"Error procesando chunk Mistral: {e} | Chunk dir: {dir(chunk)}")
+                    continue
+                except Exception as e:
+                    print(f"Error inesperado en stream: {e}")
+                    continue
+        except Exception as e:
+            # El proveedor cortó el stream a mitad: cuenta como fallo para el circuit breaker
+            breaker_chat.registrar_fallo()
+            print(f"Error Mistral (stream interrumpido): {e}")
+            interrumpido = str(e)
+        else:
+            breaker_chat.registrar_exito()
+        registrar_consulta("chat", degradada=interrumpido is not None)
+
+        if interrumpido is not None:
+            if not full_text:
+                yield MSG_LAPSUS_TECNICO
+                return
+            # Respuesta a medias: se avisa al alumno y se guarda marcada como incompleta
+            yield f"\n\n{MSG_RESPUESTA_CORTADA}"
+
         # Guardar al finalizar
         db.add(MensajeChat(sesion_id=sesion.id, rol="user", texto=pregunta.texto))
-        db.add(MensajeChat(sesion_id=sesion.id, rol="assistant", texto=full_text))
+        db.add(MensajeChat(
+            sesion_id=sesion.id, rol="assistant", texto=full_text,
+            info_tecnica={"incompleta": True, "error": interrumpido} if interrumpido is not None else None,
+        ))
         db.commit()
     else:
-        yield "[NoneBrows] Modo simulación (Sin API Key configurada)."
+        yield MSG_SIMULACION_STREAM
 
 # ============================================================================
 # 7. SINCRONIZACIÓN TEMARIO → BASE CONOCIMIENTO (Utilidad)
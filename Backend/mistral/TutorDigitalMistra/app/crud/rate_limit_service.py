@@ -0,0 +1,202 @@
+"""
+Servicio de Rate Limiting compartido para todas las llamadas salientes a IA
+(chat Mistral, embeddings Azure OpenAI, evaluaciones e índice de ingesta).
+
+Cada par (proveedor, modelo) tiene dos token buckets: peticiones por minuto (RPM)
+y tokens por minuto (TPM). Las esperas se calculan bajo el lock pero se duermen
+FUERA de él, así un hilo limitado no congela al resto. Las respuestas 429 con
+cabecera Retry-After pausan el bucket entero para todos los hilos.
+"""
+import os
+import time
+import threading
+import functools
+from typing import Dict, Tuple, Optional, List
+
+from app.crud.chunking_service import contar_tokens
+
+# ============================================================================
+# Configuración (límites por proveedor/modelo)
+# ============================================================================
+
+PROVEEDOR_MISTRAL = "mistral"
+PROVEEDOR_AZURE = "azure_openai"
+
+# (rpm, tpm) por proveedor. Se puede afinar por modelo con configurar_limite().
+LIMITES_POR_DEFECTO: Dict[str, Tuple[float, float]] = {
+    PROVEEDOR_MISTRAL: (
+        float(os.getenv("RATE_LIMIT_MISTRAL_RPM", "20")),
+        float(os.getenv("RATE_LIMIT_MISTRAL_TPM", "500000")),
+    ),
+    PROVEEDOR_AZURE: (
+        float(os.getenv("RATE_LIMIT_EMBED_RPM", "50")),
+        float(os.getenv("RATE_LIMIT_EMBED_TPM", "350000")),
+    ),
+}
+
+# ============================================================================
+# Token Bucket
+# ============================================================================
+
+class TokenBucket:
+    """
+    Bucket que se rellena de forma continua a `capacidad` unidades por minuto.
+    `reservar()` descuenta siempre (puede quedar en negativo = deuda) y devuelve
+    cuántos segundos debe esperar el llamante antes de hacer la petición.
+    """
+
+    def __init__(self, capacidad_por_minuto: float):
+        self.capacidad = max(1.0, capacidad_por_minuto)
+        self.ritmo = self.capacidad / 60.0  # Unidades por segundo
+        self.disponibles = self.capacidad
+        self.ultimo = time.monotonic()
+
+    def _rellenar(self, ahora: float):
+        self.disponibles = min(self.capacidad, self.disponibles + (ahora - self.ultimo) * self.ritmo)
+        self.ultimo = ahora
+
+    def reservar(self, unidades: float, ahora: float) -> float:
+        self._rellenar(ahora)
+        self.disponibles -= min(unidades, self.capacidad)  # Una petición enorme nunca bloquea para siempre
+        return 0.0 if self.disponibles >= 0 else -self.disponibles / self.ritmo
+
+
+class LimitadorModelo:
+    """Buckets RPM + TPM y pausa por Retry-After de un (proveedor, modelo)."""
+
+    def __init__(self, rpm: float, tpm: float):
+        self.rpm = TokenBucket(rpm)
+        self.tpm = TokenBucket(tpm)
+        self.pausa_hasta = 0.0
+        self.lock = threading.Lock()
+        self.esperas = 0
+        self.segundos_esperados = 0.0
+
+    def reservar(self, tokens: int) -> float:
+        """Reserva capacidad y devuelve los segundos a esperar (sin dormir)."""
+        with self.lock:
+            ahora = time.monotonic()
+            espera = max(
+                self.rpm.reservar(1, ahora),
+                self.tpm.reservar(tokens, ahora) if tokens else 0.0,
+                self.pausa_hasta - ahora,
+            )
+            if espera > 0:
+                self.esperas += 1
+                self.segundos_esperados += espera
+            return max(0.0, espera)
+
+    def pausar(self, segundos: float):
+        """Retry-After: ningún hilo sale hacia este modelo hasta que pase la pausa."""
+        with self.lock:
+            self.pausa_hasta = max(self.pausa_hasta, time.monotonic() + segundos)
+
+
+_limitadores: Dict[Tuple[str, str], LimitadorModelo] = {}
+_limitadores_lock = threading.Lock()
+
+
+def configurar_limite(proveedor: str, modelo: str, rpm: float, tpm: float) -> None:
+    """Fija (o sustituye) los límites de un modelo concreto."""
+    with _limitadores_lock:
+        _limitadores[(proveedor, modelo)] = LimitadorModelo(rpm, tpm)
+
+
+def obtener_limitador(proveedor: str, modelo: str) -> LimitadorModelo:
+    clave = (proveedor, modelo)
+    limitador = _limitadores.get(clave)
+    if limitador is None:
+        with _limitadores_lock:
+            limitador = _limitadores.get(clave)
+            if limitador is None:
+                rpm, tpm = LIMITES_POR_DEFECTO.get(proveedor, (60.0, 1_000_000.0))
+                limitador = LimitadorModelo(rpm, tpm)
+                _limitadores[clave] = limitador
+    return limitador
+
+# ============================================================================
+# Esperas
+# ============================================================================
+
+def estimar_tokens_mensajes(mensajes: List[Dict]) -> int:
+    """Tokens de entrada aproximados de una lista de mensajes de chat."""
+    return sum(contar_tokens(m.get("content") or "") for m in mensajes)
+
+
+def esperar(proveedor: str, modelo: str, tokens: int = 0) -> float:
+    """Bloquea SOLO al hilo llamante hasta que haya presupuesto. Devuelve lo esperado."""
+    espera = obtener_limitador(proveedor, modelo).reservar(tokens)
+    if espera > 0:
+        time.sleep(espera)
+    return espera
+
+
+def estado_limites() -> Dict[str, Dict]:
+    """Resumen de esperas acumuladas por modelo (para métricas)."""
+    with _limitadores_lock:
+        items = list(_limitadores.items())
+    return {
+        f"{proveedor}/{modelo}": {
+            "esperas": lim.esperas,
+            "segundos_esperados": round(lim.segundos_esperados, 2),
+            "rpm": lim.rpm.capacidad,
+            "tpm": lim.tpm.capacidad,
+        }
+        for (proveedor, modelo), lim in items
+    }
+
+# ============================================================================
+# Retry con Backoff Exponencial + Retry-After
+# ============================================================================
+
+def _es_rate_limit(e: Exception) -> bool:
+    texto = str(e)
+    return "429" in texto or "rate" in texto.lower() or getattr(e, "status_code", None) == 429
+
+
+def _es_timeout(e: Exception) -> bool:
+    """APITimeoutError (OpenAI), ReadTimeout/ConnectTimeout (httpx) o mensajes 'timed out'."""
+    return "timeout" in type(e).__name__.lower() or "timed out" in str(e).lower()
+
+
+def extraer_retry_after(e: Exception) -> Optional[float]:
+    """Lee Retry-After / retry-after-ms de la respuesta HTTP adjunta a la excepción (OpenAI o Mistral)."""
+    respuesta = getattr(e, "response", None) or getattr(e, "raw_response", None)
+    cabeceras = getattr(respuesta, "headers", None) or getattr(e, "headers", None)
+    if not cabeceras:
+        return None
+    try:
+        if cabeceras.get("retry-after-ms"):
+            return float(cabeceras["retry-after-ms"]) / 1000.0
+        if cabeceras.get("retry-after"):
+            return float(cabeceras["retry-after"])
+    except (TypeError, ValueError):
+        return None  # Formato fecha HTTP: se usa el backoff normal
+    return None
+
+
+def retry_with_backoff(proveedor: str, modelo: str, max_retries: int = 3, base_delay: float = 1.0):
+    """
+    Reintenta ante 429/rate limit y timeouts. Si la respuesta trae Retry-After se pausa
+    el limitador del modelo (afecta a todos los hilos) y se espera ese tiempo.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            for attempt in range(max_retries):
+                try:
+                    return func(*args, **kwargs)
+                except Exception as e:
+                    if not (_es_rate_limit(e) or _es_timeout(e)) or attempt == max_retries - 1:
+                        raise
+                    espera = extraer_retry_after(e)
+                    if espera is not None:
+                        obtener_limitador(proveedor, modelo).pausar(espera)
+                    else:
+                        espera = base_delay * (2 ** attempt)
+                    motivo = "Timeout" if _es_timeout(e) else "Rate limit"
+                    print(f"   ⏳ {motivo} {proveedor}/{modelo}, reintento en {espera:.1f}s")
+                    time.sleep(espera)
+            return None
+        return wrapper
+    return decorator
@@ -2,8 +2,15 @@
 Servicio de Text-to-Speech — edge-tts (Microsoft Neural Voices)
 Convierte texto a audio usando las voces neurales gratuitas de Microsoft Edge.
 Rápido, consistente y sin coste.
+Incluye caché en disco para frases repetidas y pre-renderizado de frases fijas.
 """
 import asyncio
+import hashlib
+import os
+import re
+import time
+from typing import Dict, Iterable, List, Optional
+
 import edge_tts
 
 # ============================================================================
@@ -20,6 +27,18 @@ VOCES_DISPONIBLES = {
 
 VOZ_DEFAULT = "es-ES-AlvaroNeural"
 
+# ============================================================================
+# Caché en Disco (audio MP3 por texto + voz + velocidad + tono)
+# ============================================================================
+
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR", "tts_cache")
+
+# Parámetros que usa el frontend (script.js) al pedir audio a /tts.
+# El pre-renderizado genera exactamente estas combinaciones.
+TTS_SPEEDS_PRERENDER = [float(s) for s in os.getenv("TTS_PRERENDER_SPEEDS", "1.2").split(",") if s.strip()]
+TTS_PITCH_PRERENDER = os.getenv("TTS_PRERENDER_PITCH", "+0Hz")
+TTS_PRERENDER_CONCURRENCIA = int(os.getenv("TTS_PRERENDER_CONCURRENCIA", "4"))
+
 
 def _speed_to_rate(speed: float) -> str:
     """
@@ -73,6 +92,40 @@ async def _generar_audio_async(
     return b"".join(audio_chunks)
 
 
+def _clave_cache(texto_limpio: str, voice_id: str, rate: str, pitch: str) -> str:
+    """Clave determinista de caché para una combinación texto/voz/velocidad/tono."""
+    base = f"{voice_id}|{rate}|{pitch}|{texto_limpio}"
+    return hashlib.sha256(base.encode("utf-8")).hexdigest()
+
+
+def _ruta_cache(clave: str) -> str:
+    return os.path.join(TTS_CACHE_DIR, clave[:2], f"{clave}.mp3")
+
+
+def _leer_cache(clave: str) -> Optional[bytes]:
+    ruta = _ruta_cache(clave)
+    try:
+        with open(ruta, "rb") as f:
+            return f.read()
+    except (FileNotFoundError, OSError):
+        return None
+
+
+def _escribir_cache(clave: str, audio: bytes) -> None:
+    """Escritura atómica (tmp + rename) para no servir ficheros a medias."""
+    if not audio:
+        return
+    ruta = _ruta_cache(clave)
+    try:
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        tmp = f"{ruta}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(audio)
+        os.replace(tmp, ruta)
+    except OSError as e:
+        print(f"[TTS cache] ⚠️ No se pudo guardar en caché: {e}")
+
+
 def _limpiar_texto_fluidez(texto: str) -> str:
     """
     Elimina pausas excesivas reemplazando puntuación lenta.
@@ -108,9 +161,18 @@ async def generar_audio_tts_async(
     texto_limpio = _limpiar_texto_fluidez(texto)
     
     voice_id = _resolver_voz(voz)
+    clave = _clave_cache(texto_limpio, voice_id, _speed_to_rate(speed), pitch)
+    
+    cached = _leer_cache(clave)
+    if cached:
+        print(f"[TTS cache] HIT texto='{texto[:40]}...', voz={voice_id}")
+        return cached
+    
     print(f"[TTS edge-tts async] texto='{texto[:40]}...', voz={voice_id}, spd={speed}, pitch={pitch}")
     
-    return await _generar_audio_async(texto_limpio, voice_id, speed, pitch)
+    audio = await _generar_audio_async(texto_limpio, voice_id, speed, pitch)
+    _escribir_cache(clave, audio)
+    return audio
 
 
 def generar_audio_tts(
@@ -121,7 +183,7 @@ def generar_audio_tts(
 ) -> bytes:
     """
     Genera audio desde texto usando edge-tts (Microsoft Neural Voices).
-    Versión síncrona — wrapper para compatibilidad.
+    Versión síncrona — wrapper de generar_audio_tts_async (comparte su caché en disco).
     
     Args:
         texto: El texto a convertir en audio
@@ -139,9 +201,6 @@ def generar_audio_tts(
     if not texto or not texto.strip():
         raise ValueError("El texto no puede estar vacío")
     
-    voice_id = _resolver_voz(voz)
-    print(f"[TTS edge-tts] texto='{texto[:60]}...', voz={voice_id}, speed={speed}")
-    
     # Ejecutar la coroutine async de forma síncrona
     try:
         # Intentar obtener un event loop existente
@@ -153,15 +212,129 @@ def generar_audio_tts(
             with concurrent.futures.ThreadPoolExecutor() as pool:
                 result = pool.submit(
                     asyncio.run,
-                    _generar_audio_async(texto, voice_id, speed)
+                    generar_audio_tts_async(texto, voz, speed)
                 ).result(timeout=60)
             return result
         else:
             return loop.run_until_complete(
-                _generar_audio_async(texto, voice_id, speed)
+                generar_audio_tts_async(texto, voz, speed)
             )
     except RuntimeError:
         # No hay event loop, crear uno nuevo
         return asyncio.run(
-            _generar_audio_async(texto, voice_id, speed)
+            generar_audio_tts_async(texto, voz, speed)
         )
+
+
+# ============================================================================
+# Pre-renderizado de Frases Fijas (job de despliegue / post-ingesta)
+# ============================================================================
+
+def _limpiar_como_cliente(texto: str) -> str:
+    """
+    Réplica de cleanTextForTTS() de front/script.js.
+    El texto que llega a /tts es el ya limpiado por el cliente, así que
+    la caché solo acierta si pre-renderizamos exactamente ese texto.
+    """
+    limpio = re.sub(r"\[.*?\]", "", texto)       # Eliminar [Tags]
+    limpio = re.sub(r"[#*_~`>]", "", limpio)       # Marcadores Markdown
+    limpio = re.sub(r"\n{2,}", ". ", limpio)       # Doble salto -> pausa
+    limpio = limpio.replace("\n", " ")             # Salto simple -> espacio
+    limpio = re.sub(r"\s{2,}", " ", limpio)        # Múltiples espacios
+    return limpio.strip()
+
+
+def fragmentos_tts_cliente(texto_respuesta: str) -> List[str]:
+    """
+    Reproduce cómo el frontend trocea una respuesta completa en peticiones TTS
+    (feedTTSSentenceBuffer + flushTTSSentenceBuffer con el texto entero en el buffer):
+    1er chunk hasta el último terminador (incluye , : ;), y el resto en el flush final.
+    """
+    fragmentos = []
+    ultimo_fin = 0
+    for m in re.finditer(r"[.!?](?:\s|\Z)|[,:;]\s", texto_respuesta):
+        ultimo_fin = m.end()
+
+    resto = texto_respuesta
+    if ultimo_fin:
+        primero = _limpiar_como_cliente(texto_respuesta[:ultimo_fin].strip())
+        if len(primero) > 1:
+            fragmentos.append(primero)
+        resto = texto_respuesta[ultimo_fin:]
+
+    final = _limpiar_como_cliente(resto.strip())
+    if len(final) > 2:
+        fragmentos.append(final)
+    return fragmentos
+
+
+async def prerenderizar_frases_async(
+    respuestas: Iterable[str],
+    voces: Optional[List[str]] = None,
+    speeds: Optional[List[float]] = None,
+    pitch: str = TTS_PITCH_PRERENDER,
+    concurrencia: int = TTS_PRERENDER_CONCURRENCIA,
+) -> Dict[str, int]:
+    """
+    Genera en caché el audio de respuestas deterministas para todas las voces.
+    
+    Args:
+        respuestas: Textos tal como los devuelve el tutor (con etiquetas de animación)
+        voces: Nombres cortos de voz (default: todas las de VOCES_DISPONIBLES)
+        speeds: Velocidades a renderizar (default: las que usa el frontend)
+        pitch: Tono
+        concurrencia: Máximo de síntesis simultáneas contra edge-tts
+    
+    Returns:
+        Contadores {'generados', 'existentes', 'errores'}
+    """
+    voces = voces or list(VOCES_DISPONIBLES.keys())
+    speeds = speeds or TTS_SPEEDS_PRERENDER
+
+    # Deduplicar a nivel de texto final enviado a edge-tts
+    textos = []
+    vistos = set()
+    for r in respuestas:
+        for frag in fragmentos_tts_cliente(r):
+            if frag not in vistos:
+                vistos.add(frag)
+                textos.append(frag)
+
+    stats = {"generados": 0, "existentes": 0, "errores": 0}
+    semaforo = asyncio.Semaphore(max(1, concurrencia))
+
+    async def _renderizar(texto: str, voice_id: str, speed: float):
+        texto_limpio = _limpiar_texto_fluidez(texto)
+        clave = _clave_cache(texto_limpio, voice_id, _speed_to_rate(speed), pitch)
+        if os.path.exists(_ruta_cache(clave)):
+            stats["existentes"] += 1
+            return
+        async with semaforo:
+            try:
+                audio = await _generar_audio_async(texto_limpio, voice_id, speed, pitch)
+                _escribir_cache(clave, audio)
+                stats["generados"] += 1
+            except Exception as e:
+                stats["errores"] += 1
+                print(f"[TTS prerender] ❌ Error en '{texto[:40]}...' ({voice_id}): {e}")
+
+    inicio = time.perf_counter()
+    tareas = [
+        _renderizar(texto, _resolver_voz(voz), speed)
+        for texto in textos
+        for voz in voces
+        for speed in speeds
+    ]
+    await asyncio.gather(*tareas)
+
+    print(
+        f"[TTS prerender] {len(textos)} textos x {len(voces)} voces x {len(speeds)} velocidades: "
+        f"{stats['generados']} generados, {stats['existentes']} ya en caché, "
+        f"{stats['errores']} errores ({time.perf_counter() - inicio:.1f}s)"
+    )
+    return stats
+
+
+def prerenderizar_frases(respuestas: Iterable[str], **kwargs) -> Dict[str, int]:
+    """Versión síncrona para scripts y threads de background (sin event loop propio)."""
+    return asyncio.run(prerenderizar_frases_async(list(respuestas), **kwargs))
@@ -1,11 +1,12 @@
 import asyncio
+import os
 import secrets
 import string
 import logging
 from collections import deque
 from typing import List, Dict, Optional
 from datetime import datetime, timedelta
-from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, Form, Query, Response
+from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, Form, Query, Response, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
@@ -13,7 +14,7 @@ from app.db.database import get_db, engine, SessionLocal
 from app.schemas.schemas import (
     PreguntaUsuario, RespuestaTutor, ContenidoUpdate,
     AssessmentGenerate, AssessmentResponse,
-    GradeOpenRequest, GradeMultipleRequest, GradeResponse,
+    GradeOpenRequest, GradeOpenBatchRequest, GradeMultipleRequest, GradeResponse,
     StudentLogin, AlumnoResponse
 )
 from app.schemas import schemas
@@ -22,6 +23,9 @@ from app.crud import rag_service
 from app.crud import ingest_service
 from app.crud import assessment_service
 from app.crud import tts_service
+from app.crud import embedding_service
+from app.crud import circuit_breaker_service, rate_limit_service
+from app.crud import job_service, blob_service
 from app.auth import get_current_user
 
 # Crear las tablas automáticamente
@@ -50,9 +54,6 @@ deque_handler.setFormatter(logging.Formatter("%(message)s"))
 logging.getLogger().addHandler(deque_handler)
 logging.getLogger().setLevel(logging.INFO)
 
-# Global in-memory storage for upload progress (MVP)
-upload_progress = {}
-
 app = FastAPI(
     title="Tutor Digital API",
     description="API para interactuar con el Tutor Digital basado en RAG, OpenAI Embeddings y Mistral",
@@ -114,98 +115,147 @@ def test():
     return {"mensaje": "Test exitoso"}
 
 
-def _procesar_archivo_en_thread(content: bytes, filename: str, account_id: str, title: str = None, licencia_id: int = None):
-    """
-    Wrapper para procesar archivo en un thread separado.
-    Recibe los bytes del archivo ya leídos para evitar problemas de I/O en threads.
-    """
-    # Derive title for frontend matching
-    # Must match ingest_service logic: filename.replace(".pdf", "")
-    base_title = title if title else filename.replace(".pdf", "")
+@app.on_event("startup")
+def iniciar_workers_ingesta():
+    """Pool de procesos que consume la cola ingest_jobs (INGEST_WORKERS=0 si se usa scripts/ingest_worker.py)."""
+    app.state.workers_ingesta = job_service.iniciar_pool_workers() if job_service.INGEST_WORKERS > 0 else []
 
-    def progress_callback(msg, pct):
-        print(f"[PROGRESS {account_id}] {pct}% - {msg}")
-        upload_progress[account_id] = {
-            "status": "processing",
-            "message": msg,
-            "percent": pct,
-            "filename": filename,
-            "titulo": base_title
-        }
-
-    db = SessionLocal()
-    try:
-        # Initialize progress
-        progress_callback("Iniciando...", 0)
-        
-        # Pasamos bytes y nombre de archivo al servicio
-        result = ingest_service.procesar_archivo_temario(db, content, filename, account_id, progress_callback=progress_callback, titulo=title, licencia_id=licencia_id)
-        
-        # Final success state
-        upload_progress[account_id] = {
-            "status": "completed",
-            "message": "Proceso completado exitosamente",
-            "percent": 100,
-            "filename": filename,
-            "titulo": base_title
-        }
-        return result
-    except Exception as e:
-        upload_progress[account_id] = {
-            "status": "error",
-            "message": str(e),
-            "percent": 0,
-            "filename": filename,
-            "titulo": base_title
-        }
-        print(f"Error en thread de proceso: {e}")
-    finally:
-        db.close()
 
+@app.on_event("shutdown")
+def detener_workers_ingesta():
+    job_service.detener_pool_workers(getattr(app.state, "workers_ingesta", []))
 
-from fastapi import BackgroundTasks
 
 @app.post("/upload/syllabus")
 async def upload_syllabus(
-    background_tasks: BackgroundTasks,
     file: UploadFile = File(...), 
     account_id: str = Query(..., description="ID de la cuenta enviado en la URL"),
     title: str = Form(None),
-    licencia_id: Optional[int] = Query(None)
+    licencia_id: Optional[int] = Query(None),
+    db: Session = Depends(get_db)
 ):
     """
     Sube el libro entero PDF. 
-    Procesamiento en SEGUNDO PLANO (Background Task) para evitar timeouts.
+    Se guarda en el almacén de PDFs (por SHA-256) y se encola en ingest_jobs: lo procesa
+    un worker en SEGUNDO PLANO. El progreso se consulta con /upload/jobs/{job_id}.
+    Si el mismo PDF ya está procesado en la licencia no se re-ingesta: se reutiliza el libro.
     """
     if not file.filename.endswith(".pdf"):
          raise HTTPException(status_code=400, detail="Solo se aceptan PDFs por ahora")
          
     try:
-        # LEER CONTENIDO ANTES DE PASAR AL THREAD/BACKGROUND
-        content = await file.read()
+        # VOLCAR AL ALMACÉN ANTES DE ENCOLAR (por bloques, con el SHA-256 calculado al vuelo)
+        ruta_pdf, pdf_sha256, _ = await blob_service.guardar_upload(file)
         filename = file.filename
-        
-        # Encolar tarea en segundo plano
-        background_tasks.add_task(_procesar_archivo_en_thread, content, filename, account_id, title, licencia_id)
+
+        existente = blob_service.buscar_libro(db, pdf_sha256, licencia_id)
+        if existente:
+            job = job_service.registrar_libro_existente(
+                db, ruta_pdf, pdf_sha256, filename, account_id, existente.id, title, licencia_id
+            )
+            return {
+                "status": "completed",
+                "message": "Este PDF ya estaba procesado: se reutiliza el libro existente.",
+                "filename": filename,
+                "account_id": account_id,
+                "job_id": job.id,
+                "libro_id": existente.id,
+            }
+
+        # Encolar trabajo persistente (lo recoge cualquier worker de ingesta)
+        job = job_service.encolar_ingesta(db, ruta_pdf, filename, account_id, title, licencia_id, pdf_sha256)
         
         return {
             "status": "processing", 
             "message": "Archivo recibido. El procesamiento ha comenzado en segundo plano. Puede tardar unos minutos.",
             "filename": filename,
-            "account_id": account_id
+            "account_id": account_id,
+            "job_id": job.id
         }
     except Exception as e:
         print(f"Error iniciando carga: {e}")
         raise HTTPException(status_code=500, detail=f"Error interno: {str(e)}")
 
 
+@app.get("/upload/jobs/{job_id}")
+def get_upload_job(job_id: int, db: Session = Depends(get_db)):
+    """
+    Estado y progreso de un trabajo de ingesta (válido desde cualquier worker de la API).
+    """
+    job = job_service.obtener_job(db, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Trabajo de ingesta no encontrado")
+    return job_service.job_a_dict(job)
+
+
+@app.get("/upload/jobs/{job_id}/eventos")
+async def stream_upload_job(job_id: int, request: Request):
+    """
+    Progreso de un trabajo de ingesta por Server-Sent Events (fase, %, chunks, ETA).
+    Los eventos llegan por LISTEN/NOTIFY a un difusor compartido por todos los clientes
+    de este proceso; el stream termina cuando el trabajo completa o falla.
+    """
+    cola = job_service.difusor.suscribir(job_id)  # Antes de leer el estado: no se pierde ningún evento
+    actual = await asyncio.to_thread(job_service.evento_actual, job_id)
+    if actual is None:
+        job_service.difusor.desuscribir(job_id, cola)
+        raise HTTPException(status_code=404, detail="Trabajo de ingesta no encontrado")
+
+    finales = (job_service.COMPLETADO, job_service.ERROR)
+
+    async def eventos():
+        try:
+            yield job_service.formato_sse(actual)
+            if actual["estado"] in finales:
+                return
+            while not await request.is_disconnected():
+                try:
+                    evento = await asyncio.wait_for(cola.get(), timeout=job_service.SSE_PING_SEG)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                yield job_service.formato_sse(evento)
+                if evento["estado"] in finales:
+                    return
+        finally:
+            job_service.difusor.desuscribir(job_id, cola)
+
+    return StreamingResponse(
+        eventos(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.post("/upload/jobs/{job_id}/reintentar")
+def retry_upload_job(job_id: int, db: Session = Depends(get_db)):
+    """
+    Reencola un trabajo en error; continúa desde su último checkpoint (sin volver a subir el PDF).
+    """
+    job = job_service.reintentar_job(db, job_id)
+    if not job:
+        raise HTTPException(status_code=409, detail="El trabajo no está en error o su PDF ya no está disponible")
+    return job_service.job_a_dict(job)
+
+
+@app.get("/upload/jobs")
+def list_upload_jobs(account_id: str = Query(...), limite: int = Query(20, le=100), db: Session = Depends(get_db)):
+    """
+    Últimos trabajos de ingesta de una cuenta.
+    """
+    return [job_service.job_a_dict(job) for job in job_service.listar_jobs(db, account_id, limite)]
+
+
 @app.get("/upload/progress/{account_id}")
-def get_upload_progress(account_id: str):
+def get_upload_progress(account_id: str, db: Session = Depends(get_db)):
     """
-    Devuelve el estado actual del procesamiento de ingestión.
+    Devuelve el estado actual del procesamiento de ingestión (último trabajo de la cuenta).
+    Compatibilidad: usar /upload/jobs/{job_id} para seguir una subida concreta.
     """
-    status = upload_progress.get(account_id, {"status": "idle", "message": "No hay procesos activos", "percent": 0})
-    return status
+    jobs = job_service.listar_jobs(db, account_id, limite=1)
+    if not jobs:
+        return {"status": "idle", "message": "No hay procesos activos", "percent": 0}
+    return job_service.job_a_dict(jobs[0])
 
 
 # ============================================================================
@@ -224,6 +274,7 @@ def generate_assessment(req: AssessmentGenerate, db: Session = Depends(get_db)):
             temario_id=req.temario_id,
             num_preguntas=req.num_preguntas,
             temperatura=req.temperatura,
+            usar_banco=req.usar_banco,
         )
         if "error" in resultado:
             raise HTTPException(status_code=400, detail=resultado["error"])
@@ -235,6 +286,25 @@ def generate_assessment(req: AssessmentGenerate, db: Session = Depends(get_db)):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/assessments/banco/{temario_id}")
+def estado_banco_preguntas(temario_id: int, db: Session = Depends(get_db)):
+    """
+    Estado del banco de preguntas de un temario (total, stock, por tipo y dificultad).
+    """
+    return assessment_service.estado_banco(db, temario_id)
+
+
+@app.post("/assessments/banco/{temario_id}/reponer")
+def reponer_banco_preguntas(temario_id: int, db: Session = Depends(get_db)):
+    """
+    Lanza en segundo plano la generación de un lote de preguntas nuevas para el banco.
+    """
+    if not db.get(modelos.Temario, temario_id):
+        raise HTTPException(status_code=404, detail="Temario no encontrado")
+    lanzada = assessment_service.reponer_banco_async(temario_id)
+    return {"temario_id": temario_id, "lanzada": lanzada, **assessment_service.estado_banco(db, temario_id)}
+
+
 @app.post("/assessments/grade/open")
 def grade_open_answer(req: GradeOpenRequest, db: Session = Depends(get_db)):
     """
@@ -258,6 +328,36 @@ def grade_open_answer(req: GradeOpenRequest, db: Session = Depends(get_db)):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/assessments/grade/open/batch")
+def grade_open_answers_batch(req: GradeOpenBatchRequest, db: Session = Depends(get_db)):
+    """
+    Corrige en lote todas las respuestas abiertas de una entrega o de una clase:
+    varias respuestas por prompt del juez, prompts en paralelo y un único commit.
+    """
+    try:
+        resultado = assessment_service.corregir_respuestas_abiertas_lote(
+            db=db,
+            respuestas=[r.model_dump() for r in req.respuestas],
+        )
+        if "error" in resultado:
+            raise HTTPException(status_code=400, detail=resultado["error"])
+        return resultado
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error corrigiendo respuestas abiertas en lote: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/assessments/{assessment_id}/cache-correcciones")
+def informe_cache_correcciones(assessment_id: int, db: Session = Depends(get_db)):
+    """
+    Respuestas abiertas corregidas de una evaluación y cuántas reutilizaron un veredicto
+    de la caché (exacta o semántica), por pregunta.
+    """
+    return assessment_service.informe_cache_correcciones(db, assessment_id)
+
+
 @app.post("/assessments/grade/multiple")
 def grade_multiple_choice(req: GradeMultipleRequest, db: Session = Depends(get_db)):
     """
@@ -400,6 +500,52 @@ def delete_libro(libro_id: int, db: Session = Depends(get_db)):
     except Exception as e:
         print(f"Error eliminando libro {libro_id}: {e}")
         raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/syllabus/libro/{libro_id}/edicion")
+async def upload_nueva_edicion(
+    libro_id: int,
+    file: UploadFile = File(...),
+    account_id: str = Query(..., description="ID de la cuenta enviado en la URL"),
+    db: Session = Depends(get_db)
+):
+    """
+    Sube una edición revisada de un libro ya ingerido. A diferencia de borrar y volver a
+    subir, conserva progreso, sesiones y citas: solo se embeben los fragmentos nuevos o
+    modificados y el progreso de los alumnos pasa al fragmento superviviente más cercano.
+    Se procesa en segundo plano como /upload/syllabus (seguimiento con /upload/jobs/{job_id}).
+    """
+    if not file.filename.endswith(".pdf"):
+        raise HTTPException(status_code=400, detail="Solo se aceptan PDFs por ahora")
+    libro = db.get(modelos.Libro, libro_id)
+    if not libro:
+        raise HTTPException(status_code=404, detail="Libro no encontrado")
+
+    try:
+        ruta_pdf, pdf_sha256, _ = await blob_service.guardar_upload(file)
+        if libro.pdf_sha256 == pdf_sha256:
+            return {
+                "status": "completed",
+                "message": "El PDF es idéntico a la edición actual: no hay cambios.",
+                "filename": file.filename,
+                "libro_id": libro_id,
+            }
+
+        job = job_service.encolar_ingesta(
+            db, ruta_pdf, file.filename, account_id, libro.titulo, libro.licencia_id, pdf_sha256,
+            modo=job_service.MODO_EDICION, libro_id=libro_id,
+        )
+        return {
+            "status": "processing",
+            "message": "Nueva edición recibida. Se aplicarán solo los cambios en segundo plano.",
+            "filename": file.filename,
+            "account_id": account_id,
+            "job_id": job.id,
+            "libro_id": libro_id,
+        }
+    except Exception as e:
+        print(f"Error iniciando nueva edición del libro {libro_id}: {e}")
+        raise HTTPException(status_code=500, detail=f"Error interno: {str(e)}")
 @app.get("/licencias/{licencia_id}", response_model=schemas.LicenciaResponse)
 def obtener_licencia(licencia_id: int, db: Session = Depends(get_db)):
     licencia = db.query(modelos.Licencia).filter(modelos.Licencia.id == licencia_id).first()
@@ -839,6 +985,35 @@ def stream_logs():
 
     return StreamingResponse(event_generator(), media_type="text/event-stream")
 
+@app.get("/dev/metrics/embedding-cache")
+def get_embedding_cache_metrics(incluir_bd: bool = False, db: Session = Depends(get_db)):
+    """
+    Dev endpoint: aciertos y ratio por nivel de la caché de embeddings (memoria, disco, PostgreSQL).
+    Con ?incluir_bd=true añade el informe de la tabla (tamaño, hit rate histórico, filas por modelo).
+    """
+    if incluir_bd:
+        return embedding_service.informe_cache_db(db)
+    return embedding_service.obtener_metricas_cache()
+
+@app.get("/dev/metrics/grading")
+def get_grading_metrics():
+    """
+    Dev endpoint: respuestas abiertas corregidas en este proceso por origen (juez, caché,
+    pre-corrección local) y tasa de llamadas al LLM evitadas.
+    """
+    return assessment_service.obtener_metricas_correccion()
+
+@app.get("/dev/metrics/providers")
+def get_provider_metrics():
+    """
+    Dev endpoint: estado de los circuit breakers (embeddings/chat), ratio de respuestas
+    degradadas (búsqueda léxica, chat sin API) y esperas del rate limiter por modelo.
+    """
+    return {
+        **circuit_breaker_service.estado_breakers(),
+        "rate_limits": rate_limit_service.estado_limites(),
+    }
+
 @app.get("/dev/instructors", response_model=List[schemas.InstructorResponse])
 def list_instructors(db: Session = Depends(get_db)):
     """
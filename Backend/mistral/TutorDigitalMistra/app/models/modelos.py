@@ -57,7 +57,8 @@ class Libro(Base):
     titulo: Mapped[str] = mapped_column(String(255))
     autor: Mapped[Optional[str]] = mapped_column(String(255))
     descripcion: Mapped[Optional[str]] = mapped_column(Text)
-    pdf_path: Mapped[Optional[str]] = mapped_column(String(500))
+    pdf_path: Mapped[Optional[str]] = mapped_column(String(500))  # Ruta en el almacén de PDFs (blob_service)
+    pdf_sha256: Mapped[Optional[str]] = mapped_column(String(64), index=True)  # Para no re-ingestar el mismo PDF
     fecha_creacion: Mapped[datetime] = mapped_column(DateTime, server_default=func.now())
     activo: Mapped[bool] = mapped_column(Boolean, default=True)
     licencia_id: Mapped[Optional[int]] = mapped_column(ForeignKey("licencias.id"), nullable=True)
@@ -212,13 +213,21 @@ class ChatCitas(Base):
 class EmbeddingCache(Base):
     __tablename__ = "embedding_cache"
 
+    # sha256("modelo|dimension|texto"): un cambio de modelo nunca reutiliza vectores viejos
     text_hash: Mapped[str] = mapped_column(String(64), primary_key=True)
-    original_text: Mapped[str] = mapped_column(Text)
+    # Solo un extracto para depuración (la compactación puede vaciarlo)
+    original_text: Mapped[Optional[str]] = mapped_column(Text)
+    modelo: Mapped[Optional[str]] = mapped_column(String(100))
+    dimension: Mapped[Optional[int]] = mapped_column(Integer)
     
     # OpenAI text-embedding-3-small = 1536 dimensiones
     embedding: Mapped[list] = mapped_column(Vector(1536))
     
-    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
+    # Sin zona horaria, como last_used_at: el índice COALESCE(last_used_at, created_at) exige un tipo inmutable
+    created_at: Mapped[datetime] = mapped_column(DateTime, server_default=func.now())
+    # Uso (se actualiza en lotes desde embedding_service)
+    last_used_at: Mapped[Optional[datetime]] = mapped_column(DateTime)
+    hit_count: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
     
 # --- Módulo: Sistema (Logs y Config) ---
 
@@ -251,6 +260,33 @@ class Configuracion(Base):
     descripcion: Mapped[Optional[str]] = mapped_column(String(255))
 
 
+class IngestJob(Base):
+    """Trabajo de ingesta de un PDF. Cola persistente: los workers lo reclaman con SKIP LOCKED."""
+    __tablename__ = "ingest_jobs"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    account_id: Mapped[str] = mapped_column(String(100), index=True)
+    licencia_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    filename: Mapped[str] = mapped_column(String(255))
+    titulo: Mapped[Optional[str]] = mapped_column(String(255))
+    ruta_pdf: Mapped[str] = mapped_column(String(500))  # PDF en el almacén direccionado por contenido
+    pdf_sha256: Mapped[Optional[str]] = mapped_column(String(64))
+    modo: Mapped[str] = mapped_column(String(20), default="nuevo")  # nuevo, edicion (libro_id = libro a actualizar)
+    estado: Mapped[str] = mapped_column(String(20), default="pendiente")  # pendiente, procesando, completado, error
+    mensaje: Mapped[Optional[str]] = mapped_column(Text)
+    porcentaje: Mapped[int] = mapped_column(Integer, default=0)
+    libro_id: Mapped[Optional[int]] = mapped_column(ForeignKey("libros.id", ondelete="SET NULL"), nullable=True)
+    resultado: Mapped[Optional[dict]] = mapped_column(JSON)
+    fase: Mapped[Optional[str]] = mapped_column(String(20))  # Última fase confirmada (ver ingest_service)
+    checkpoint: Mapped[Optional[dict]] = mapped_column(JSON)  # libro_id, temario, chunks escritos... para reanudar
+    intentos: Mapped[int] = mapped_column(Integer, default=0)
+    worker: Mapped[Optional[str]] = mapped_column(String(100))
+    fecha_creacion: Mapped[datetime] = mapped_column(DateTime, server_default=func.now())
+    fecha_inicio: Mapped[Optional[datetime]] = mapped_column(DateTime)
+    fecha_actualizacion: Mapped[datetime] = mapped_column(DateTime, server_default=func.now())  # Latido del worker
+    fecha_fin: Mapped[Optional[datetime]] = mapped_column(DateTime)
+
+
 
     # --- Módulo: Progreso Académico ---
 
@@ -331,6 +367,25 @@ class Assessment(Base):
     scores: Mapped[List["TestScore"]] = relationship(back_populates="assessment")
 
 
+class PreguntaBanco(Base):
+    """Pregunta generada por el LLM y guardada para reutilizarla en nuevas evaluaciones."""
+    __tablename__ = "banco_preguntas"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    temario_id: Mapped[int] = mapped_column(ForeignKey("temario.id"))
+    tipo: Mapped[str] = mapped_column(String(20))  # opcion_multiple, verdadero_falso, abierta
+    enunciado: Mapped[str] = mapped_column(Text)
+    contenido: Mapped[dict] = mapped_column(JSON)  # Pregunta completa (opciones, respuesta_correcta, justificacion)
+    dificultad: Mapped[int] = mapped_column(Integer, default=2)
+    bloques_fuente: Mapped[Optional[list]] = mapped_column(JSON)  # IDs de base_conocimiento usados
+    embedding: Mapped[Optional[List[float]]] = mapped_column(Vector(1536))  # Enunciado + respuesta (diversidad MMR)
+    veces_usada: Mapped[int] = mapped_column(Integer, default=0)
+    activa: Mapped[bool] = mapped_column(Boolean, default=True)
+    fecha_creacion: Mapped[datetime] = mapped_column(DateTime, server_default=func.now())
+
+    temario: Mapped["Temario"] = relationship()
+
+
 class TestScore(Base):
     """Calificaciones históricas con feedback generado por LLM-as-a-Judge."""
     __tablename__ = "test_scores"
@@ -348,6 +403,22 @@ class TestScore(Base):
     usuario: Mapped["Usuario"] = relationship(backref="test_scores")
 
 
+class CacheCorreccion(Base):
+    """Veredicto del juez reutilizable para respuestas (casi) idénticas a la misma pregunta."""
+    __tablename__ = "cache_correcciones"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    assessment_id: Mapped[int] = mapped_column(ForeignKey("assessments.id"))
+    pregunta_idx: Mapped[int] = mapped_column(Integer)
+    respuesta_hash: Mapped[str] = mapped_column(String(64))  # sha256 de la respuesta normalizada
+    respuesta_normalizada: Mapped[str] = mapped_column(Text)
+    embedding: Mapped[Optional[List[float]]] = mapped_column(Vector(1536))  # NULL en respuestas muy cortas
+    resultado: Mapped[dict] = mapped_column(JSON)  # score, nivel, feedback, conceptos...
+    hits: Mapped[int] = mapped_column(Integer, default=0)
+    fecha_creacion: Mapped[datetime] = mapped_column(DateTime, server_default=func.now())
+    ultimo_uso: Mapped[Optional[datetime]] = mapped_column(DateTime)
+
+
 class LearningEvent(Base):
     """Telemetría de eventos conductuales del alumno en la plataforma."""
     __tablename__ = "learning_events"
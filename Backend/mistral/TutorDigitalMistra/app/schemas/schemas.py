@@ -68,6 +68,7 @@ class AssessmentGenerate(BaseModel):
     temario_id: int
     num_preguntas: int = 5
     temperatura: float = 0.7
+    usar_banco: bool = True  # False = preguntas nuevas del LLM aunque haya banco
 
 class AssessmentResponse(BaseModel):
     """Response con la evaluación generada."""
@@ -84,6 +85,10 @@ class GradeOpenRequest(BaseModel):
     respuesta_alumno: str
     usuario_id: int
 
+class GradeOpenBatchRequest(BaseModel):
+    """Request para corregir en lote las respuestas abiertas de una entrega o de una clase."""
+    respuestas: List[GradeOpenRequest]
+
 class GradeMultipleRequest(BaseModel):
     """Request para corregir respuestas de opción múltiple."""
     assessment_id: int
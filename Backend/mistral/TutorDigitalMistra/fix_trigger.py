@@ -28,6 +28,14 @@ def fix_trigger():
         CREATE OR REPLACE FUNCTION fn_sync_busqueda_texto()
         RETURNS TRIGGER AS $$
         BEGIN
+          -- Ingesta masiva: busqueda_texto se rellena al final con un solo UPDATE
+          IF current_setting('tutor.fts_diferido', true) = 'on' THEN
+            RETURN NEW;
+          END IF;
+          -- Cambios de enlaces/orden: el texto no cambia, no se recalcula
+          IF TG_OP = 'UPDATE' AND NEW.contenido IS NOT DISTINCT FROM OLD.contenido THEN
+            RETURN NEW;
+          END IF;
           NEW.busqueda_texto := setweight(to_tsvector('spanish', unaccent(COALESCE(NEW.contenido, ''))), 'A');
           RETURN NEW;
         END;
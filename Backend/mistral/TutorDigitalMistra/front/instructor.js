@@ -214,8 +214,9 @@ if (uploadBtn) {
                 throw new Error(errorDetails);
             }
 
+            const uploadData = await res.json();
             updateStatusText('Archivo recibido. Procesando...');
-            await pollProcessingConfig(); // Real-time polling
+            await followProcessing(uploadData.job_id); // Push (SSE), polling as fallback
 
             updateStatusText('¡Completado!');
             showToast('Procesado correctamente');
@@ -241,24 +242,70 @@ function updateStatusText(text) {
     if (el) el.innerText = text;
 }
 
-async function pollProcessingConfig() {
+function formatEta(seconds) {
+    if (seconds == null) return '';
+    if (seconds < 60) return `~${seconds}s`;
+    return `~${Math.round(seconds / 60)} min`;
+}
+
+function renderProgress(data) {
+    const extra = [];
+    if (data.chunks) extra.push(`${data.chunks} fragmentos`);
+    if (data.eta_seg != null) extra.push(`quedan ${formatEta(data.eta_seg)}`);
+    if (data.message) updateStatusText(extra.length ? `${data.message} (${extra.join(' · ')})` : data.message);
+    if (progressBar) progressBar.style.width = (data.percent || 0) + '%';
+
+    // Refresh Uploads Tab if active, only when the job ends (not on every progress tick)
+    const jobDone = data.status === 'completed' || data.status === 'error';
+    const uploadsView = document.getElementById('view-uploads');
+    if (jobDone && uploadsView && uploadsView.classList.contains('active')) {
+        loadUploads();
+    }
+}
+
+// Progress pushed by the server (Server-Sent Events). Falls back to polling if
+// EventSource is unavailable or the stream breaks before the job finishes.
+function followProcessing(jobId) {
+    if (!jobId || !window.EventSource) return pollProcessingConfig(jobId);
+
+    return new Promise((resolve, reject) => {
+        const source = new EventSource(`${API_URL}/upload/jobs/${jobId}/eventos`);
+        let finished = false;
+
+        source.addEventListener('progreso', (e) => {
+            const data = JSON.parse(e.data);
+            renderProgress(data);
+            if (data.status === 'completed') {
+                finished = true;
+                source.close();
+                resolve();
+            } else if (data.status === 'error') {
+                finished = true;
+                source.close();
+                reject(new Error(data.message || 'Error desconocido en procesado'));
+            }
+        });
+
+        source.onerror = () => {
+            if (finished) return;
+            source.close();
+            console.warn('SSE no disponible, usando polling');
+            pollProcessingConfig(jobId).then(resolve, reject);
+        };
+    });
+}
+
+async function pollProcessingConfig(jobId) {
     return new Promise((resolve, reject) => {
         const interval = setInterval(async () => {
             try {
-                // Poll progress for current license
-                const res = await fetch(`${API_URL}/upload/progress/${LICENCIA_ID}`);
+                // Poll progress for this upload's job (fallback: latest job of the license)
+                const url = jobId ? `${API_URL}/upload/jobs/${jobId}` : `${API_URL}/upload/progress/${LICENCIA_ID}`;
+                const res = await fetch(url);
                 if (!res.ok) return;
 
                 const data = await res.json();
-
-                if (data.message) updateStatusText(data.message);
-                if (progressBar) progressBar.style.width = (data.percent || 0) + '%';
-
-                // Refresh Uploads Tab if active
-                const uploadsView = document.getElementById('view-uploads');
-                if (uploadsView && uploadsView.classList.contains('active')) {
-                    loadUploads();
-                }
+                renderProgress(data);
 
                 // Stop condition
                 if (data.status === 'completed' || (data.percent >= 100 && data.status !== 'processing' && data.status !== 'error')) {
@@ -57,10 +57,12 @@ CREATE TABLE libros (
     titulo VARCHAR(255) NOT NULL,
     autor VARCHAR(255),
     descripcion TEXT,
-    pdf_path VARCHAR(500),
+    pdf_path VARCHAR(500),    -- Ruta en el almacén de PDFs (PDF_BLOB_DIR/ab/<sha256>.pdf)
+    pdf_sha256 VARCHAR(64),   -- Mismo PDF en la misma licencia → se reutiliza el libro
     fecha_creacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     activo BOOLEAN DEFAULT TRUE
 );
+CREATE INDEX idx_libros_pdf_sha256 ON libros(pdf_sha256);
 
 CREATE TABLE temario (
     id SERIAL PRIMARY KEY,
@@ -110,9 +112,18 @@ CREATE INDEX idx_base_conocimiento_secuencia ON base_conocimiento(chunk_siguient
 CREATE INDEX idx_base_conocimiento_metadatos ON base_conocimiento USING GIN(metadatos);
 
 -- Trigger para actualizar búsqueda de texto automáticamente
+-- La ingesta masiva lo desactiva en su transacción (SET LOCAL tutor.fts_diferido = 'on') y
+-- rellena busqueda_texto al final con un solo UPDATE. Un UPDATE que no cambia el contenido
+-- (enlaces, orden...) no recalcula el tsvector.
 CREATE OR REPLACE FUNCTION tsvector_update_trigger()
 RETURNS TRIGGER AS $$
 BEGIN
+  IF current_setting('tutor.fts_diferido', true) = 'on' THEN
+    RETURN NEW;
+  END IF;
+  IF TG_OP = 'UPDATE' AND NEW.contenido IS NOT DISTINCT FROM OLD.contenido THEN
+    RETURN NEW;
+  END IF;
   NEW.busqueda_texto := setweight(to_tsvector('spanish', unaccent(COALESCE(NEW.contenido, ''))), 'A');
   RETURN NEW;
 END;
@@ -160,6 +171,22 @@ CREATE TABLE assessments (
     fecha_creacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Banco de preguntas generadas: las evaluaciones se montan desde aquí (ver assessment_service)
+CREATE TABLE banco_preguntas (
+    id SERIAL PRIMARY KEY,
+    temario_id INTEGER NOT NULL REFERENCES temario(id),
+    tipo VARCHAR(20) NOT NULL,
+    enunciado TEXT NOT NULL,
+    contenido JSONB NOT NULL,
+    dificultad INTEGER DEFAULT 2,
+    bloques_fuente JSONB,
+    embedding VECTOR(1536),
+    veces_usada INTEGER DEFAULT 0,
+    activa BOOLEAN DEFAULT TRUE,
+    fecha_creacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX idx_banco_preguntas_temario ON banco_preguntas(temario_id) WHERE activa;
+
 CREATE TABLE test_scores (
     id SERIAL PRIMARY KEY,
     assessment_id INTEGER NOT NULL REFERENCES assessments(id),
@@ -171,6 +198,21 @@ CREATE TABLE test_scores (
     fecha_envio TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Veredictos del juez por (assessment, pregunta, respuesta normalizada) + nivel semántico
+CREATE TABLE cache_correcciones (
+    id SERIAL PRIMARY KEY,
+    assessment_id INTEGER NOT NULL REFERENCES assessments(id),
+    pregunta_idx INTEGER NOT NULL,
+    respuesta_hash VARCHAR(64) NOT NULL,
+    respuesta_normalizada TEXT NOT NULL,
+    embedding VECTOR(1536),
+    resultado JSONB NOT NULL,
+    hits INTEGER DEFAULT 0,
+    fecha_creacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    ultimo_uso TIMESTAMP,
+    UNIQUE (assessment_id, pregunta_idx, respuesta_hash)
+);
+
 -- ============================================================================
 -- MÓDULO: CHAT Y CITAS
 -- ============================================================================
@@ -201,11 +243,16 @@ CREATE TABLE chat_citas (
 );
 
 CREATE TABLE embedding_cache (
-    text_hash VARCHAR(64) PRIMARY KEY,
-    original_text TEXT NOT NULL,
+    text_hash VARCHAR(64) PRIMARY KEY,      -- sha256('modelo|dimension|texto')
+    original_text TEXT,                     -- Extracto (NULL tras compactar)
+    modelo VARCHAR(100),
+    dimension INT,
     embedding VECTOR(1536) NOT NULL,
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_used_at TIMESTAMP,                 -- Mismo tipo que created_at (índice COALESCE inmutable)
+    hit_count INT NOT NULL DEFAULT 0
 );
+CREATE INDEX idx_embedding_cache_uso ON embedding_cache (COALESCE(last_used_at, created_at));
 
 -- ============================================================================
 -- MÓDULO: PROGRESO (Sin trigger automático)
@@ -285,6 +332,33 @@ CREATE TABLE configuracion (
     descripcion VARCHAR(255)
 );
 
+-- Cola persistente de ingestas (la consumen los workers con FOR UPDATE SKIP LOCKED)
+CREATE TABLE ingest_jobs (
+    id SERIAL PRIMARY KEY,
+    account_id VARCHAR(100) NOT NULL,
+    licencia_id INTEGER,
+    filename VARCHAR(255) NOT NULL,
+    titulo VARCHAR(255),
+    ruta_pdf VARCHAR(500) NOT NULL,  -- PDF en el almacén direccionado por contenido
+    pdf_sha256 VARCHAR(64),
+    modo VARCHAR(20) NOT NULL DEFAULT 'nuevo',  -- nuevo, edicion (libro_id = libro a actualizar)
+    estado VARCHAR(20) NOT NULL DEFAULT 'pendiente',  -- pendiente, procesando, completado, error
+    mensaje TEXT,
+    porcentaje INTEGER NOT NULL DEFAULT 0,
+    libro_id INTEGER REFERENCES libros(id) ON DELETE SET NULL,
+    resultado JSONB,
+    fase VARCHAR(20),    -- Última fase confirmada: libro, estructurado, embebido, enlazado
+    checkpoint JSONB,    -- Datos para reanudar (libro_id, temario_ids, chunks escritos, último id...)
+    intentos INTEGER NOT NULL DEFAULT 0,
+    worker VARCHAR(100),
+    fecha_creacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    fecha_inicio TIMESTAMP,
+    fecha_actualizacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP,  -- Latido del worker
+    fecha_fin TIMESTAMP
+);
+CREATE INDEX idx_ingest_jobs_pendientes ON ingest_jobs (id) WHERE estado = 'pendiente';
+CREATE INDEX idx_ingest_jobs_cuenta ON ingest_jobs (account_id, id DESC);
+
 -- ============================================================================
 -- FUNCIONES SQL NATIVAS PARA RAG
 -- ============================================================================
@@ -318,6 +392,7 @@ BEGIN
     FROM base_conocimiento bc
     LEFT JOIN temario t ON bc.temario_id = t.id
     WHERE (libro_filter IS NULL OR t.libro_id = libro_filter)
+    AND t.activo IS NOT FALSE  -- Temario inactivo: ingesta a medias o contenido retirado
     AND (1 - (bc.embedding <=> query_embedding)) > match_threshold
     ORDER BY score DESC
     LIMIT match_count;
@@ -0,0 +1,193 @@
+"""
+Microbenchmark del chunking (fragmentar + enriquecer) sobre un libro real.
+Compara el algoritmo anterior (re-tokeniza texto, sentencias, overlap y fragmentos)
+con el actual (cada sentencia se tokeniza una sola vez, en lote y en hilos).
+
+Si cl100k_base no está disponible (sin red) y tiktoken está instalado, usa un
+Encoding de tiktoken a nivel de byte con la misma regex de pre-tokenización:
+los conteos no son los reales pero el coste de tokenizar es comparable.
+
+Uso:
+    python scripts/bench_chunking.py
+    python scripts/bench_chunking.py --pdf "../../../Recursos/PruebaFastApi/Python para todos.pdf" --repeticiones 5
+"""
+import sys
+import os
+import re
+import time
+import argparse
+
+# Añadir el directorio raíz al path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pypdf import PdfReader
+
+from app.crud import chunking_service
+from app.crud.chunking_service import (
+    CHUNK_SIZE, CHUNK_OVERLAP, contar_tokens, _dividir_en_sentencias, detectar_tipo_contenido,
+)
+
+PDF_POR_DEFECTO = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "..",
+    "Recursos", "PruebaFastApi", "Python para todos.pdf",
+)
+PAGINAS_POR_TEMA = 8
+
+CL100K_PAT = (
+    r"""'(?i:[sdmt]|ll|ve|re)|[^\r\n\p{L}\p{N}]?+\p{L}+|\p{N}{1,3}| ?[^\s\p{L}\p{N}]++[\r\n]*|\s*[\r\n]|\s+(?!\S)|\s+"""
+)
+
+
+class TokenizadorContado:
+    """Envuelve un Encoding de tiktoken contando llamadas y caracteres tokenizados."""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self.llamadas = 0
+        self.caracteres = 0
+
+    def encode(self, texto):
+        self.llamadas += 1
+        self.caracteres += len(texto)
+        return self.encoding.encode(texto)
+
+    def encode_ordinary_batch(self, textos, num_threads=8):
+        self.llamadas += 1
+        self.caracteres += sum(len(t) for t in textos)
+        return self.encoding.encode_ordinary_batch(textos, num_threads=num_threads)
+
+
+def _tokenizador_bench():
+    if chunking_service.TOKENIZER is not None:
+        return chunking_service.TOKENIZER, "cl100k_base"
+    try:
+        import tiktoken
+    except ImportError:
+        return None, "estimación por caracteres (sin tiktoken)"
+    encoding = tiktoken.Encoding(
+        name="bytes_bench",
+        pat_str=CL100K_PAT,
+        mergeable_ranks={bytes([i]): i for i in range(256)},
+        special_tokens={},
+    )
+    return encoding, "tiktoken byte-level (cl100k_base no disponible)"
+
+# ============================================================================
+# Algoritmo anterior (copia literal, como referencia)
+# ============================================================================
+
+def _legacy_fragmentar_texto(texto, chunk_size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
+    if not texto or not texto.strip():
+        return []
+    texto = texto.strip()
+    total_tokens = contar_tokens(texto)
+    if total_tokens <= chunk_size:
+        return [texto]
+    sentencias = _dividir_en_sentencias(texto)
+    if not sentencias:
+        return [texto]
+    fragmentos = []
+    chunk_actual = []
+    tokens_chunk_actual = 0
+    idx_sentencia = 0
+    while idx_sentencia < len(sentencias):
+        sentencia = sentencias[idx_sentencia]
+        tokens_sentencia = contar_tokens(sentencia)
+        if tokens_sentencia > chunk_size and not chunk_actual:
+            fragmentos.append(sentencia)
+            idx_sentencia += 1
+            continue
+        if tokens_chunk_actual + tokens_sentencia <= chunk_size:
+            chunk_actual.append(sentencia)
+            tokens_chunk_actual += tokens_sentencia
+            idx_sentencia += 1
+        else:
+            if chunk_actual:
+                fragmentos.append(" ".join(chunk_actual))
+            tokens_overlap = 0
+            inicio_overlap = len(chunk_actual)
+            for j in range(len(chunk_actual) - 1, -1, -1):
+                tokens_overlap += contar_tokens(chunk_actual[j])
+                if tokens_overlap >= overlap:
+                    inicio_overlap = j
+                    break
+            chunk_actual = chunk_actual[inicio_overlap:]
+            tokens_chunk_actual = sum(contar_tokens(s) for s in chunk_actual)
+            if tokens_chunk_actual + tokens_sentencia > chunk_size:
+                chunk_actual = []
+                tokens_chunk_actual = 0
+    if chunk_actual:
+        ultimo = " ".join(chunk_actual)
+        if not fragmentos or ultimo != fragmentos[-1]:
+            fragmentos.append(ultimo)
+    return fragmentos
+
+
+def _legacy_procesar(texto):
+    fragmentos = _legacy_fragmentar_texto(texto)
+    return [
+        {"contenido": f, "tipo": detectar_tipo_contenido(f), "tokens": contar_tokens(f)}
+        for f in fragmentos
+    ]
+
+
+def _actual_procesar(texto):
+    return chunking_service.procesar_texto_tema(texto, "Tema", 1, 1, 1)
+
+# ============================================================================
+# Benchmark
+# ============================================================================
+
+def cargar_temas(ruta_pdf: str) -> list:
+    """Agrupa el libro en 'temas' de PAGINAS_POR_TEMA páginas (como hace la ingesta)."""
+    paginas = [(p.extract_text() or "").strip() for p in PdfReader(ruta_pdf).pages]
+    return [
+        "\n".join(paginas[i:i + PAGINAS_POR_TEMA])
+        for i in range(0, len(paginas), PAGINAS_POR_TEMA)
+    ]
+
+
+def medir(funcion, temas, tokenizador, repeticiones):
+    mejor = float("inf")
+    for _ in range(repeticiones):
+        if tokenizador:
+            tokenizador.llamadas = tokenizador.caracteres = 0
+        t0 = time.perf_counter()
+        resultado = [funcion(t) for t in temas]
+        mejor = min(mejor, time.perf_counter() - t0)
+    stats = (tokenizador.llamadas, tokenizador.caracteres) if tokenizador else (0, 0)
+    return mejor, resultado, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmark de chunking_service")
+    parser.add_argument("--pdf", default=PDF_POR_DEFECTO)
+    parser.add_argument("--repeticiones", type=int, default=3)
+    args = parser.parse_args()
+
+    temas = cargar_temas(args.pdf)
+    encoding, nombre = _tokenizador_bench()
+    tokenizador = TokenizadorContado(encoding) if encoding else None
+    chunking_service.TOKENIZER = tokenizador
+
+    print("=" * 60)
+    print(f"BENCH CHUNKING: {os.path.basename(args.pdf)} — {len(temas)} temas, "
+          f"{sum(len(t) for t in temas):,} caracteres")
+    print(f"Tokenizador: {nombre}")
+    print("=" * 60)
+
+    t_legacy, r_legacy, s_legacy = medir(_legacy_procesar, temas, tokenizador, args.repeticiones)
+    t_actual, r_actual, s_actual = medir(_actual_procesar, temas, tokenizador, args.repeticiones)
+
+    frag_legacy = [b["contenido"] for tema in r_legacy for b in tema]
+    frag_actual = [b["contenido"] for tema in r_actual for b in tema]
+    iguales = sum(1 for a, b in zip(frag_legacy, frag_actual) if a == b)
+
+    print(f"Anterior: {t_legacy * 1000:8.1f} ms  {s_legacy[0]:6d} llamadas  {s_legacy[1]:>10,} caracteres tokenizados")
+    print(f"Actual:   {t_actual * 1000:8.1f} ms  {s_actual[0]:6d} llamadas  {s_actual[1]:>10,} caracteres tokenizados")
+    print(f"Speedup: {t_legacy / t_actual:.1f}x")
+    print(f"Fragmentos: {len(frag_legacy)} antes / {len(frag_actual)} ahora, {iguales} idénticos")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Benchmark de generación de embeddings en la ingesta.
+Levanta un servidor falso compatible con la API de embeddings de Azure OpenAI
+(latencia fija + coste por token) y compara el esquema antiguo (lotes fijos de 20,
+uno detrás de otro) con los lotes por tokens concurrentes de embedding_service.
+
+No toca la base de datos ni la API real.
+
+Uso:
+    python scripts/bench_embeddings.py                    # 600 chunks (~libro de 600 páginas)
+    python scripts/bench_embeddings.py --chunks 2000 --latencia 0.4 --concurrencia 8
+"""
+import sys
+import os
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Añadir el directorio raíz al path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+LEGACY_BATCH_SIZE = 20
+DIM = 1536
+
+
+def crear_servidor(latencia_base: float, segundos_por_token: float) -> ThreadingHTTPServer:
+    """Servidor que imita POST /openai/deployments/{modelo}/embeddings."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            cuerpo = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            entradas = cuerpo["input"]
+            tokens = sum(len(t) // 4 for t in entradas)
+            time.sleep(latencia_base + tokens * segundos_por_token)
+            data = [
+                {"object": "embedding", "index": i, "embedding": [float(len(t) % 7)] * DIM}
+                for i, t in enumerate(entradas)
+            ]
+            random.shuffle(data)  # La API no garantiza el orden
+            respuesta = json.dumps({
+                "object": "list",
+                "data": data,
+                "model": cuerpo.get("model", "text-embedding-3-small"),
+                "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+            }).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(respuesta)))
+            self.end_headers()
+            self.wfile.write(respuesta)
+
+        def log_message(self, *args):
+            pass
+
+    return ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+
+
+def generar_chunks(n: int) -> list:
+    """Textos de ~450 tokens (≈1800 caracteres) como los del chunking."""
+    palabras = "variable funcion bucle lista diccionario clase objeto modulo excepcion cadena".split()
+    rnd = random.Random(42)
+    return [f"[Tema {i}]: " + " ".join(rnd.choice(palabras) for _ in range(200)) for i in range(n)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de embeddings contra un servidor falso")
+    parser.add_argument("--chunks", type=int, default=600)
+    parser.add_argument("--latencia", type=float, default=0.3, help="Latencia fija por petición (s)")
+    parser.add_argument("--por-token", type=float, default=0.00002, help="Coste por token (s)")
+    parser.add_argument("--concurrencia", type=int, default=None)
+    args = parser.parse_args()
+
+    servidor = crear_servidor(args.latencia, args.por_token)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+
+    # Configurar el cliente ANTES de importar el servicio
+    os.environ["OPENAI_API_KEY"] = "bench"
+    os.environ["EMBEDDING_PROVIDER"] = "azure"
+    os.environ["AZURE_OPENAI_ENDPOINT"] = f"http://127.0.0.1:{servidor.server_port}/"
+    from app.crud import embedding_service, rate_limit_service
+
+    # Los límites reales (RPM/TPM) dominarían la medida
+    rate_limit_service.configurar_limite(
+        rate_limit_service.PROVEEDOR_AZURE, embedding_service.EMBEDDING_DEPLOYMENT, rpm=10 ** 9, tpm=10 ** 12
+    )
+    concurrencia = args.concurrencia or embedding_service.EMBEDDING_CONCURRENCIA
+
+    textos = generar_chunks(args.chunks)
+
+    print("=" * 60)
+    print(f"BENCH EMBEDDINGS: {len(textos)} chunks, latencia {args.latencia}s + {args.por_token}s/token")
+    print("=" * 60)
+
+    # 1. Esquema antiguo: lotes fijos secuenciales
+    t0 = time.perf_counter()
+    legacy = []
+    for inicio in range(0, len(textos), LEGACY_BATCH_SIZE):
+        legacy.extend(embedding_service._generate_embeddings_batch_api(textos[inicio:inicio + LEGACY_BATCH_SIZE]))
+    t_legacy = time.perf_counter() - t0
+    peticiones_legacy = -(-len(textos) // LEGACY_BATCH_SIZE)
+
+    # 2. Lotes por tokens concurrentes
+    _, lotes = embedding_service._agrupar_por_tokens(textos)
+    t0 = time.perf_counter()
+    nuevo = embedding_service.generar_vectores_concurrente(textos, concurrencia=concurrencia)
+    t_nuevo = time.perf_counter() - t0
+
+    assert [v[0] for v in nuevo] == [v[0] for v in legacy], "El orden de los resultados no coincide"
+
+    print(f"Secuencial (lotes de {LEGACY_BATCH_SIZE}):  {t_legacy:7.2f} s  ({peticiones_legacy} peticiones)")
+    print(f"Concurrente (x{concurrencia}, por tokens): {t_nuevo:7.2f} s  ({len(lotes)} peticiones)")
+    print(f"Speedup: {t_legacy / t_nuevo:.1f}x")
+    servidor.shutdown()
+
+
+if __name__ == "__main__":
+    main()
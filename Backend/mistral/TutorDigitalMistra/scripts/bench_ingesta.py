@@ -0,0 +1,345 @@
+"""
+Benchmark de la ingesta completa (procesar_archivo_temario) contra PostgreSQL + pgvector.
+Mide PDFs sintéticos del tamaño que se pida y el libro incluido ("Python para todos.pdf")
+con proveedores de IA falsos: embeddings LOCALES (sin red; --latencia-embeddings simula la
+de la API) y sin LLM para el índice (la estructura sale de marcadores o del índice impreso).
+
+Cada caso corre en un proceso nuevo, así el pico de memoria (RSS) es el de ese caso.
+Reporta el tiempo ocupado por fase (extracción, estructura, chunking, embeddings,
+escritura en BD, mantenimiento), páginas/s, chunks/s y pico de RSS, y lo guarda en JSON
+para comparar ejecuciones. Los libros creados se borran al terminar (salvo --conservar).
+
+Uso:
+    python scripts/bench_ingesta.py                                  # 50 y 200 págs + libro incluido
+    python scripts/bench_ingesta.py --paginas 100 500 1000 --sin-libro --salida bench_grande.json
+    python scripts/bench_ingesta.py --sin-marcadores --latencia-embeddings 0.3 --comparar bench_ingesta.json
+"""
+import sys
+import os
+import json
+import time
+import random
+import platform
+import argparse
+import multiprocessing
+from datetime import datetime
+
+# Añadir el directorio raíz al path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dotenv import load_dotenv
+load_dotenv()
+
+PDF_INCLUIDO = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "..",
+    "Recursos", "PruebaFastApi", "Python para todos.pdf",
+)
+DIR_SINTETICOS = os.path.join("uploads", "bench")
+TITULO_BENCH = "__bench_ingesta__"
+
+LINEAS_POR_PAGINA = 46
+PAGINAS_POR_CAPITULO = 12
+SECCIONES_POR_CAPITULO = 3
+
+# ============================================================================
+# PDFs sintéticos
+# ============================================================================
+
+_PALABRAS = (
+    "el la los las un una de del en con por para que como cuando donde variable función "
+    "bucle lista diccionario clase objeto módulo excepción cadena valor tipo programa "
+    "intérprete sentencia expresión argumento parámetro resultado elemento índice método "
+    "atributo herencia iterador generador archivo línea código datos memoria ejecución"
+).split()
+_CODIGO = [
+    "def calcular(valores):", "    total = 0", "    for v in valores:", "        total += v * 2",
+    "    return total", "print(calcular([1, 2, 3]))",
+]
+
+
+def _frase(rnd: random.Random) -> str:
+    palabras = [rnd.choice(_PALABRAS) for _ in range(rnd.randint(8, 16))]
+    return " ".join(palabras).capitalize() + "."
+
+
+def _escapar_pdf(texto: str) -> bytes:
+    texto = texto.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+    return texto.encode("cp1252", errors="replace")
+
+
+def _lineas_pagina(rnd: random.Random, titulo: str = None) -> list:
+    """Prosa partida en líneas de ~90 caracteres y, de vez en cuando, un bloque de código."""
+    lineas = [titulo, ""] if titulo else []
+    while len(lineas) < LINEAS_POR_PAGINA:
+        if rnd.random() < 0.15:
+            lineas.extend(_CODIGO + [""])
+            continue
+        parrafo = " ".join(_frase(rnd) for _ in range(rnd.randint(3, 7)))
+        while parrafo:
+            corte = parrafo.rfind(" ", 0, 90) if len(parrafo) > 90 else len(parrafo)
+            lineas.append(parrafo[:corte])
+            parrafo = parrafo[corte:].strip()
+        lineas.append("")
+    return lineas[:LINEAS_POR_PAGINA]
+
+
+def generar_pdf_sintetico(ruta: str, paginas: int, marcadores: bool = True, semilla: int = 42) -> str:
+    """
+    Libro sintético: portada, índice impreso (título ..... página) y capítulos de
+    PAGINAS_POR_CAPITULO páginas con SECCIONES_POR_CAPITULO secciones. Con `marcadores`
+    añade el outline del PDF. Solo usa pypdf (fuente estándar Helvetica).
+    """
+    from pypdf import PdfWriter
+    from pypdf.generic import DecodedStreamObject, DictionaryObject, NameObject
+
+    rnd = random.Random(semilla)
+    escritor = PdfWriter()
+    fuente = escritor._add_object(DictionaryObject({
+        NameObject("/Type"): NameObject("/Font"),
+        NameObject("/Subtype"): NameObject("/Type1"),
+        NameObject("/BaseFont"): NameObject("/Helvetica"),
+        NameObject("/Encoding"): NameObject("/WinAnsiEncoding"),
+    }))
+
+    def _pagina(lineas):
+        pagina = escritor.add_blank_page(595, 842)
+        pagina[NameObject("/Resources")] = DictionaryObject(
+            {NameObject("/Font"): DictionaryObject({NameObject("/F1"): fuente})}
+        )
+        flujo = DecodedStreamObject()
+        flujo.set_data(b"BT /F1 10 Tf 16 TL 40 800 Td " + b" ".join(b"(" + _escapar_pdf(l) + b") Tj T*" for l in lineas) + b" ET")
+        pagina[NameObject("/Contents")] = escritor._add_object(flujo)
+
+    # Plan de capítulos: portada (1) + índice (2..) + contenido
+    paginas_indice = 1 + (paginas // PAGINAS_POR_CAPITULO * (SECCIONES_POR_CAPITULO + 1)) // 40
+    inicio = 2 + paginas_indice
+    temas = []
+    for capitulo, pagina in enumerate(range(inicio, paginas + 1, PAGINAS_POR_CAPITULO), start=1):
+        temas.append((1, f"{capitulo}. Capítulo {capitulo}: {rnd.choice(_PALABRAS)} y {rnd.choice(_PALABRAS)}", pagina))
+        paso = max(1, PAGINAS_POR_CAPITULO // SECCIONES_POR_CAPITULO)
+        for seccion in range(1, SECCIONES_POR_CAPITULO + 1):
+            pagina_seccion = pagina + (seccion - 1) * paso + 1
+            if pagina_seccion <= min(paginas, pagina + PAGINAS_POR_CAPITULO - 1):
+                temas.append((2, f"{capitulo}.{seccion} Sección sobre {rnd.choice(_PALABRAS)}", pagina_seccion))
+
+    _pagina(["Libro sintético de benchmark", "", f"{paginas} páginas"])
+    entradas = [f"{titulo} {'.' * 8} {pagina}" for _, titulo, pagina in temas]
+    for i in range(paginas_indice):
+        _pagina((["Contenido", ""] if i == 0 else []) + entradas[i * 40:(i + 1) * 40])
+
+    titulos = {pagina: titulo for _, titulo, pagina in temas}
+    for pagina in range(inicio, paginas + 1):
+        _pagina(_lineas_pagina(rnd, titulos.get(pagina)))
+
+    if marcadores:
+        padre = None
+        for nivel, titulo, pagina in temas:
+            item = escritor.add_outline_item(titulo, pagina - 1, parent=None if nivel == 1 else padre)
+            if nivel == 1:
+                padre = item
+
+    os.makedirs(os.path.dirname(ruta) or ".", exist_ok=True)
+    with open(ruta, "wb") as f:
+        escritor.write(f)
+    return ruta
+
+# ============================================================================
+# Ejecución de un caso (proceso hijo)
+# ============================================================================
+
+def _rss_actual_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for linea in f:
+                if linea.startswith("VmRSS:"):
+                    return round(int(linea.split()[1]) / 1024, 1)
+    except OSError:
+        return None
+
+
+def _ejecutar_caso(nombre: str, ruta: str, opciones: dict, resultados):
+    # Proveedores falsos ANTES de importar los servicios (load_dotenv no pisa lo que ya hay)
+    os.environ["EMBEDDING_PROVIDER"] = "local"
+    os.environ["MISTRAL_API_KEY"] = ""
+
+    from sqlalchemy import text
+    from app.db.database import SessionLocal
+    from app.crud import embedding_service, ingest_service
+
+    if opciones["latencia_embeddings"] > 0:
+        embed_original = embedding_service.proveedor.embed
+
+        def embed_con_latencia(textos, timeout=None):
+            time.sleep(opciones["latencia_embeddings"])
+            return embed_original(textos, timeout)
+
+        embedding_service.proveedor.embed = embed_con_latencia
+
+    db = SessionLocal()
+    if not opciones["con_cache"]:
+        # Solo entradas del proveedor local (nunca las de la API real)
+        db.execute(text("DELETE FROM embedding_cache WHERE modelo = :m"), {"m": embedding_service.EMBEDDING_MODELO})
+        db.commit()
+
+    rss_base = _rss_actual_mb()
+    t0 = time.perf_counter()
+    resultado = ingest_service.procesar_archivo_temario(
+        db, ruta, os.path.basename(ruta), "bench", titulo=f"{TITULO_BENCH} {nombre}",
+    )
+    segundos = time.perf_counter() - t0
+
+    try:
+        import resource
+        pico = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+        pico_hijos = round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1)
+    except ImportError:
+        pico = pico_hijos = None
+
+    if "error" in resultado:
+        resultados.put({"nombre": nombre, "error": resultado["error"]})
+        return
+
+    paginas = len(ingest_service.abrir_pdf(ruta).pages)
+    chunks = resultado["bloques"]
+    resultados.put({
+        "nombre": nombre,
+        "paginas": paginas,
+        "bytes": os.path.getsize(ruta),
+        "chunks": chunks,
+        "temas": db.execute(text("SELECT count(*) FROM temario WHERE libro_id = :l"), {"l": resultado["libro_id"]}).scalar(),
+        "estructura": resultado.get("estructura"),
+        "segundos": round(segundos, 2),
+        "paginas_por_seg": round(paginas / segundos, 1),
+        "chunks_por_seg": round(chunks / segundos, 1),
+        "ms_por_pagina": round(segundos * 1000 / paginas, 1),
+        "ms_por_chunk": round(segundos * 1000 / max(chunks, 1), 1),
+        "desglose": resultado.get("desglose"),
+        "etapas": resultado.get("etapas"),
+        "mantenimiento": resultado.get("mantenimiento"),
+        "rss_base_mb": rss_base,
+        "pico_rss_mb": pico,
+        "pico_rss_hijos_mb": pico_hijos,  # Pool de extracción (PDFs grandes en disco)
+    })
+
+    if not opciones["conservar"]:
+        _borrar_libro(db, resultado["libro_id"])
+    db.close()
+
+
+def _borrar_libro(db, libro_id: int):
+    from sqlalchemy import text
+    temas = "SELECT id FROM temario WHERE libro_id = :l"
+    db.execute(text(f"UPDATE base_conocimiento SET chunk_anterior_id = NULL, chunk_siguiente_id = NULL WHERE temario_id IN ({temas})"), {"l": libro_id})
+    db.execute(text(f"DELETE FROM base_conocimiento WHERE temario_id IN ({temas})"), {"l": libro_id})
+    db.execute(text("UPDATE temario SET parent_id = NULL WHERE libro_id = :l"), {"l": libro_id})
+    db.execute(text("DELETE FROM temario WHERE libro_id = :l"), {"l": libro_id})
+    db.execute(text("DELETE FROM libros WHERE id = :l"), {"l": libro_id})
+    db.commit()
+
+
+def ejecutar_caso(nombre: str, ruta: str, opciones: dict) -> dict:
+    contexto = multiprocessing.get_context("spawn")
+    resultados = contexto.Queue()
+    proceso = contexto.Process(target=_ejecutar_caso, args=(nombre, ruta, opciones, resultados))
+    proceso.start()
+    proceso.join()
+    if resultados.empty():
+        return {"nombre": nombre, "error": f"El proceso terminó con código {proceso.exitcode}"}
+    return resultados.get()
+
+# ============================================================================
+# Informe
+# ============================================================================
+
+FASES = ("extraccion", "estructura", "chunking", "embeddings", "escritura_bd", "mantenimiento")
+
+
+def imprimir_tabla(casos: list):
+    print("\n" + "=" * 110)
+    print(f"{'caso':22s} {'págs':>5s} {'chunks':>6s} {'total s':>8s} {'ms/pág':>7s} {'ms/chunk':>8s}  "
+          + " ".join(f"{f[:9]:>9s}" for f in FASES) + f" {'pico MB':>8s}")
+    print("-" * 110)
+    for c in casos:
+        if "error" in c:
+            print(f"{c['nombre']:22s} ERROR: {c['error']}")
+            continue
+        d = c.get("desglose") or {}
+        print(f"{c['nombre']:22s} {c['paginas']:5d} {c['chunks']:6d} {c['segundos']:8.2f} {c['ms_por_pagina']:7.1f} "
+              f"{c['ms_por_chunk']:8.1f}  " + " ".join(f"{d.get(f, 0):9.2f}" for f in FASES) + f" {c['pico_rss_mb'] or 0:8.1f}")
+    print("=" * 110)
+    print("Fases = tiempo ocupado de cada etapa (el pipeline las solapa: la suma puede superar el total)")
+
+
+def imprimir_comparacion(casos: list, ruta_anterior: str):
+    with open(ruta_anterior, encoding="utf-8") as f:
+        anteriores = {c["nombre"]: c for c in json.load(f).get("casos", []) if "error" not in c}
+    print(f"\nComparación con {ruta_anterior}:")
+    for c in casos:
+        previo = anteriores.get(c["nombre"])
+        if previo is None or "error" in c:
+            continue
+        cambio = (c["segundos"] - previo["segundos"]) / previo["segundos"] * 100
+        memoria = (c["pico_rss_mb"] or 0) - (previo.get("pico_rss_mb") or 0)
+        print(f"  {c['nombre']:22s} {previo['segundos']:8.2f}s → {c['segundos']:8.2f}s ({cambio:+.1f}%)  pico RSS {memoria:+.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de la ingesta completa con proveedores de IA falsos")
+    parser.add_argument("--paginas", type=int, nargs="*", default=[50, 200], help="Tamaños de los PDFs sintéticos")
+    parser.add_argument("--sin-libro", action="store_true", help="No medir el libro incluido")
+    parser.add_argument("--pdf", default=PDF_INCLUIDO, help="PDF real a medir además de los sintéticos")
+    parser.add_argument("--sin-marcadores", action="store_true", help="PDFs sintéticos sin outline (estructura por índice impreso)")
+    parser.add_argument("--latencia-embeddings", type=float, default=0.0, help="Segundos añadidos a cada lote de embeddings")
+    parser.add_argument("--con-cache", action="store_true", help="No vaciar embedding_cache del proveedor local antes de cada caso")
+    parser.add_argument("--conservar", action="store_true", help="No borrar los libros creados")
+    parser.add_argument("--salida", default="bench_ingesta.json", help="Fichero JSON de resultados")
+    parser.add_argument("--comparar", help="JSON de una ejecución anterior con la que comparar")
+    args = parser.parse_args()
+
+    opciones = {
+        "latencia_embeddings": args.latencia_embeddings,
+        "con_cache": args.con_cache,
+        "conservar": args.conservar,
+    }
+    casos_pdf = []
+    for paginas in args.paginas:
+        ruta = os.path.join(DIR_SINTETICOS, f"sintetico_{paginas}{'_sin_marcadores' if args.sin_marcadores else ''}.pdf")
+        if not os.path.exists(ruta):
+            print(f"📄 Generando PDF sintético de {paginas} páginas...")
+            generar_pdf_sintetico(ruta, paginas, marcadores=not args.sin_marcadores)
+        casos_pdf.append((f"sintetico_{paginas}", ruta))
+    if not args.sin_libro:
+        casos_pdf.append((os.path.splitext(os.path.basename(args.pdf))[0][:22], args.pdf))
+
+    print("=" * 60)
+    print(f"BENCH INGESTA: {len(casos_pdf)} casos, latencia embeddings {args.latencia_embeddings}s")
+    print("=" * 60)
+
+    casos = []
+    for nombre, ruta in casos_pdf:
+        print(f"\n▶ {nombre} ({ruta})")
+        casos.append(ejecutar_caso(nombre, ruta, opciones))
+
+    imprimir_tabla(casos)
+
+    informe = {
+        "fecha": datetime.now().isoformat(timespec="seconds"),
+        "maquina": {"cpus": os.cpu_count(), "python": platform.python_version(), "plataforma": platform.platform()},
+        "configuracion": {
+            **{k: v for k, v in os.environ.items() if k.startswith(("INGEST_", "CHUNK_", "EMBEDDING_"))},
+            "latencia_embeddings": args.latencia_embeddings,
+            "marcadores": not args.sin_marcadores,
+            "con_cache": args.con_cache,
+        },
+        "casos": casos,
+    }
+    with open(args.salida, "w", encoding="utf-8") as f:
+        json.dump(informe, f, indent=2, ensure_ascii=False)
+    print(f"\n💾 Resultados en {args.salida}")
+
+    if args.comparar:
+        imprimir_comparacion(casos, args.comparar)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""
+Benchmark de escritura de base_conocimiento (requiere PostgreSQL con pgvector).
+Compara, con chunks sintéticos y vectores aleatorios de 1536 dimensiones:
+  1. Anterior: add_all + flush cada 10 filas y luego un UPDATE por fila para los enlaces
+  2. ORM por lotes: _guardar_lote_chunks (flush por lote, enlaces en el mismo flush)
+  3. COPY binario: _guardar_lote_copy (ids reservados, enlaces en memoria, un COPY por lote)
+  4. COPY binario + full-text diferido: sin trigger por fila, busqueda_texto en un UPDATE al final
+
+Crea un libro temporal y lo borra al terminar.
+
+Uso:
+    python scripts/bench_insert_chunks.py
+    python scripts/bench_insert_chunks.py --chunks 5000 --lote 256
+"""
+import sys
+import os
+import time
+import argparse
+
+# Añadir el directorio raíz al path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dotenv import load_dotenv
+load_dotenv()
+
+import numpy as np
+from sqlalchemy import text
+
+from app.db.database import SessionLocal
+from app.models.modelos import Libro, Temario, BaseConocimiento
+from app.crud.ingest_service import _guardar_lote_chunks, _guardar_lote_copy, _rellenar_fts
+from app.crud.embedding_service import EMBEDDING_DIM
+
+
+def generar_chunks(n: int, temario_id: int):
+    rnd = np.random.default_rng(42)
+    palabras = "variable funcion bucle lista diccionario clase objeto modulo excepcion cadena".split()
+    chunks = [
+        {
+            "tema": 0,
+            "temario_id": temario_id,
+            "contenido": " ".join(rnd.choice(palabras, 250)),
+            "tipo": "texto",
+            "pagina": 1 + i // 4,
+            "metadata": {"titulo_tema": "Bench", "chunk_index": i, "tokens": 450},
+        }
+        for i in range(n)
+    ]
+    vectores = list(rnd.standard_normal((n, EMBEDDING_DIM), dtype=np.float32))
+    return chunks, vectores
+
+
+def escribir_anterior(db, chunks, vectores, lote):
+    """Copia del flujo anterior: flush cada 10 y enlaces con un UPDATE por fila."""
+    objetos = []
+    pendientes = []
+    for i, (chunk, vec) in enumerate(zip(chunks, vectores)):
+        obj = BaseConocimiento(
+            temario_id=chunk["temario_id"], contenido=chunk["contenido"], tipo_contenido=chunk["tipo"],
+            pagina=chunk["pagina"], ref_fuente=f"Pág {chunk['pagina']}", metadata_info=chunk["metadata"],
+            embedding=vec.tolist(), orden_aparicion=i + 1,
+        )
+        objetos.append(obj)
+        pendientes.append(obj)
+        if len(pendientes) >= 10:
+            db.add_all(pendientes)
+            db.flush()
+            pendientes = []
+    if pendientes:
+        db.add_all(pendientes)
+        db.flush()
+    for i, obj in enumerate(objetos):
+        if i > 0:
+            obj.chunk_anterior_id = objetos[i - 1].id
+        if i < len(objetos) - 1:
+            obj.chunk_siguiente_id = objetos[i + 1].id
+    db.commit()
+
+
+def escribir_por_lotes(funcion, fts_diferido: bool = False):
+    def _escribir(db, chunks, vectores, lote):
+        estado = {"orden": 0, "ultimo_id": None, "fts_diferido": fts_diferido}
+        for inicio in range(0, len(chunks), lote):
+            funcion(db, chunks[inicio:inicio + lote], vectores[inicio:inicio + lote], estado)
+        if fts_diferido:
+            _rellenar_fts(db, [chunks[0]["temario_id"]])
+            db.commit()
+    return _escribir
+
+
+def verificar_enlaces(db, temario_id: int, n: int) -> bool:
+    filas = db.execute(
+        text("SELECT id, chunk_anterior_id, chunk_siguiente_id, busqueda_texto IS NOT NULL FROM base_conocimiento "
+             "WHERE temario_id = :t ORDER BY orden_aparicion"),
+        {"t": temario_id},
+    ).all()
+    return len(filas) == n and all(f[3] for f in filas) and all(
+        filas[i][2] == filas[i + 1][0] and filas[i + 1][1] == filas[i][0] for i in range(n - 1)
+    ) and filas[0][1] is None and filas[-1][2] is None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de inserción en base_conocimiento")
+    parser.add_argument("--chunks", type=int, default=2000)
+    parser.add_argument("--lote", type=int, default=256)
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    libro = Libro(titulo="__bench_insert_chunks__", activo=False)
+    db.add(libro)
+    db.commit()
+
+    print("=" * 60)
+    print(f"BENCH INSERT: {args.chunks} chunks, lotes de {args.lote}")
+    print("=" * 60)
+
+    metodos = [
+        ("Anterior (flush 10 + UPDATE/fila)", escribir_anterior),
+        ("ORM por lotes", escribir_por_lotes(_guardar_lote_chunks)),
+        ("COPY binario", escribir_por_lotes(_guardar_lote_copy)),
+        ("COPY binario + FTS diferido", escribir_por_lotes(_guardar_lote_copy, fts_diferido=True)),
+    ]
+    try:
+        for nombre, funcion in metodos:
+            tema = Temario(libro_id=libro.id, nombre=nombre, nivel=1, orden=1, activo=False)
+            db.add(tema)
+            db.commit()
+            chunks, vectores = generar_chunks(args.chunks, tema.id)
+            t0 = time.perf_counter()
+            funcion(db, chunks, vectores, args.lote)
+            segundos = time.perf_counter() - t0
+            ok = verificar_enlaces(db, tema.id, args.chunks)
+            print(f"{nombre:36s} {segundos:7.2f} s  {args.chunks / segundos:8.0f} filas/s  enlaces+fts {'✓' if ok else '✗'}")
+    finally:
+        db.rollback()
+        db.execute(text(
+            "UPDATE base_conocimiento SET chunk_anterior_id = NULL, chunk_siguiente_id = NULL "
+            "WHERE temario_id IN (SELECT id FROM temario WHERE libro_id = :l)"
+        ), {"l": libro.id})
+        db.execute(text("DELETE FROM base_conocimiento WHERE temario_id IN (SELECT id FROM temario WHERE libro_id = :l)"), {"l": libro.id})
+        db.execute(text("DELETE FROM temario WHERE libro_id = :l"), {"l": libro.id})
+        db.execute(text("DELETE FROM libros WHERE id = :l"), {"l": libro.id})
+        db.commit()
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""
+Mantenimiento de embedding_cache.
+Muestra tamaño y tasa de aciertos, y compacta: borra entradas de modelos antiguos
+y entradas frías, y opcionalmente vacía los extractos de texto.
+
+Uso:
+    python scripts/compactar_embedding_cache.py --informe
+    python scripts/compactar_embedding_cache.py --dias 60 --min-hits 2 --vaciar-texto --vacuum
+"""
+import sys
+import os
+import json
+import argparse
+
+# Añadir el directorio raíz al path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dotenv import load_dotenv
+load_dotenv()
+
+from sqlalchemy import text
+from app.db.database import SessionLocal, engine
+from app.crud import embedding_service
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Informe y compactación de embedding_cache")
+    parser.add_argument("--informe", action="store_true", help="Solo mostrar el informe, sin compactar")
+    parser.add_argument("--dias", type=int, default=90, help="Días sin uso para considerar una entrada fría")
+    parser.add_argument("--min-hits", type=int, default=1, help="Las entradas frías con menos aciertos se borran")
+    parser.add_argument("--vaciar-texto", action="store_true", help="Vaciar original_text de las entradas restantes")
+    parser.add_argument("--vacuum", action="store_true", help="VACUUM ANALYZE al terminar (recupera espacio)")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        print("=" * 60)
+        print("EMBEDDING CACHE: informe")
+        print("=" * 60)
+        print(json.dumps(embedding_service.informe_cache_db(db), indent=2, ensure_ascii=False, default=str))
+
+        if args.informe:
+            return
+
+        print("\nCompactando...")
+        resultado = embedding_service.compactar_cache(
+            db, dias_sin_uso=args.dias, min_hits=args.min_hits, vaciar_texto=args.vaciar_texto
+        )
+        print(f"  → {resultado}")
+    finally:
+        db.close()
+
+    if args.vacuum:
+        # VACUUM no puede ejecutarse dentro de una transacción
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.execute(text("VACUUM (ANALYZE) embedding_cache"))
+        print("  → VACUUM ANALYZE completado")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""
+Pool de workers de ingesta independiente de la API.
+Consume la cola persistente ingest_jobs (ver app/crud/job_service.py). Arrancar la API
+con INGEST_WORKERS=0 para que solo procesen estos workers; se pueden lanzar en varias
+máquinas a la vez (los trabajos se reparten con SKIP LOCKED).
+
+Uso:
+    python scripts/ingest_worker.py                 # Un proceso
+    python scripts/ingest_worker.py --procesos 4
+"""
+import sys
+import os
+import signal
+import argparse
+
+# Añadir el directorio raíz al path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dotenv import load_dotenv
+load_dotenv()
+
+from app.crud import job_service
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Workers de la cola de ingesta (ingest_jobs)")
+    parser.add_argument("--procesos", type=int, default=1, help="Trabajos de ingesta en paralelo")
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print(f"WORKERS DE INGESTA: {args.procesos} procesos")
+    print("=" * 60)
+
+    pool = job_service.iniciar_pool_workers(args.procesos)
+
+    def _salir(*_):
+        print("\nDeteniendo workers (los trabajos a medias se reencolarán)...")
+        job_service.detener_pool_workers(pool)
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, _salir)
+    try:
+        for proceso in pool:
+            proceso.join()
+    except KeyboardInterrupt:
+        _salir()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Script de migración: banco de preguntas para montar evaluaciones sin llamar al LLM.
+Ejecutar UNA VEZ tras actualizar el código (las bases creadas con schema_final.sql ya lo tienen).
+
+Crea banco_preguntas (ver assessment_service.generar_evaluacion). Con --importar vuelca
+al banco las preguntas de las evaluaciones ya generadas (sin bloques fuente).
+
+Uso:
+    python scripts/migrate_banco_preguntas.py
+    python scripts/migrate_banco_preguntas.py --importar
+"""
+import sys
+import os
+import argparse
+
+# Añadir el directorio raíz al path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dotenv import load_dotenv
+load_dotenv()
+
+from sqlalchemy import text
+from app.db.database import engine, SessionLocal
+
+
+def migrar(importar: bool = False):
+    print("=" * 60)
+    print("MIGRACIÓN: banco_preguntas")
+    print("=" * 60)
+
+    with engine.connect() as conn:
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS banco_preguntas (
+                id SERIAL PRIMARY KEY,
+                temario_id INTEGER NOT NULL REFERENCES temario(id),
+                tipo VARCHAR(20) NOT NULL,
+                enunciado TEXT NOT NULL,
+                contenido JSONB NOT NULL,
+                dificultad INTEGER DEFAULT 2,
+                bloques_fuente JSONB,
+                embedding VECTOR(1536),
+                veces_usada INTEGER DEFAULT 0,
+                activa BOOLEAN DEFAULT TRUE,
+                fecha_creacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS idx_banco_preguntas_temario ON banco_preguntas(temario_id) WHERE activa"))
+        conn.commit()
+        print("  → tabla banco_preguntas creada")
+
+    if importar:
+        from app.models.modelos import Assessment
+        from app.crud.assessment_service import guardar_en_banco
+
+        db = SessionLocal()
+        total = 0
+        for assessment in db.query(Assessment).order_by(Assessment.id).all():
+            preguntas = (assessment.generated_json_payload or {}).get("preguntas", [])
+            total += len(guardar_en_banco(db, assessment.temario_id, [dict(p) for p in preguntas], []))
+            db.commit()
+        db.close()
+        print(f"  → {total} preguntas importadas de evaluaciones anteriores")
+
+    print("\n" + "=" * 60)
+    print("MIGRACIÓN COMPLETADA")
+    print("=" * 60)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Crea banco_preguntas")
+    parser.add_argument("--importar", action="store_true", help="Importar las preguntas de evaluaciones existentes")
+    args = parser.parse_args()
+    migrar(args.importar)
@@ -0,0 +1,51 @@
+"""
+Script de migración: caché de correcciones de respuestas abiertas.
+Ejecutar UNA VEZ tras actualizar el código (las bases creadas con schema_final.sql ya la tienen).
+
+Crea cache_correcciones: una respuesta igual o casi igual a otra ya calificada para la
+misma pregunta reutiliza el veredicto del juez (ver assessment_service._buscar_en_cache).
+"""
+import sys
+import os
+
+# Añadir el directorio raíz al path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dotenv import load_dotenv
+load_dotenv()
+
+from sqlalchemy import text
+from app.db.database import engine
+
+
+def migrar():
+    print("=" * 60)
+    print("MIGRACIÓN: cache_correcciones")
+    print("=" * 60)
+
+    with engine.connect() as conn:
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS cache_correcciones (
+                id SERIAL PRIMARY KEY,
+                assessment_id INTEGER NOT NULL REFERENCES assessments(id),
+                pregunta_idx INTEGER NOT NULL,
+                respuesta_hash VARCHAR(64) NOT NULL,
+                respuesta_normalizada TEXT NOT NULL,
+                embedding VECTOR(1536),
+                resultado JSONB NOT NULL,
+                hits INTEGER DEFAULT 0,
+                fecha_creacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                ultimo_uso TIMESTAMP,
+                UNIQUE (assessment_id, pregunta_idx, respuesta_hash)
+            )
+        """))
+        conn.commit()
+        print("  → tabla cache_correcciones creada")
+
+    print("\n" + "=" * 60)
+    print("MIGRACIÓN COMPLETADA")
+    print("=" * 60)
+
+
+if __name__ == "__main__":
+    migrar()
@@ -0,0 +1,90 @@
+"""
+Script de migración: embedding_cache con claves por modelo y seguimiento de uso.
+Ejecutar UNA VEZ tras actualizar el código.
+
+Este script:
+1. Añade las columnas modelo, dimension, last_used_at y hit_count (y deja created_at y
+   last_used_at como TIMESTAMP sin zona horaria)
+2. Permite original_text NULL (la compactación lo vacía)
+3. Re-calcula las claves como sha256('modelo|dimension|texto') para las filas cuyo texto
+   se guardó completo; las que se guardaron truncadas (2000 caracteres) ya no se pueden
+   re-indexar y se eliminan
+4. Crea el índice de uso para la compactación
+"""
+import sys
+import os
+
+# Añadir el directorio raíz al path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dotenv import load_dotenv
+load_dotenv()
+
+from sqlalchemy import text
+from app.db.database import engine
+from app.crud.embedding_service import EMBEDDING_DEPLOYMENT, EMBEDDING_DIM, EMBEDDING_CACHE_TEXTO_MAX
+
+
+def migrar():
+    print("=" * 60)
+    print("MIGRACIÓN: embedding_cache (claves por modelo + uso)")
+    print(f"Modelo actual: {EMBEDDING_DEPLOYMENT} ({EMBEDDING_DIM} dims)")
+    print("=" * 60)
+
+    with engine.connect() as conn:
+        print("\n[1/4] Añadiendo columnas...")
+        conn.execute(text("ALTER TABLE embedding_cache ADD COLUMN IF NOT EXISTS modelo VARCHAR(100)"))
+        conn.execute(text("ALTER TABLE embedding_cache ADD COLUMN IF NOT EXISTS dimension INT"))
+        conn.execute(text("ALTER TABLE embedding_cache ADD COLUMN IF NOT EXISTS last_used_at TIMESTAMP"))
+        # Ambas sin zona horaria: con TIMESTAMPTZ el COALESCE del índice no es IMMUTABLE.
+        # Se mira el tipo real (las bases creadas con create_all pueden tener created_at TIMESTAMPTZ)
+        tipos = dict(conn.execute(text("""
+            SELECT column_name, data_type FROM information_schema.columns
+            WHERE table_name = 'embedding_cache' AND column_name IN ('created_at', 'last_used_at')
+        """)).all())
+        for columna, tipo in tipos.items():
+            if tipo == "timestamp with time zone":
+                conn.execute(text(f"ALTER TABLE embedding_cache ALTER COLUMN {columna} TYPE TIMESTAMP"))
+                print(f"  → {columna}: TIMESTAMPTZ → TIMESTAMP")
+        conn.execute(text("ALTER TABLE embedding_cache ADD COLUMN IF NOT EXISTS hit_count INT NOT NULL DEFAULT 0"))
+        conn.execute(text("ALTER TABLE embedding_cache ALTER COLUMN original_text DROP NOT NULL"))
+        conn.commit()
+        print("  → columnas añadidas")
+
+        print("\n[2/4] Eliminando filas truncadas (no re-indexables)...")
+        borradas = conn.execute(text(
+            "DELETE FROM embedding_cache WHERE modelo IS NULL AND length(original_text) >= 2000"
+        )).rowcount
+        conn.commit()
+        print(f"  → {borradas} filas eliminadas")
+
+        print("\n[3/4] Re-calculando claves (sha256 'modelo|dimension|texto')...")
+        actualizadas = conn.execute(
+            text("""
+                UPDATE embedding_cache
+                SET text_hash = encode(sha256(convert_to(:modelo || '|' || :dim || '|' || original_text, 'UTF8')), 'hex'),
+                    modelo = :modelo,
+                    dimension = :dim,
+                    original_text = CASE WHEN :max > 0 THEN left(original_text, :max) END
+                WHERE modelo IS NULL
+            """),
+            {"modelo": EMBEDDING_DEPLOYMENT, "dim": EMBEDDING_DIM, "max": EMBEDDING_CACHE_TEXTO_MAX}
+        ).rowcount
+        conn.commit()
+        print(f"  → {actualizadas} filas re-indexadas")
+
+        print("\n[4/4] Creando índice de uso...")
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS idx_embedding_cache_uso "
+            "ON embedding_cache (COALESCE(last_used_at, created_at))"
+        ))
+        conn.commit()
+        print("  → índice creado")
+
+    print("\n" + "=" * 60)
+    print("MIGRACIÓN COMPLETADA")
+    print("=" * 60)
+
+
+if __name__ == "__main__":
+    migrar()
@@ -0,0 +1,52 @@
+"""
+Script de migración: checkpoints de ingesta y almacén de PDFs por SHA-256.
+Ejecutar UNA VEZ tras actualizar el código (las bases creadas con schema_final.sql ya los tienen).
+
+1. ingest_jobs.fase / ingest_jobs.checkpoint: un trabajo interrumpido se reanuda desde
+   el último lote escrito (ver app/crud/ingest_service.py)
+2. libros.pdf_sha256 / ingest_jobs.pdf_sha256 + índice: un PDF ya ingerido se enlaza o se
+   clona en lugar de re-ingestarlo (ver app/crud/blob_service.py)
+3. ingest_jobs.modo: 'edicion' aplica una edición revisada sobre un libro existente
+   (ver ingest_service.procesar_nueva_edicion)
+"""
+import sys
+import os
+
+# Añadir el directorio raíz al path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dotenv import load_dotenv
+load_dotenv()
+
+from sqlalchemy import text
+from app.db.database import engine
+
+
+def migrar():
+    print("=" * 60)
+    print("MIGRACIÓN: ingest_jobs (checkpoints, modo) + libros.pdf_sha256")
+    print("=" * 60)
+
+    with engine.connect() as conn:
+        conn.execute(text("ALTER TABLE ingest_jobs ADD COLUMN IF NOT EXISTS fase VARCHAR(20)"))
+        conn.execute(text("ALTER TABLE ingest_jobs ADD COLUMN IF NOT EXISTS checkpoint JSONB"))
+        conn.commit()
+        print("  → columnas fase y checkpoint añadidas")
+
+        conn.execute(text("ALTER TABLE ingest_jobs ADD COLUMN IF NOT EXISTS pdf_sha256 VARCHAR(64)"))
+        conn.execute(text("ALTER TABLE libros ADD COLUMN IF NOT EXISTS pdf_sha256 VARCHAR(64)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS idx_libros_pdf_sha256 ON libros(pdf_sha256)"))
+        conn.commit()
+        print("  → columnas pdf_sha256 e índice añadidos (los libros anteriores no se deduplican)")
+
+        conn.execute(text("ALTER TABLE ingest_jobs ADD COLUMN IF NOT EXISTS modo VARCHAR(20) NOT NULL DEFAULT 'nuevo'"))
+        conn.commit()
+        print("  → columna modo añadida")
+
+    print("\n" + "=" * 60)
+    print("MIGRACIÓN COMPLETADA")
+    print("=" * 60)
+
+
+if __name__ == "__main__":
+    migrar()
@@ -0,0 +1,56 @@
+"""
+Job de pre-renderizado TTS.
+Genera en la caché de audio las respuestas deterministas del tutor
+(mensajes fijos, saludos y, en modo fallback, los bloques literales del libro)
+para todas las voces configuradas. Ejecutar tras el despliegue o tras una ingesta.
+
+Uso:
+    python scripts/prerender_tts.py                      # Frases fijas, todas las voces
+    python scripts/prerender_tts.py --libro-id 3 --bloques
+    python scripts/prerender_tts.py --extra saludos.txt --concurrencia 8
+"""
+import sys
+import os
+import argparse
+
+# Añadir el directorio raíz al path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dotenv import load_dotenv
+load_dotenv()
+
+from app.db.database import SessionLocal
+from app.crud import rag_service, tts_service
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-renderiza frases fijas en la caché TTS")
+    parser.add_argument("--libro-id", type=int, default=None, help="Limitar los bloques a un libro")
+    parser.add_argument("--bloques", action="store_true", help="Incluir bloques literales del modo AVANCE aunque haya API")
+    parser.add_argument("--extra", default=None, help="Fichero con frases adicionales (una por línea, ej: saludos)")
+    parser.add_argument("--voces", default=None, help="Voces separadas por coma (default: todas)")
+    parser.add_argument("--concurrencia", type=int, default=tts_service.TTS_PRERENDER_CONCURRENCIA)
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        respuestas = rag_service.obtener_respuestas_pre_renderizables(
+            db, libro_id=args.libro_id, incluir_bloques=True if args.bloques else None
+        )
+    finally:
+        db.close()
+
+    if args.extra:
+        with open(args.extra, "r", encoding="utf-8") as f:
+            respuestas.extend(linea.strip() for linea in f if linea.strip())
+
+    voces = [v.strip() for v in args.voces.split(",")] if args.voces else None
+
+    print("=" * 60)
+    print(f"PRE-RENDER TTS: {len(respuestas)} respuestas")
+    print("=" * 60)
+    tts_service.prerenderizar_frases(respuestas, voces=voces, concurrencia=args.concurrencia)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Reconstrucción de los índices de búsqueda de base_conocimiento tras una carga masiva.
+
+Cada ingesta ya calcula busqueda_texto por lotes sin trigger, vacía la lista pendiente
+de los GIN y hace ANALYZE (ver ingest_service._mantenimiento_indices). Lo que no puede
+hacer es reconstruir el HNSW, que es de toda la tabla. Tras cargas masivas o muchas
+bajas (libros eliminados, nuevas ediciones) los índices acumulan entradas muertas: este
+script los reconstruye de una vez (HNSW y GIN) con más maintenance_work_mem.
+
+Por defecto usa REINDEX CONCURRENTLY (las búsquedas siguen funcionando mientras tanto).
+
+Uso:
+    python scripts/reconstruir_indices.py
+    python scripts/reconstruir_indices.py --solo-fts            # Rellenar busqueda_texto que falte
+    python scripts/reconstruir_indices.py --memoria 2GB --bloqueante
+"""
+import sys
+import os
+import time
+import argparse
+
+# Añadir el directorio raíz al path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dotenv import load_dotenv
+load_dotenv()
+
+from sqlalchemy import text
+from app.db.database import engine
+
+INDICES = (
+    "idx_base_conocimiento_embedding",  # HNSW
+    "idx_base_conocimiento_fts",        # GIN busqueda_texto
+    "idx_base_conocimiento_metadatos",  # GIN metadatos
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reconstruye los índices de búsqueda de base_conocimiento")
+    parser.add_argument("--memoria", default="1GB", help="maintenance_work_mem para la reconstrucción")
+    parser.add_argument("--bloqueante", action="store_true", help="REINDEX sin CONCURRENTLY (más rápido, bloquea escrituras)")
+    parser.add_argument("--solo-fts", action="store_true", help="Solo rellenar busqueda_texto vacío y ANALYZE")
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print("RECONSTRUCCIÓN DE ÍNDICES: base_conocimiento")
+    print("=" * 60)
+
+    tiempos = {}
+    # REINDEX CONCURRENTLY no puede ir dentro de una transacción
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        t0 = time.perf_counter()
+        filas = conn.execute(text("""
+            UPDATE base_conocimiento
+            SET busqueda_texto = setweight(to_tsvector('spanish', unaccent(COALESCE(contenido, ''))), 'A')
+            WHERE busqueda_texto IS NULL
+        """)).rowcount
+        tiempos["fts"] = time.perf_counter() - t0
+        print(f"  → busqueda_texto rellenado en {filas} chunks ({tiempos['fts']:.2f}s)")
+
+        if not args.solo_fts:
+            conn.execute(text("SELECT set_config('maintenance_work_mem', :m, false)"), {"m": args.memoria})
+            modo = "" if args.bloqueante else " CONCURRENTLY"
+            for indice in INDICES:
+                t0 = time.perf_counter()
+                conn.execute(text(f"REINDEX INDEX{modo} {indice}"))
+                tiempos[indice] = time.perf_counter() - t0
+                print(f"  → {indice} reconstruido ({tiempos[indice]:.2f}s)")
+
+        t0 = time.perf_counter()
+        conn.execute(text("ANALYZE base_conocimiento"))
+        tiempos["analyze"] = time.perf_counter() - t0
+        print(f"  → ANALYZE ({tiempos['analyze']:.2f}s)")
+
+    print("\n" + "=" * 60)
+    print(f"COMPLETADO en {sum(tiempos.values()):.2f}s")
+    print("=" * 60)
+
+
+if __name__ == "__main__":
+    main()